@@ -0,0 +1,220 @@
+"""Operational user statistics for ``/admin/stats``.
+
+Questions like "paid users per persona" or "free users about to run out"
+used to need a full ``users`` scan on the connection the webhook uses.
+:class:`UserStats` keeps the answers as in-memory counters instead.  The
+counters are keyed by ``(persona, state)``, where the state comes from
+:func:`classify`: ``paid``, ``free``, ``near_quota`` or ``exhausted``.
+
+* Handlers report every change they make to a user with
+  :meth:`UserStats.update`, giving the row before and after: a persona
+  switch, a payment, an expiry or a spent free message.  Each message also
+  calls :meth:`UserStats.message`.  Both only touch a dict under a lock.
+* :meth:`UserStats.reconcile` replaces the counters with one aggregate
+  query, by default every ``interval`` seconds on a background thread.  It
+  picks up users created since the last pass and corrects drift, for
+  example from changes made by other instances.  Changes reported while
+  the query runs are added on top of its result.
+
+A dashboard request only reads the counters, so it adds no load to the
+production database.
+"""
+
+from __future__ import annotations
+
+import datetime
+import hmac
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Callable, Iterable
+
+from storage import UserRow
+
+STATES = ("paid", "free", "near_quota", "exhausted")
+
+# (persona, state, users, msg_count 總和)
+Snapshot = Iterable[tuple[str, str, int, int]]
+
+
+def classify(is_paid: int, free_count: int, near_quota: int) -> str:
+    if is_paid:
+        return "paid"
+    if free_count <= 0:
+        return "exhausted"
+    return "near_quota" if free_count <= near_quota else "free"
+
+
+def sqlite_snapshot(conn: sqlite3.Connection, near_quota: int) -> Snapshot:
+    """Aggregate the ``users`` table in one pass (use a dedicated connection)."""
+    return conn.execute(
+        "SELECT persona, CASE WHEN is_paid THEN 'paid' "
+        "WHEN free_count <= 0 THEN 'exhausted' "
+        "WHEN free_count <= ? THEN 'near_quota' ELSE 'free' END AS state, "
+        "COUNT(*), COALESCE(SUM(msg_count), 0) FROM users GROUP BY persona, state",
+        (near_quota,),
+    ).fetchall()
+
+
+def redis_snapshot(store, near_quota: int, batch: int = 500) -> Snapshot:
+    """Same aggregate for :class:`storage.RedisUserStore` (SCAN + pipelines)."""
+    agg: Counter = Counter()
+    msgs: Counter = Counter()
+    keys: list[bytes] = []
+
+    def drain() -> None:
+        pipe = store.r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, "persona", "is_paid", "free_count", "msg_count")
+        for persona, paid, free, count in pipe.execute():
+            state = classify(int(paid or 0), int(free or 0), near_quota)
+            bucket = ((persona or b"").decode(), state)
+            agg[bucket] += 1
+            msgs[bucket] += int(count or 0)
+        keys.clear()
+
+    for key in store.r.scan_iter(match=store._key("*"), count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            drain()
+    if keys:
+        drain()
+    return [(p, s, n, msgs[(p, s)]) for (p, s), n in agg.items()]
+
+
+def authorized(header: str | None, token: str | None) -> bool:
+    """``Authorization: Bearer <token>`` check in constant time."""
+    if not token or not header or not header.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(header[len("Bearer ") :].encode(), token.encode())
+
+
+class UserStats:
+    """Incrementally maintained user counters; safe to call from any thread."""
+
+    def __init__(
+        self,
+        snapshot: Callable[[], Snapshot] | None,
+        near_quota: int = 3,
+        interval: float = 600,
+    ) -> None:
+        self.snapshot = snapshot
+        self.near_quota = near_quota
+        self.interval = interval
+        self._counts: Counter = Counter()
+        self._messages: Counter = Counter()  # persona -> msg_count 總和
+        self._pending: Counter | None = None  # reconcile 查詢期間的變動
+        self.reconciled_at: float | None = None
+        self.drift = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _bucket(self, row: UserRow) -> tuple[str, str]:
+        return row.persona, classify(row.is_paid, row.free_count, self.near_quota)
+
+    def update(self, before: UserRow, after: UserRow) -> None:
+        """Move the user from ``before``'s bucket to ``after``'s."""
+        old, new = self._bucket(before), self._bucket(after)
+        if old == new:
+            return
+        with self._lock:
+            for counts in (self._counts, self._pending):
+                if counts is None:
+                    continue
+                counts[old] -= 1
+                counts[new] += 1
+
+    def message(self, persona: str) -> None:
+        with self._lock:
+            self._messages[persona] += 1
+            if self._pending is not None:
+                self._pending[("msg", persona)] += 1
+
+    def reconcile(self) -> None:
+        """Reset the counters from :attr:`snapshot`."""
+        if self.snapshot is None:
+            return
+        with self._lock:
+            self._pending = Counter()
+        try:
+            rows = list(self.snapshot())
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        counts: Counter = Counter()
+        messages: Counter = Counter()
+        for persona, state, users, msg_sum in rows:
+            counts[(persona, state)] += users
+            messages[persona] += msg_sum
+        with self._lock:
+            for key, delta in self._pending.items():
+                if key[0] == "msg":
+                    messages[key[1]] += delta
+                else:
+                    counts[key] += delta
+            self._pending = None
+            keys = set(counts) | set(self._counts)
+            self.drift = sum(abs(counts[k] - self._counts[k]) for k in keys)
+            self._counts = counts
+            self._messages = messages
+            self.reconciled_at = time.time()
+
+    def view(self) -> dict:
+        """JSON body of ``/admin/stats``."""
+        with self._lock:
+            counts = dict(self._counts)
+            messages = dict(self._messages)
+        personas: dict[str, dict[str, int]] = {}
+        for (persona, state), n in counts.items():
+            if n > 0:
+                personas.setdefault(persona, dict.fromkeys(STATES, 0))[state] = n
+        totals = {s: sum(p[s] for p in personas.values()) for s in STATES}
+        reconciled = (
+            datetime.datetime.fromtimestamp(
+                self.reconciled_at, datetime.timezone.utc
+            ).isoformat()
+            if self.reconciled_at
+            else None
+        )
+        return {
+            "users": sum(totals.values()),
+            "totals": totals,
+            "personas": personas,
+            "messages": {k: v for k, v in messages.items() if v},
+            "near_quota_threshold": self.near_quota,
+            "reconciled_at": reconciled,
+            "drift": self.drift,
+        }
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="stats", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        # 啟動時先對帳一次，之後定期
+        while True:
+            try:
+                self.reconcile()
+            except Exception:
+                logging.exception("stats reconcile failed")
+            if self._stop.wait(self.interval):
+                return
+
+
+__all__ = [
+    "STATES",
+    "UserStats",
+    "authorized",
+    "classify",
+    "redis_snapshot",
+    "sqlite_snapshot",
+]
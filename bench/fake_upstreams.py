@@ -0,0 +1,248 @@
+"""Local stand-ins for LINE, OpenAI, Replicate, ElevenLabs and R2.
+
+Each upstream runs on its own ``ThreadingHTTPServer`` so it can be given its
+own latency and error profile.  Latency is drawn from a log-normal
+distribution around ``median_ms``; a fraction ``error_rate`` of requests
+answers with HTTP 503.
+
+Only the endpoints ``main.py`` actually calls are implemented, with response
+bodies just detailed enough for the SDKs to parse them.
+"""
+
+from __future__ import annotations
+
+import io
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def sample_jpeg(size: int = 768) -> bytes:
+    """Return a JPEG of roughly SDXL output size (Pillow) or a stub payload."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\xff\xd8\xff\xe0" + b"\x00" * 60_000 + b"\xff\xd9"
+    out = io.BytesIO()
+    Image.new("RGB", (size, size), (240, 200, 210)).save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+@dataclass
+class Profile:
+    """Latency/error distribution of one fake upstream."""
+
+    median_ms: float = 50.0
+    sigma: float = 0.5
+    error_rate: float = 0.0
+
+    def delay(self) -> None:
+        if self.median_ms > 0:
+            ms = self.median_ms * math.exp(random.gauss(0, self.sigma))
+            time.sleep(ms / 1000)
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeServer"
+
+    def log_message(self, fmt, *args):  # 靜音
+        pass
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status: int, body: bytes = b"", ctype: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        if self.command == "PUT":
+            self.send_header("ETag", '"fake"')
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json(self, obj, status: int = 200):
+        self._send(status, json.dumps(obj).encode())
+
+    def _handle(self):
+        body = self._body()
+        with self.server.lock:
+            self.server.requests[self.command] = (
+                self.server.requests.get(self.command, 0) + 1
+            )
+        self.server.profile.delay()
+        if self.server.profile.fails():
+            self._json({"error": "fake upstream failure"}, 503)
+            return
+        self.server.route(self, body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    name = "fake"
+
+    def __init__(self, profile: Profile | None = None) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.profile = profile or Profile()
+        self.lock = threading.Lock()
+        self.requests: dict[str, int] = {}
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "FakeServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def route(self, h: _Handler, body: bytes) -> None:
+        h._json({})
+
+
+class FakeLine(FakeServer):
+    name = "line"
+
+    def route(self, h, body):
+        if h.path.endswith("/content"):
+            h._send(200, b"\x00" * 2048, "audio/x-m4a")
+        elif "/message/" in h.path or "/broadcast" in h.path:
+            h._json({"sentMessages": [{"id": uuid.uuid4().hex, "quoteToken": "q"}]})
+        else:
+            h._json({})
+
+
+class FakeOpenAI(FakeServer):
+    name = "openai"
+
+    def route(self, h, body):
+        if h.path.endswith("/chat/completions"):
+            h._json(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "fake",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "嗨嗨～我在這裡喔"},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 40,
+                        "completion_tokens": 20,
+                        "total_tokens": 60,
+                    },
+                }
+            )
+        elif h.path.endswith("/audio/transcriptions"):
+            h._send(200, "早安".encode(), "text/plain; charset=utf-8")
+        else:
+            h._json({}, 404)
+
+
+class FakeReplicate(FakeServer):
+    name = "replicate"
+
+    def __init__(self, profile: Profile | None = None) -> None:
+        super().__init__(profile)
+        self.image = sample_jpeg()
+
+    def _prediction(self, pid: str) -> dict:
+        return {
+            "id": pid,
+            "model": "stability-ai/sdxl",
+            "version": "fake",
+            "status": "succeeded",
+            "input": {},
+            "output": [f"{self.url}/files/{pid}.jpg"],
+            "logs": "",
+            "error": None,
+            "metrics": {},
+            "created_at": "2024-01-01T00:00:00Z",
+            "urls": {
+                "get": f"{self.url}/v1/predictions/{pid}",
+                "cancel": f"{self.url}/v1/predictions/{pid}/cancel",
+            },
+        }
+
+    def route(self, h, body):
+        if h.path.startswith("/files/"):
+            h._send(200, self.image, "image/jpeg")
+        elif h.path.startswith("/v1/predictions/"):
+            h._json(self._prediction(h.path.split("/")[3]))
+        elif h.path.startswith("/v1/predictions"):
+            h._json(self._prediction(uuid.uuid4().hex), 201)
+        else:
+            h._json({}, 404)
+
+
+class FakeElevenLabs(FakeServer):
+    name = "elevenlabs"
+
+    def route(self, h, body):
+        h._send(200, b"\xff\xfb\x90\x00" * 256, "audio/mpeg")
+
+
+class FakeR2(FakeServer):
+    """Accepts any S3 PUT/DELETE; answers multi-object deletes with no errors."""
+
+    name = "r2"
+
+    def route(self, h, body):
+        if h.command == "POST" and "delete" in h.path:
+            h._send(
+                200,
+                b'<?xml version="1.0" encoding="UTF-8"?><DeleteResult></DeleteResult>',
+                "application/xml",
+            )
+        else:
+            h._send(200, b"", "application/xml")
+
+
+FAKES = {
+    cls.name: cls
+    for cls in (FakeLine, FakeOpenAI, FakeReplicate, FakeElevenLabs, FakeR2)
+}
+
+
+def start_all(profiles: dict[str, Profile]) -> dict[str, FakeServer]:
+    """Start every fake upstream with its profile (default: 50 ms, no errors)."""
+    return {name: cls(profiles.get(name)).start() for name, cls in FAKES.items()}
+
+
+def app_env(servers: dict[str, FakeServer]) -> dict[str, str]:
+    """Environment variables pointing ``main.py`` at the fake upstreams."""
+    return {
+        "LINE_API_ENDPOINT": servers["line"].url,
+        "OPENAI_BASE_URL": f"{servers['openai'].url}/v1",
+        "REPLICATE_BASE_URL": servers["replicate"].url,
+        "ELEVENLABS_BASE_URL": servers["elevenlabs"].url,
+        "R2_ENDPOINT": servers["r2"].url,
+        "R2_BUCKET_NAME": "bench",
+        "R2_PUBLIC_URL": servers["r2"].url,
+        "R2_ACCESS_TOKEN": "bench",
+        "R2_SECRET_ACCESS_KEY": "bench",
+        "OPENAI_API_KEY": "sk-bench",
+        "REPLICATE_API_TOKEN": "r8-bench",
+        "ELEVENLABS_API_KEY": "bench",
+        "LINE_ACCESS_TOKEN": "bench",
+    }
@@ -0,0 +1,220 @@
+"""Signed LINE webhook traffic generator.
+
+Builds realistic webhook bodies (text, audio, ``/畫圖``, ``/群組`` and ECPay
+notifications), signs them with the channel secret and replays them open-loop
+at a target rate: request *i* is due at ``start + i / rps`` whether or not
+earlier requests have finished, so server slowdowns show up as latency
+instead of silently lowering the offered load.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import http.client
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from urllib.parse import urlencode, urlsplit
+
+from payment_gateway import generate_check_mac_value
+
+TEXTS = ["早安", "晚安", "在嗎", "想你", "今天好累喔", "你喜歡什麼顏色？", "陪我聊聊天"]
+DEFAULT_MIX = {
+    "text": 0.75,
+    "audio": 0.1,
+    "image": 0.05,
+    "group": 0.05,
+    "payment": 0.05,
+}
+
+
+def parse_mix(spec: str | None) -> dict[str, float]:
+    """Parse ``"text=0.8,image=0.2"``; weights need not sum to one."""
+    if not spec:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        if kind.strip() not in DEFAULT_MIX:
+            raise ValueError(f"unknown event kind: {kind!r}")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def sign(body: bytes, channel_secret: str) -> str:
+    digest = hmac.new(channel_secret.encode(), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def _event(uid: str, message: dict) -> dict:
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": uid},
+        "webhookEventId": uuid.uuid4().hex.upper()[:26],
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "message": message,
+    }
+
+
+def webhook_body(kind: str, uid: str) -> bytes:
+    if kind == "audio":
+        message = {
+            "type": "audio",
+            "id": str(random.randint(10**14, 10**15)),
+            "duration": 3000,
+            "contentProvider": {"type": "line"},
+        }
+    else:
+        text = {
+            "image": "/畫圖 森林裡的小鹿",
+            "group": "/群組 晴子醬 小空",
+        }.get(kind) or random.choice(TEXTS)
+        message = {
+            "type": "text",
+            "id": str(random.randint(10**14, 10**15)),
+            "quoteToken": uuid.uuid4().hex,
+            "text": text,
+        }
+    payload = {"destination": "Ubench", "events": [_event(uid, message)]}
+    return json.dumps(payload, ensure_ascii=False).encode()
+
+
+def payment_form(uid: str, hash_key: str, hash_iv: str) -> bytes:
+    params = {
+        "MerchantID": "2000132",
+        "MerchantTradeNo": uuid.uuid4().hex[:20],
+        "RtnCode": "1",
+        "RtnMsg": "Succeeded",
+        "TradeNo": str(random.randint(10**9, 10**10)),
+        "TradeAmt": "99",
+        "PaymentDate": time.strftime("%Y/%m/%d %H:%M:%S"),
+        "PaymentType": "Credit_CreditCard",
+        "TradeDate": time.strftime("%Y/%m/%d %H:%M:%S"),
+        # 真實付款的形狀：模擬付款（SimulatePaid=1）不會開通，量不到延長會員的路徑
+        "SimulatePaid": "0",
+        "CustomField1": uid,
+    }
+    params["CheckMacValue"] = generate_check_mac_value(params, hash_key, hash_iv)
+    return urlencode(params).encode()
+
+
+@dataclass
+class Result:
+    kind: str
+    status: int
+    latency: float  # seconds, measured from the scheduled send time
+    lag: float  # how late the request actually left
+
+
+@dataclass
+class LoadConfig:
+    base_url: str
+    rps: float
+    duration: float
+    users: list[str]
+    channel_secret: str
+    hash_key: str
+    hash_iv: str
+    mix: dict[str, float] = field(default_factory=lambda: dict(DEFAULT_MIX))
+    concurrency: int = 64
+
+
+class _Conn(threading.local):
+    conn: http.client.HTTPConnection | None = None
+
+
+def run(cfg: LoadConfig) -> list[Result]:
+    """Replay traffic for ``cfg.duration`` seconds and return every result."""
+    target = urlsplit(cfg.base_url)
+    local = _Conn()
+    kinds = list(cfg.mix)
+    weights = [cfg.mix[k] for k in kinds]
+    results: list[Result] = []
+    lock = threading.Lock()
+
+    def send(kind: str, due: float) -> None:
+        uid = random.choice(cfg.users)
+        if kind == "payment":
+            path = "/payment_callback"
+            body = payment_form(uid, cfg.hash_key, cfg.hash_iv)
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        else:
+            path, body = "/callback", webhook_body(kind, uid)
+            headers = {
+                "Content-Type": "application/json",
+                "X-Line-Signature": sign(body, cfg.channel_secret),
+            }
+        sent = time.perf_counter()
+        try:
+            if local.conn is None:
+                local.conn = http.client.HTTPConnection(
+                    target.hostname, target.port, timeout=120
+                )
+            local.conn.request("POST", path, body=body, headers=headers)
+            resp = local.conn.getresponse()
+            resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            local.conn = None
+            status = 0
+        done = time.perf_counter()
+        with lock:
+            results.append(Result(kind, status, done - due, sent - due))
+
+    total = int(cfg.rps * cfg.duration)
+    with ThreadPoolExecutor(max_workers=cfg.concurrency) as pool:
+        start = time.perf_counter()
+        for i in range(total):
+            due = start + i / cfg.rps
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, random.choices(kinds, weights)[0], due)
+    return results
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+def summarize(results: list[Result], elapsed: float) -> dict:
+    def stats(rows: list[Result]) -> dict:
+        lat = sorted(r.latency * 1000 for r in rows)
+        return {
+            "count": len(rows),
+            "errors": sum(1 for r in rows if r.status != 200),
+            "p50_ms": round(percentile(lat, 50), 2),
+            "p95_ms": round(percentile(lat, 95), 2),
+            "p99_ms": round(percentile(lat, 99), 2),
+            "max_ms": round(lat[-1], 2) if lat else 0.0,
+            "mean_ms": round(sum(lat) / len(lat), 2) if lat else 0.0,
+        }
+
+    ok = [r for r in results if r.status == 200]
+    status_counts: dict[str, int] = {}
+    for r in results:
+        status_counts[str(r.status)] = status_counts.get(str(r.status), 0) + 1
+    lags = sorted(r.lag * 1000 for r in results)
+    return {
+        "requests": len(results),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "latency": stats(results),
+        "by_kind": {
+            kind: stats([r for r in results if r.kind == kind])
+            for kind in sorted({r.kind for r in results})
+        },
+        "status": status_counts,
+        "client_lag_p99_ms": round(percentile(lags, 99), 2),
+    }
@@ -0,0 +1,257 @@
+"""Offline load test: boot ``main:app`` against fake upstreams and replay traffic.
+
+Usage (from the repository root)::
+
+    python -m bench.run_bench --rps 20 --duration 60 \\
+        --latency openai=900,replicate=4000 --errors openai=0.02 \\
+        --out bench_results.json --baseline last_release.json
+
+The app runs in a subprocess (fresh ``users.db`` in a temp directory) with
+every upstream URL pointed at :mod:`bench.fake_upstreams`.  The report
+contains p50/p95/p99 latency overall and per event kind, throughput, the
+app's RSS, SQLite query-time quantiles scraped from ``/metrics`` and the
+number of "database is locked" errors in the app log.
+
+With ``--baseline`` the run exits non-zero when p95 latency or throughput
+regress by more than ``--max-regression`` percent.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+from bench import loadgen
+from bench.fake_upstreams import Profile, app_env, start_all
+
+ROOT = Path(__file__).resolve().parent.parent
+CHANNEL_SECRET = "bench-channel-secret"
+# ECPay 官方測試帳號
+HASH_KEY = "5294y06JbISpM5x9"
+HASH_IV = "v77hoKGq4kWxNNIS"
+
+
+def _parse_map(spec: str | None) -> dict[str, float]:
+    out = {}
+    for item in filter(None, (spec or "").split(",")):
+        name, _, value = item.partition("=")
+        out[name.strip()] = float(value)
+    return out
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_mb(pid: int) -> float:
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def _scrape(base_url: str) -> str:
+    try:
+        with urllib.request.urlopen(f"{base_url}/metrics", timeout=5) as resp:
+            return resp.read().decode()
+    except OSError:
+        return ""
+
+
+_BUCKET_RE = re.compile(r'^db_seconds_bucket\{op="([^"]+)",le="([^"]+)"\} (\S+)$')
+
+
+def _db_buckets(text: str) -> dict[str, dict[str, float]]:
+    out: dict[str, dict[str, float]] = {}
+    for line in text.splitlines():
+        m = _BUCKET_RE.match(line)
+        if m:
+            out.setdefault(m.group(1), {})[m.group(2)] = float(m.group(3))
+    return out
+
+
+def sqlite_report(before: str, after: str) -> dict:
+    """Per-operation query count and bucketed p95/p99 between two scrapes."""
+    start, end = _db_buckets(before), _db_buckets(after)
+    report = {}
+    for op, buckets in end.items():
+        delta = {le: n - start.get(op, {}).get(le, 0) for le, n in buckets.items()}
+        total = delta.get("+Inf", 0)
+        if not total:
+            continue
+
+        def quantile(q: float) -> str:
+            for le, n in sorted(
+                delta.items(),
+                key=lambda kv: float("inf") if kv[0] == "+Inf" else float(kv[0]),
+            ):
+                if n >= q * total:
+                    return le
+            return "+Inf"
+
+        report[op] = {
+            "count": int(total),
+            "p95_le_s": quantile(0.95),
+            "p99_le_s": quantile(0.99),
+        }
+    return report
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list[str]:
+    """Return a list of regressions beyond ``max_regression`` percent."""
+    problems = []
+    limit = 1 + max_regression / 100
+    old_p95 = baseline["latency"]["p95_ms"]
+    new_p95 = result["latency"]["p95_ms"]
+    if old_p95 and new_p95 > old_p95 * limit:
+        problems.append(f"p95 latency {old_p95:.1f}ms → {new_p95:.1f}ms")
+    old_tp = baseline["throughput_rps"]
+    new_tp = result["throughput_rps"]
+    if old_tp and new_tp * limit < old_tp:
+        problems.append(f"throughput {old_tp:.1f} → {new_tp:.1f} rps")
+    return problems
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rps", type=float, default=10)
+    ap.add_argument("--duration", type=float, default=30)
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--mix", help="e.g. text=0.8,audio=0.1,image=0.1")
+    ap.add_argument("--latency", help="median ms per upstream, e.g. openai=800")
+    ap.add_argument("--errors", help="error rate per upstream, e.g. replicate=0.05")
+    ap.add_argument("--out", default="bench_results.json")
+    ap.add_argument("--baseline", help="previous results file to compare against")
+    ap.add_argument("--max-regression", type=float, default=10.0)
+    args = ap.parse_args(argv)
+
+    latency, errors = _parse_map(args.latency), _parse_map(args.errors)
+    profiles = {
+        name: Profile(median_ms=latency.get(name, 50.0), error_rate=errors.get(name, 0))
+        for name in ("line", "openai", "replicate", "elevenlabs", "r2")
+    }
+    servers = start_all(profiles)
+    users = [f"Ubench{i:028d}" for i in range(args.users)]
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    log_path = Path(workdir) / "app.log"
+    env = {
+        **os.environ,
+        **app_env(servers),
+        "PYTHONPATH": str(ROOT),
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "ECPAY_HASH_KEY": HASH_KEY,
+        "ECPAY_HASH_IV": HASH_IV,
+        "ECPAY_MERCHANT_ID": "2000132",
+        # 壓測使用者都視為白名單，避免免費額度耗盡後只測到拒絕訊息
+        "WHITELIST_USER_IDS": ",".join(users),
+        "TRACE_EXPORT_PATH": "",
+    }
+    with log_path.open("w") as log:
+        app = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+            cwd=workdir,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    try:
+        for _ in range(200):
+            try:
+                urllib.request.urlopen(f"{base_url}/health", timeout=1).read()
+                break
+            except OSError:
+                if app.poll() is not None:
+                    print(log_path.read_text(), file=sys.stderr)
+                    return 2
+                time.sleep(0.1)
+
+        rss = {"start": _rss_mb(app.pid), "peak": 0.0}
+        stop = threading.Event()
+
+        def sample_memory():
+            while not stop.wait(0.5):
+                rss["peak"] = max(rss["peak"], _rss_mb(app.pid))
+
+        threading.Thread(target=sample_memory, daemon=True).start()
+        before = _scrape(base_url)
+        cfg = loadgen.LoadConfig(
+            base_url=base_url,
+            rps=args.rps,
+            duration=args.duration,
+            users=users,
+            channel_secret=CHANNEL_SECRET,
+            hash_key=HASH_KEY,
+            hash_iv=HASH_IV,
+            mix=loadgen.parse_mix(args.mix),
+            concurrency=args.concurrency,
+        )
+        started = time.perf_counter()
+        results = loadgen.run(cfg)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        after = _scrape(base_url)
+        rss["end"] = _rss_mb(app.pid)
+    finally:
+        app.terminate()
+        app.wait(timeout=10)
+        for server in servers.values():
+            server.stop()
+
+    app_log = log_path.read_text(errors="replace")
+    report = {
+        "config": {
+            "rps": args.rps,
+            "duration": args.duration,
+            "users": args.users,
+            "mix": cfg.mix,
+            "profiles": {k: vars(v) for k, v in profiles.items()},
+        },
+        **loadgen.summarize(results, elapsed),
+        "memory_mb": {k: round(v, 1) for k, v in rss.items()},
+        "sqlite": {
+            "queries": sqlite_report(before, after),
+            "locked_errors": app_log.count("database is locked"),
+        },
+        "upstream_requests": {
+            name: sum(server.requests.values()) for name, server in servers.items()
+        },
+    }
+    Path(args.out).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    lat = report["latency"]
+    print(
+        f"{report['requests']} requests, {report['throughput_rps']} rps ok, "
+        f"p50 {lat['p50_ms']}ms p95 {lat['p95_ms']}ms p99 {lat['p99_ms']}ms "
+        f"→ {args.out}"
+    )
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        problems = compare(report, baseline, args.max_regression)
+        for p in problems:
+            print(f"REGRESSION: {p}", file=sys.stderr)
+        if problems:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+"""Micro-benchmarks for the CPU work every text message does.
+
+The user store is seeded with :data:`USERS` rows and the chat completion is
+stubbed with a fixed answer, so only our own code is timed:
+
+* ``get_user`` and, separately, the membership expiry check,
+* :func:`commands.classify_command`, which labels every message in ``process``,
+* the persona ``wrapper`` lookup and the ``wrap_as_*`` call it returns,
+* :func:`style_prompt.romanticize`,
+* ``main.handle_message`` for chat messages.  This is the real module
+  (imported as in ``tests/conftest.py``), with its SQLite user store,
+  response cache, usage ledger and metrics; only the LINE reply and OpenAI
+  are stubbed, and the rate and monthly limits are raised so that no user
+  is refused while the case runs.
+
+The pieces get their own cases because the SQLite reads and writes dominate
+the message: a slow date parse or a per-message dict rebuild adds well
+under the threshold there, but multiplies the cost of its own case.
+
+Every case records ops/sec and the bytes allocated per call:
+
+* Calls are timed in batches of :data:`BATCH`.  The reported ops/sec
+  comes from the fastest round, which the scheduler and GC disturb least.
+* The guard does not compare raw ops/sec.  Each batch is also timed
+  alternately with a fixed workload (:func:`calibrate`), and the median
+  ratio is compared, so a host that is slower today is not a regression.
+* Allocations are the ``tracemalloc`` peak, median of :data:`ALLOC_SAMPLES`
+  calls.
+
+With ``HOT_PATH_SAVE=1`` the numbers are written to the baseline file
+(``HOT_PATH_BASELINE``).  Otherwise they are compared with it, and a case
+fails when it is more than ``HOT_PATH_MAX_REGRESSION`` percent (default
+20) slower or allocates that much more.  A case also fails when the
+baseline file or its entry is missing, so an unrecorded baseline never
+passes silently.
+
+These benchmarks are not collected by a plain ``pytest`` run
+(``testpaths`` in ``pytest.ini``).  Usage, from the repository root with
+``requirements-dev.txt`` installed::
+
+    HOT_PATH_SAVE=1 python -m pytest bench/test_hot_path.py   # record
+    python -m pytest bench/test_hot_path.py                   # compare
+
+Record the baseline on the machine that runs the comparison; the ratios
+still depend somewhat on the CPU and Python version, so the file is not
+committed.
+"""
+
+from __future__ import annotations
+
+import datetime
+import itertools
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+import tracemalloc
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+from commands import COMMAND_TYPES, classify_command
+# app 是 tests/conftest.py 的 fixture：匯入後這個模組也能用
+from conftest import app, text_event  # noqa: F401
+from personas import DEFAULT_WRAPPER, PERSONAS, WRAPPERS
+from rate_limit import RateLimiter
+from storage import SQLiteUserStore, is_expired
+from style_prompt import romanticize
+
+USERS = 100_000
+ALLOC_SAMPLES = 200
+# 單次呼叫只有微秒級，成批計時才不會被計時器本身的誤差蓋過
+BATCH = 100
+RELATIVE_ROUNDS = 300
+TODAY = datetime.date(2024, 5, 1)
+# 假的模型回覆（不打上游）
+ANSWER = "今天過得怎麼樣？記得早點休息，明天還要上班呢。"
+TEXTS = [
+    "早安",
+    "今天好累喔",
+    "你喜歡什麼顏色？",
+    "陪我聊聊天",
+    *(prefix + " 測試" for prefix, _ in COMMAND_TYPES),
+]
+# handle_message 只送聊天訊息（指令會去打圖片、TTS 等上游）
+CHAT_TEXTS = TEXTS[:4]
+
+BASELINE = os.getenv(
+    "HOT_PATH_BASELINE",
+    os.path.join(os.path.dirname(__file__), "hot_path_baseline.json"),
+)
+MAX_REGRESSION = float(os.getenv("HOT_PATH_MAX_REGRESSION", "20"))
+SAVE = os.getenv("HOT_PATH_SAVE") == "1"
+_WORDS = [f"w{i}" for i in range(200)]  # calibrate() 用
+# 記憶體量小時的誤差（位元組），避免幾十 bytes 的差異就判定退步
+ALLOC_SLACK = 256
+
+USERS_SQL = """
+CREATE TABLE users(
+    user_id TEXT PRIMARY KEY,
+    msg_count     INT DEFAULT 0,
+    is_paid       INT DEFAULT 0,
+    free_count    INT DEFAULT 10,
+    paid_until    TEXT,
+    persona       TEXT DEFAULT 'rina',
+    group_personas TEXT,
+    timezone      TEXT,
+    push_opt_out  INT DEFAULT 0
+);
+"""
+
+
+def seed_rows(n: int, rng: random.Random, today: datetime.date = TODAY):
+    personas = list(PERSONAS)
+    for i in range(n):
+        paid = rng.random() < 0.3
+        # 付費會員一半已過期、一半還有效
+        until = (
+            (today + datetime.timedelta(days=rng.randint(-30, 30))).isoformat()
+            if paid
+            else None
+        )
+        yield (
+            f"U{i:032x}",
+            rng.randint(0, 500),
+            int(paid),
+            rng.randint(0, 10),
+            until,
+            rng.choice(personas),
+        )
+
+
+@pytest.fixture(scope="module")
+def store():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    conn.execute(USERS_SQL)
+    conn.executemany(
+        "INSERT INTO users(user_id, msg_count, is_paid, free_count, paid_until, "
+        "persona) VALUES(?, ?, ?, ?, ?, ?)",
+        seed_rows(USERS, random.Random(0)),
+    )
+    conn.commit()
+    return SQLiteUserStore(conn, free_quota=10, default_persona="rina")
+
+
+@pytest.fixture(scope="module")
+def chat(app, uids):
+    """``main`` with :data:`USERS` seeded users and its upstreams stubbed."""
+    from linebot.v3.webhooks import MessageEvent
+
+    conn = app.store.conn
+    with app.store.lock:
+        conn.execute("DELETE FROM users")
+        conn.executemany(
+            "INSERT INTO users(user_id, msg_count, is_paid, free_count, "
+            "paid_until, persona) VALUES(?, ?, ?, ?, ?, ?)",
+            seed_rows(USERS, random.Random(0), datetime.date.today()),
+        )
+        # 有免費額度的人給足：計時期間沒有人用完，走到的路徑分布才穩定
+        conn.execute("UPDATE users SET free_count = 1000000 WHERE free_count > 0")
+        conn.commit()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(app, "respond", lambda e, *parts: None)
+        mp.setattr(app, "ask_openai", lambda text, persona, model=None: ANSWER)
+        mp.setattr(app, "rate_limiter", RateLimiter({"free": {"chat": (10**9, 1)}}))
+        mp.setattr(app, "MONTH_LIMIT", 10**9)
+        events = [
+            (MessageEvent.from_dict(text_event(uid, text)), text)
+            for uid, text in zip(uids, itertools.cycle(CHAT_TEXTS))
+        ]
+        # 先跑一輪：過期會員降級、回覆快取填滿，之後每輪的工作量才一致
+        for e, text in events:
+            app.handle_message(e, text)
+        yield events
+
+
+@pytest.fixture(scope="module")
+def uids():
+    rng = random.Random(1)
+    return [f"U{rng.randrange(USERS):032x}" for _ in range(1000)]
+
+
+@pytest.fixture(scope="module")
+def results():
+    out: dict[str, dict[str, float]] = {}
+    yield out
+    if SAVE and out:
+        with open(BASELINE, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+
+
+def alloc_per_call(func) -> int:
+    """Median ``tracemalloc`` peak (bytes) of one ``func()`` call."""
+    func()  # 先暖身，快取等一次性配置不算
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(ALLOC_SAMPLES):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return int(statistics.median(peaks))
+
+
+def calibrate() -> None:
+    """A fixed pure-Python workload (dict, str and int work)."""
+    table = {w: len(w) for w in _WORDS}
+    "".join(w for w in _WORDS if table[w] > 2)
+    sum(i * i for i in range(500))
+
+
+def relative_speed(batch, rounds: int = RELATIVE_ROUNDS) -> float:
+    """Speed of ``batch`` relative to :func:`calibrate` (median of pairs)."""
+    ratios = []
+    clock = time.perf_counter
+    for _ in range(rounds):
+        # 兩者交錯計時，主機忽快忽慢時兩邊受到相同影響
+        start = clock()
+        batch()
+        mid = clock()
+        calibrate()
+        ratios.append((clock() - mid) / (mid - start))
+    return statistics.median(ratios)
+
+
+def guard(benchmark, results, name: str, func) -> None:
+    """Benchmark ``func`` and fail if it regressed against the baseline."""
+
+    def batch():
+        for _ in range(BATCH):
+            func()
+
+    benchmark(batch)
+    if benchmark.disabled:  # --benchmark-disable 時只跑一次、沒有統計
+        return
+    ops = BATCH / benchmark.stats.stats.min
+    current = {
+        "ops": ops,
+        "relative": relative_speed(batch),
+        "alloc_bytes": alloc_per_call(func),
+    }
+    results[name] = current
+    benchmark.extra_info.update(current)
+    if SAVE:
+        return
+    if not os.path.exists(BASELINE):
+        pytest.fail(f"no baseline at {BASELINE}; record one with HOT_PATH_SAVE=1")
+    with open(BASELINE, encoding="utf-8") as f:
+        base = json.load(f).get(name)
+    if base is None:
+        pytest.fail(f"{name} is not in {BASELINE}; re-record with HOT_PATH_SAVE=1")
+    limit = MAX_REGRESSION / 100
+    problems = []
+    if current["relative"] < base["relative"] * (1 - limit):
+        slower = 1 - current["relative"] / base["relative"]
+        problems.append(f"{slower:.0%} slower ({current['ops']:.0f} ops/s)")
+    if current["alloc_bytes"] > base["alloc_bytes"] * (1 + limit) + ALLOC_SLACK:
+        problems.append(f"{current['alloc_bytes']} B vs {base['alloc_bytes']} B")
+    if problems:
+        pytest.fail(
+            f"{name} regressed more than {MAX_REGRESSION:g}%: " + "; ".join(problems)
+        )
+
+
+def test_get_user(benchmark, results, store, uids):
+    it = itertools.cycle(uids)
+    guard(benchmark, results, "get_user", lambda: store.get_user(next(it)))
+
+
+def test_expiry_check(benchmark, results, store, uids):
+    until = [row.paid_until for row in map(store.get_user, uids) if row.is_paid]
+    it = itertools.cycle(until)
+    guard(benchmark, results, "expiry_check", lambda: is_expired(next(it), TODAY))
+
+
+def test_classify_command(benchmark, results):
+    it = itertools.cycle(TEXTS)
+    guard(benchmark, results, "classify_command", lambda: classify_command(next(it)))
+
+
+def test_wrapper_lookup(benchmark, results):
+    it = itertools.cycle([*PERSONAS, "unknown"])
+    guard(
+        benchmark,
+        results,
+        "wrapper_lookup",
+        lambda: WRAPPERS.get(next(it), DEFAULT_WRAPPER),
+    )
+
+
+def test_wrap_as(benchmark, results):
+    it = itertools.cycle(WRAPPERS.values())
+    guard(benchmark, results, "wrap_as", lambda: next(it)(ANSWER))
+
+
+def test_romanticize(benchmark, results):
+    guard(benchmark, results, "romanticize", lambda: romanticize(ANSWER))
+
+
+def test_handle_message(benchmark, results, chat, app):
+    it = itertools.cycle(chat)
+    guard(benchmark, results, "handle_message", lambda: app.handle_message(*next(it)))
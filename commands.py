@@ -0,0 +1,40 @@
+"""Command classification for metrics labels and tracing.
+
+Every message goes through :func:`classify_command`, so the prefixes are
+matched with one precompiled regular expression instead of a ``startswith``
+loop over :data:`COMMAND_TYPES`.
+"""
+
+from __future__ import annotations
+
+import re
+
+COMMAND_TYPES = (
+    ("/help", "help"),
+    ("/購買", "buy"),
+    ("/幫我續費", "buy"),
+    ("/狀態查詢", "status"),
+    ("/角色", "persona"),
+    ("/群組", "group"),
+    ("/畫圖", "image"),
+    ("/朗讀", "tts"),
+    ("/推播", "push"),
+    ("/時區", "push"),
+)
+
+_NAMES = dict(COMMAND_TYPES)
+# 長的前綴排前面：日後若有前綴重疊，取最長的那個
+_PATTERN = re.compile(
+    "|".join(re.escape(p) for p in sorted(_NAMES, key=len, reverse=True))
+)
+
+
+def classify_command(text: str) -> str:
+    """Return the command type of ``text`` (``"chat"`` for plain messages)."""
+    if not text.startswith("/"):
+        return "chat"
+    match = _PATTERN.match(text)
+    return _NAMES[match.group()] if match else "chat"
+
+
+__all__ = ["COMMAND_TYPES", "classify_command"]
@@ -6,17 +6,29 @@ load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_PROJECT_ID = os.getenv("OPENAI_PROJECT_ID")
+# Upstream endpoints can be pointed at local stand-ins (see bench/)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 LINE_ACCESS_TOKEN = os.getenv("LINE_ACCESS_TOKEN")
+# Threads (and keep-alive connections) sending LINE replies and pushes
+LINE_WORKERS = int(os.getenv("LINE_WORKERS", "8"))
 WHITELIST_USER_IDS = set(filter(None, os.getenv("WHITELIST_USER_IDS", "").split(",")))
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
+REPLICATE_BASE_URL = os.getenv("REPLICATE_BASE_URL", "https://api.replicate.com")
 SD_API_KEY = os.getenv("SD_API_KEY")
 R2_ACCESS_TOKEN = os.getenv("R2_ACCESS_TOKEN")
 R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
 R2_ENDPOINT = os.getenv("R2_ENDPOINT")
 R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
 R2_PUBLIC_URL = os.getenv("R2_PUBLIC_URL")
+# Uploaded media is deleted this many days after its last access (0 keeps
+# it forever); the leader sweeps the catalog every MEDIA_SWEEP_INTERVAL seconds.
+MEDIA_IMAGE_DAYS = float(os.getenv("MEDIA_IMAGE_DAYS", "30"))
+MEDIA_AUDIO_DAYS = float(os.getenv("MEDIA_AUDIO_DAYS", "7"))
+MEDIA_SWEEP_INTERVAL = int(os.getenv("MEDIA_SWEEP_INTERVAL", "3600"))
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
+ELEVENLABS_BASE_URL = os.getenv("ELEVENLABS_BASE_URL", "https://api.elevenlabs.io")
 ELEVENLABS_VOICE_ID = os.getenv(
     "ELEVENLABS_VOICE_ID", "9lHjugDhwqoxA5MhX0az"
 )
@@ -24,3 +36,100 @@ ELEVENLABS_VOICE_ID = os.getenv(
 # Factor to adjust synthesized speech speed. 1.0 means original speed,
 # 0.5 means half speed (slower). Defaults to 1.0.
 TTS_SPEED = float(os.getenv("TTS_SPEED", "0.8"))
+
+# Voice messages: transcription threads, clips allowed to wait for one
+# before replying busy, longest clip accepted (seconds, after trimming
+# silence) and the chunk length long clips are split into and transcribed
+# in parallel.
+ASR_WORKERS = int(os.getenv("ASR_WORKERS", "4"))
+ASR_MAX_QUEUE = int(os.getenv("ASR_MAX_QUEUE", "32"))
+ASR_MAX_SECONDS = float(os.getenv("ASR_MAX_SECONDS", "300"))
+ASR_CHUNK_SECONDS = float(os.getenv("ASR_CHUNK_SECONDS", "30"))
+
+# Per-user rate limits, e.g. "free.chat=10/60,paid.image=20/3600".
+# Unlisted tiers/commands fall back to rate_limit.DEFAULT_LIMITS.
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+
+# Load shedding thresholds (concurrent requests / upstream latency in seconds)
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4")
+OPENAI_DEGRADED_MODEL = os.getenv("OPENAI_DEGRADED_MODEL", "gpt-4o-mini")
+LOAD_DEGRADE_INFLIGHT = int(os.getenv("LOAD_DEGRADE_INFLIGHT", "8"))
+LOAD_TEXT_ONLY_INFLIGHT = int(os.getenv("LOAD_TEXT_ONLY_INFLIGHT", "16"))
+LOAD_MAX_INFLIGHT = int(os.getenv("LOAD_MAX_INFLIGHT", "32"))
+LOAD_DEGRADE_LATENCY = float(os.getenv("LOAD_DEGRADE_LATENCY", "8"))
+LOAD_TEXT_ONLY_LATENCY = float(os.getenv("LOAD_TEXT_ONLY_LATENCY", "15"))
+# Threads running webhook handlers; keep it above LOAD_MAX_INFLIGHT so a
+# burst is shed with a busy reply instead of waiting in the pool queue.
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "48"))
+
+# Resilience: total time budget for one webhook and optional hedging delay
+# (seconds) for chat completions. 0 disables hedged requests.
+WEBHOOK_DEADLINE = float(os.getenv("WEBHOOK_DEADLINE", "50"))
+OPENAI_HEDGE_AFTER = float(os.getenv("OPENAI_HEDGE_AFTER", "0"))
+# Threads running hedged attempts; each hedged call holds up to two, so the
+# default covers every webhook worker hedging at once.
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", str(2 * WEBHOOK_WORKERS)))
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", "45"))
+
+# Request tracing: head-sampling rate (0–1), JSON-lines export file and a
+# slow-request log that captures every trace above TRACE_SLOW_MS.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "traces.jsonl")
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))
+TRACE_SLOW_LOG = os.getenv("TRACE_SLOW_LOG", "slow_traces.jsonl")
+
+# Shared state: STORAGE_BACKEND "sqlite" keeps users in the local users.db;
+# "redis" keeps users, applied ECPay trade numbers, webhook dedup keys, usage
+# totals, the media catalog (and, with LEADER_BACKEND=redis, the scheduler
+# lease) in REDIS_URL so several instances can serve the same users.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Scale-out: only the holder of the scheduler lease runs broadcast jobs.
+# LEADER_BACKEND is "sqlite" (lease row in LEADER_LEASE_PATH), "file"
+# (flock next to it) or "redis" (key in REDIS_URL). SCHEDULER_JOBSTORE_URL
+# is an SQLAlchemy URL; empty keeps jobs in memory.
+LEADER_BACKEND = os.getenv("LEADER_BACKEND", "sqlite")
+LEADER_LEASE_PATH = os.getenv("LEADER_LEASE_PATH", "leader.db")
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+SCHEDULER_JOBSTORE_URL = os.getenv("SCHEDULER_JOBSTORE_URL", "sqlite:///jobs.sqlite")
+
+# Personalised pushes: each user's meal reminder lands somewhere inside a
+# PUSH_WINDOW-second window after the slot time (in their own timezone); due
+# pushes are sent every PUSH_BUCKET seconds.
+PUSH_WINDOW = int(os.getenv("PUSH_WINDOW", "2700"))
+PUSH_BUCKET = int(os.getenv("PUSH_BUCKET", "60"))
+
+# Response cache for short small-talk messages ("早安", "在嗎"): entries per
+# persona (0 disables), upstream answers collected per entry before serving
+# hits, and entry lifetime in seconds.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "3"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(6 * 60 * 60)))
+
+# Push prefetch: PREFETCH_LEAD seconds before each push slot opens, answer
+# the usual replies ("早安", "吃飽了") and write persona openers, PREFETCH_SIZE
+# of each per persona, on PREFETCH_WORKERS threads. 0 disables.
+PREFETCH_LEAD = int(os.getenv("PREFETCH_LEAD", "300"))
+PREFETCH_SIZE = int(os.getenv("PREFETCH_SIZE", "3"))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+
+# Usage accounting: monthly message cap per user (0 = unlimited; whitelist
+# exempt), monthly OpenAI token budget across all users (replies degrade at
+# 80%; 0 disables the guard; the default is roughly the US$100 hard limit the
+# old billing check assumed) and how often the ledger is flushed.
+MONTH_LIMIT = int(os.getenv("MONTH_LIMIT", "100"))
+OPENAI_MONTHLY_TOKENS = int(os.getenv("OPENAI_MONTHLY_TOKENS", "2000000"))
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "5"))
+
+# ECPay notifications are queued in their own SQLite file and applied by a
+# background worker.
+PAYMENT_DB_PATH = os.getenv("PAYMENT_DB_PATH", "payments.db")
+
+# Admin API: /admin/stats needs "Authorization: Bearer $ADMIN_TOKEN" (empty
+# disables it). Counters are reconciled against the user store every
+# ADMIN_STATS_RECONCILE seconds; free users with at most ADMIN_NEAR_QUOTA
+# messages left count as near quota.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+ADMIN_STATS_RECONCILE = float(os.getenv("ADMIN_STATS_RECONCILE", "600"))
+ADMIN_NEAR_QUOTA = int(os.getenv("ADMIN_NEAR_QUOTA", "3"))
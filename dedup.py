@@ -0,0 +1,141 @@
+"""Idempotency store for redelivered webhooks.
+
+LINE redelivers a webhook when we are slow to answer or answer with an
+error.  :class:`DedupStore` keeps the keys we have already accepted in a
+small TTL'd in-memory map and mirrors them into a compact SQLite table so
+the protection survives restarts.  :class:`RedisDedupStore` keeps them in
+Redis instead, shared by every app instance.
+
+A key is claimed before the event is handled.  If handling fails, the caller
+releases it, so the redelivery of a failed event is processed instead of
+dropped.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+CREATE_DEDUP_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS dedup_keys(
+    key     TEXT PRIMARY KEY,
+    seen_at INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class DedupStore:
+    """Remember processed keys for ``ttl`` seconds.
+
+    Keys are namespaced (e.g. ``"line:<webhookEventId>"``) so several stores
+    can share one table, but each store needs its own connection: the
+    store's lock is the only thing serializing it.
+    """
+
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        namespace: str,
+        ttl: int = 24 * 60 * 60,
+        max_memory: int = 10_000,
+        purge_every: int = 500,
+    ) -> None:
+        self.conn = conn
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.purge_every = purge_every
+        self._recent: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts = 0
+        with self._lock:
+            self.conn.execute(CREATE_DEDUP_TABLE_SQL)
+            self.conn.commit()
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def claim(self, key: str) -> bool:
+        """Mark ``key`` as processed; return ``False`` if it was already seen."""
+        if not key:
+            return True
+        full = self._key(key)
+        now = time.time()
+        with self._lock:
+            expires = self._recent.get(full)
+            if expires is not None and expires > now:
+                return False
+            cur = self.conn.execute(
+                "INSERT OR IGNORE INTO dedup_keys(key, seen_at) VALUES(?, ?)",
+                (full, int(now)),
+            )
+            if cur.rowcount == 0:
+                row = self.conn.execute(
+                    "SELECT seen_at FROM dedup_keys WHERE key = ?", (full,)
+                ).fetchone()
+                if row and row[0] + self.ttl > now:
+                    self.conn.commit()
+                    self._remember(full, row[0] + self.ttl)
+                    return False
+                # 過期的舊紀錄 → 視為新事件重新登記
+                self.conn.execute(
+                    "UPDATE dedup_keys SET seen_at = ? WHERE key = ?",
+                    (int(now), full),
+                )
+            self.conn.commit()
+            self._remember(full, now + self.ttl)
+            self._inserts += 1
+            if self._inserts % self.purge_every == 0:
+                self._purge(now)
+        return True
+
+    def release(self, key: str) -> None:
+        """Forget ``key`` so a retry of a failed operation is processed again."""
+        if not key:
+            return
+        full = self._key(key)
+        with self._lock:
+            self._recent.pop(full, None)
+            self.conn.execute("DELETE FROM dedup_keys WHERE key = ?", (full,))
+            self.conn.commit()
+
+    def _remember(self, full: str, expires: float) -> None:
+        self._recent[full] = expires
+        self._recent.move_to_end(full)
+        while len(self._recent) > self.max_memory:
+            self._recent.popitem(last=False)
+
+    def _purge(self, now: float) -> None:
+        self.conn.execute(
+            "DELETE FROM dedup_keys WHERE key >= ? AND key < ? AND seen_at < ?",
+            (f"{self.namespace}:", f"{self.namespace};", int(now - self.ttl)),
+        )
+        self.conn.commit()
+        for k in [k for k, exp in self._recent.items() if exp <= now]:
+            del self._recent[k]
+
+
+class RedisDedupStore:
+    """Same interface as :class:`DedupStore`; one ``SET NX EX`` per claim."""
+
+    def __init__(self, client, namespace: str, ttl: int = 24 * 60 * 60) -> None:
+        self.r = client
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _key(self, key: str) -> str:
+        return f"laigf:dedup:{self.namespace}:{key}"
+
+    def claim(self, key: str) -> bool:
+        if not key:
+            return True
+        return bool(self.r.set(self._key(key), int(time.time()), nx=True, ex=self.ttl))
+
+    def release(self, key: str) -> None:
+        if key:
+            self.r.delete(self._key(key))
+
+
+__all__ = ["CREATE_DEDUP_TABLE_SQL", "DedupStore", "RedisDedupStore"]
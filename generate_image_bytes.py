@@ -1,31 +1,62 @@
 import os
+import time
 
 import replicate
 import requests
 
 import config
+import resilience
+import usage_ledger
 
 if config.REPLICATE_API_TOKEN:
     os.environ.setdefault("REPLICATE_API_TOKEN", config.REPLICATE_API_TOKEN)
 
+_client = replicate.Client(
+    api_token=config.REPLICATE_API_TOKEN, base_url=config.REPLICATE_BASE_URL
+)
 
-def generate_image_bytes(prompt: str) -> bytes:
+SDXL_VERSION = "7762fd07cf82c948538e41f63f77d685e02b063e37e496e96eefd46c929f9bdc"
+
+
+def _run_sdxl(prompt: str, size: int, timeout: float) -> bytes:
+    """Create a prediction and poll it until done, cancelling it on timeout."""
+    end = time.monotonic() + timeout
+    prediction = _client.predictions.create(
+        version=SDXL_VERSION,
+        input={
+            "prompt": prompt,
+            "width": size,
+            "height": size,
+            "apply_watermark": False,
+            "num_inference_steps": 25,
+        },
+    )
+    while prediction.status not in ("succeeded", "failed", "canceled"):
+        if time.monotonic() >= end:
+            prediction.cancel()
+            raise resilience.DeadlineExceeded(f"SDXL 超過 {timeout:.0f} 秒未完成")
+        time.sleep(0.5)
+        prediction.reload()
+    if prediction.status != "succeeded":
+        raise RuntimeError(prediction.error or prediction.status)
+
+    # output 是 list of URLs，取第一張圖片來下載
+    image_url = prediction.output[0]
+    response = requests.get(image_url, timeout=max(end - time.monotonic(), 1))
+    response.raise_for_status()
+    return response.content
+
+
+def generate_image_bytes(prompt: str, size: int = 768) -> bytes:
     try:
-        output = replicate.run(
-            "stability-ai/sdxl:7762fd07cf82c948538e41f63f77d685e02b063e37e496e96eefd46c929f9bdc",
-            input={
-                "prompt": prompt,
-                "width": 768,
-                "height": 768,
-                "apply_watermark": False,
-                "num_inference_steps": 25,
-            },
+        # 建立任務不是冪等的，重試可能重複計費 → retries=0
+        image = resilience.call(
+            "replicate",
+            lambda timeout: _run_sdxl(prompt, size, timeout),
+            timeout=config.IMAGE_TIMEOUT,
+            retries=0,
         )
-        # output 是 list of URLs，取第一張圖片來下載
-        image_url = output[0]
-        response = requests.get(image_url)
-        response.raise_for_status()
-        return response.content
-
+        usage_ledger.add("replicate", images=1)
+        return image
     except Exception as e:
         raise RuntimeError(f"Replicate API 建立任務失敗：{e}")
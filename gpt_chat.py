@@ -1,18 +1,23 @@
-import json
-import urllib.request
+from __future__ import annotations
+
+import logging
 
 import requests
 
 import config
+import resilience
+import usage_ledger
 from personas import DEFAULT_PERSONA, PERSONAS
 
 WHITELIST_USER_IDS = config.WHITELIST_USER_IDS
-print(f"💡 白名單 ID：{WHITELIST_USER_IDS}")
+logging.info("💡 白名單 ID：%s", WHITELIST_USER_IDS)
 
 
-def ask_openai(prompt: str, persona: str = DEFAULT_PERSONA) -> str:
+def ask_openai(
+    prompt: str, persona: str = DEFAULT_PERSONA, model: str | None = None
+) -> str:
     try:
-        print(f"[DEBUG] 向 OpenAI 發送訊息：{prompt}")
+        logging.debug("向 OpenAI 發送訊息：%s", prompt)
 
         headers = {
             "Authorization": f"Bearer {config.OPENAI_API_KEY}",
@@ -22,7 +27,7 @@ def ask_openai(prompt: str, persona: str = DEFAULT_PERSONA) -> str:
 
         persona_conf = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])
         payload = {
-            "model": "gpt-4",
+            "model": model or config.OPENAI_MODEL,
             "messages": [
                 {"role": "system", "content": persona_conf["system"]},
                 {"role": "user", "content": prompt},
@@ -30,45 +35,36 @@ def ask_openai(prompt: str, persona: str = DEFAULT_PERSONA) -> str:
             "temperature": 0.7,
         }
 
-        res = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=payload,
+        def _post(timeout: float):
+            res = requests.post(
+                f"{config.OPENAI_BASE_URL}/chat/completions",
+                headers=headers,
+                json=payload,
+                timeout=timeout,
+            )
+            res.raise_for_status()
+            return res.json()
+
+        data = resilience.call(
+            "openai",
+            _post,
             timeout=20,
+            hedge_after=config.OPENAI_HEDGE_AFTER or None,
         )
-        res.raise_for_status()
-        print("[DEBUG] 回覆成功")
-        return res.json()["choices"][0]["message"]["content"].strip()
+        logging.debug("回覆成功")
+        usage_ledger.add("openai", tokens=data.get("usage", {}).get("total_tokens", 0))
+        return data["choices"][0]["message"]["content"].strip()
 
     except Exception as e:
-        print(f"[ERROR] ChatGPT 失敗：{e}")
-        display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
-        return f"{display_name}今天有點累，晚點再陪你好不好～🥺"
+        logging.error("ChatGPT 失敗：%s", e)
+        return fallback_reply(persona)
 
 
-def is_user_whitelisted(user_id: str) -> bool:
-    return user_id in WHITELIST_USER_IDS
+def fallback_reply(persona: str = DEFAULT_PERSONA) -> str:
+    """Canned reply returned by :func:`ask_openai` when the upstream fails."""
+    display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
+    return f"{display_name}今天有點累，晚點再陪你好不好～🥺"
 
 
-def is_over_token_quota():
-    try:
-        headers = {
-            "Authorization": f"Bearer {config.OPENAI_API_KEY}",
-            "OpenAI-Project": config.OPENAI_PROJECT_ID,
-        }
-        req = urllib.request.Request(
-            "https://api.openai.com/v1/dashboard/billing/usage", headers=headers
-        )
-        with urllib.request.urlopen(req) as resp:
-            usage = json.load(resp).get("total_usage", 0) / 100.0
-
-        req = urllib.request.Request(
-            "https://api.openai.com/v1/dashboard/billing/subscription",
-            headers=headers,
-        )
-        with urllib.request.urlopen(req) as resp:
-            limit = json.load(resp).get("hard_limit_usd", 100)
-
-        return usage > (limit * 0.8)
-    except Exception:
-        return False
+def is_user_whitelisted(user_id: str) -> bool:
+    return user_id in WHITELIST_USER_IDS
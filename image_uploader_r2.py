@@ -1,80 +1,146 @@
-import uuid
+import functools
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.client import Config
 
 import config
+import resilience
+import tracing
+from image_variants import make_variants
+from media_catalog import media_key
 
+# 避免 R2 變慢時佔住 worker：短連線逾時、交給 resilience 重試
+R2_CLIENT_CONFIG = Config(
+    signature_version="s3v4",
+    connect_timeout=3,
+    read_timeout=10,
+    retries={"max_attempts": 1},
+)
 
-def upload_image_to_r2(image_bytes):
+# 圖片鍵由內容雜湊決定，內容永遠不變 → 讓 CDN 與 LINE 用戶端長期快取
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+# 原圖與預覽圖同時上傳
+_upload_pool = ThreadPoolExecutor(4, thread_name_prefix="r2")
+
+
+@functools.lru_cache(maxsize=1)
+def _client():
+    """One boto3 client (and connection pool) shared by every upload."""
     access_key = config.R2_ACCESS_TOKEN
     secret_key = config.R2_SECRET_ACCESS_KEY
     endpoint = config.R2_ENDPOINT
-    bucket = config.R2_BUCKET_NAME
-    public_base = config.R2_PUBLIC_URL
-    if not all([access_key, secret_key, endpoint, bucket, public_base]):
+    if not all(
+        [access_key, secret_key, endpoint, config.R2_BUCKET_NAME, config.R2_PUBLIC_URL]
+    ):
         raise EnvironmentError("❌ R2 環境變數未正確設定")
-
-    s3 = boto3.client(
+    return boto3.client(
         "s3",
         region_name="auto",
         endpoint_url=endpoint,
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
-        config=Config(signature_version="s3v4"),
+        config=R2_CLIENT_CONFIG,
     )
 
-    image_name = f"{uuid.uuid4().hex}.jpg"
-    key = image_name
 
+def upload_bytes_to_r2(data, key, content_type, cache_control=None):
+    """Put ``data`` under ``key`` and return its public URL."""
+    s3 = _client()
+    extra = {"CacheControl": cache_control} if cache_control else {}
     try:
-        print(f"[DEBUG] 上傳至 R2: {key}")
-        s3.put_object(
-            Bucket=bucket, Key=key, Body=image_bytes, ContentType="image/jpeg"
+        logging.debug("上傳至 R2: %s", key)
+        resilience.call(
+            "r2",
+            lambda _timeout: s3.put_object(
+                Bucket=config.R2_BUCKET_NAME,
+                Key=key,
+                Body=data,
+                ContentType=content_type,
+                **extra,
+            ),
+            timeout=15,
         )
     except Exception as e:
-        print(f"[ERROR] R2 上傳失敗: {e}")
+        logging.error("R2 上傳失敗: %s", e)
         raise RuntimeError(f"Cloudflare R2 上傳失敗: {e}")
+    return _public_url(key)
 
-    final_url = f"{public_base.rstrip('/')}/{bucket}/{image_name}"
-    print(f"[DEBUG] 圖片網址為: {final_url}")
-    return final_url
 
+def _public_url(key):
+    return f"{config.R2_PUBLIC_URL.rstrip('/')}/{config.R2_BUCKET_NAME}/{key}"
 
-def upload_audio_to_r2(audio_bytes, ext="mp3"):
-    """Upload audio data to R2 and return the public URL."""
-    access_key = config.R2_ACCESS_TOKEN
-    secret_key = config.R2_SECRET_ACCESS_KEY
-    endpoint = config.R2_ENDPOINT
-    bucket = config.R2_BUCKET_NAME
-    public_base = config.R2_PUBLIC_URL
-    if not all([access_key, secret_key, endpoint, bucket, public_base]):
-        raise EnvironmentError("❌ R2 環境變數未正確設定")
 
-    s3 = boto3.client(
-        "s3",
-        region_name="auto",
-        endpoint_url=endpoint,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        config=Config(signature_version="s3v4"),
+def delete_from_r2(keys):
+    """Delete up to 1000 objects in one request; returns the keys that failed."""
+    s3 = _client()
+    objects = [{"Key": key} for key in keys]
+    result = resilience.call(
+        "r2",
+        lambda _timeout: s3.delete_objects(
+            Bucket=config.R2_BUCKET_NAME, Delete={"Objects": objects, "Quiet": True}
+        ),
+        timeout=30,
     )
+    return [err["Key"] for err in result.get("Errors", [])]
 
-    audio_name = f"{uuid.uuid4().hex}.{ext}"
-    key = audio_name
 
-    try:
-        print(f"[DEBUG] 上傳至 R2: {key}")
-        s3.put_object(
-            Bucket=bucket,
-            Key=key,
-            Body=audio_bytes,
-            ContentType=f"audio/{ext}",
+def upload_media(data, kind, ext, content_type, owner=None, catalog=None, digest=None):
+    """Upload under a date/kind-prefixed, content-addressed key and catalog it.
+
+    Content already in ``catalog`` is not uploaded again; its URL is reused.
+    """
+    digest = digest or hashlib.sha256(data).hexdigest()[:32]
+    existing = catalog.find(kind, digest) if catalog else None
+    if existing:
+        return _public_url(existing)
+    key = media_key(kind, digest, ext)
+    url = upload_bytes_to_r2(data, key, content_type, IMMUTABLE_CACHE)
+    if catalog:
+        try:
+            catalog.record(key, owner, kind, len(data), digest)
+        except Exception:
+            # 物件已上傳成功；沒登記只代表不會被自動清掉
+            logging.exception("media catalog: 無法登記 %s", key)
+    return url
+
+
+def upload_image_to_r2(image_bytes, owner=None, catalog=None):
+    url = upload_media(image_bytes, "image", "jpg", "image/jpeg", owner, catalog)
+    logging.debug("圖片網址為: %s", url)
+    return url
+
+
+def upload_image_variants(image_bytes, owner=None, catalog=None):
+    """Upload a compressed original and a preview; returns both URLs."""
+    with tracing.span("image.variants"):
+        variants = make_variants(image_bytes)
+    uploads = [
+        _upload_pool.submit(
+            tracing.wrap(upload_media),
+            data,
+            kind,
+            "jpg",
+            "image/jpeg",
+            owner,
+            catalog,
+            variants.digest,
         )
-    except Exception as e:
-        print(f"[ERROR] R2 上傳失敗: {e}")
-        raise RuntimeError(f"Cloudflare R2 上傳失敗: {e}")
+        for data, kind in (
+            (variants.original, "image"),
+            (variants.preview, "preview"),
+        )
+    ]
+    original_url, preview_url = (f.result() for f in uploads)
+    logging.debug("圖片網址為: %s（預覽 %s）", original_url, preview_url)
+    return original_url, preview_url
+
 
-    final_url = f"{public_base.rstrip('/')}/{bucket}/{audio_name}"
-    print(f"[DEBUG] 語音網址為: {final_url}")
-    return final_url
+def upload_audio_to_r2(audio_bytes, ext="mp3", owner=None, catalog=None):
+    """Upload audio data to R2 and return the public URL."""
+    url = upload_media(audio_bytes, "audio", ext, f"audio/{ext}", owner, catalog)
+    logging.debug("語音網址為: %s", url)
+    return url
@@ -0,0 +1,53 @@
+"""Post-process generated images into the sizes LINE actually shows.
+
+An image message has two URLs: ``original_content_url`` is opened when the
+user taps the bubble, ``preview_image_url`` is what the chat renders.
+Sending the full SDXL output for both makes every client download the
+large file just to draw a thumbnail.
+
+:func:`make_variants` decodes the image once and encodes two JPEGs from
+it: a re-compressed original and a :data:`PREVIEW_SIZE` preview.  LINE
+only accepts JPEG or PNG for image messages (preview at most 1 MB), so
+WebP is not an option here.  Both are named after the SHA-256 of the
+source bytes, so the same image always maps to the same keys and a retried
+upload overwrites instead of leaving orphans.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+from typing import NamedTuple
+
+from PIL import Image
+
+PREVIEW_SIZE = 240
+ORIGINAL_QUALITY = 85
+PREVIEW_QUALITY = 75
+
+
+class Variants(NamedTuple):
+    digest: str  # 原始檔 SHA-256（前 32 碼），當作物件鍵
+    original: bytes
+    preview: bytes
+
+
+def _jpeg(image: Image.Image, quality: int) -> bytes:
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
+
+def make_variants(image_bytes: bytes, preview_size: int = PREVIEW_SIZE) -> Variants:
+    """Encode a compressed original and a ``preview_size`` preview in one decode."""
+    with Image.open(io.BytesIO(image_bytes)) as src:
+        # 只解碼一次；縮圖從記憶體裡的像素複製，不再讀檔
+        image = src.convert("RGB")
+    original = _jpeg(image, ORIGINAL_QUALITY)
+    image.thumbnail((preview_size, preview_size), Image.LANCZOS)
+    preview = _jpeg(image, PREVIEW_QUALITY)
+    digest = hashlib.sha256(image_bytes).hexdigest()[:32]
+    return Variants(digest, original, preview)
+
+
+__all__ = ["PREVIEW_SIZE", "Variants", "make_variants"]
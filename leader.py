@@ -0,0 +1,227 @@
+"""Lease-based leader election so only one app instance runs scheduled jobs.
+
+Every instance runs a :class:`LeaderElector`.  It keeps trying to acquire a
+named lease from a :class:`LeaseBackend`; whoever holds it renews it every
+``ttl / 3`` seconds, and if the holder dies the lease expires and another
+instance takes over.
+
+Backends:
+
+* :class:`SQLiteLeaseBackend` – a ``leases`` table in an SQLite file shared by
+  every worker on the machine (uvicorn ``--workers N``).
+* :class:`FileLockBackend` – an ``flock`` on a file; released automatically by
+  the kernel when the holder exits.
+* :class:`RedisLeaseBackend` – a key with a TTL in Redis, for instances on
+  different machines.
+
+Anything with ``acquire(name, holder, ttl)`` / ``release(name, holder)`` can
+be plugged in.
+"""
+
+from __future__ import annotations
+
+import functools
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Protocol
+
+CREATE_LEASES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS leases(
+    name       TEXT PRIMARY KEY,
+    holder     TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class LeaseBackend(Protocol):
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        """Take or renew the lease; return True if ``holder`` now owns it."""
+
+    def release(self, name: str, holder: str) -> None:
+        """Give the lease up if ``holder`` owns it."""
+
+
+class SQLiteLeaseBackend:
+    def __init__(self, path: str) -> None:
+        self.conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute(CREATE_LEASES_TABLE_SQL)
+        self._lock = threading.Lock()
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # 單一 UPSERT：沒人持有、已過期或本來就是自己 → 取得/續約
+            cur = self.conn.execute(
+                """
+                INSERT INTO leases(name, holder, expires_at) VALUES(?, ?, ?)
+                ON CONFLICT(name) DO UPDATE
+                SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+                """,
+                (name, holder, now + ttl, now),
+            )
+            return cur.rowcount == 1
+
+    def release(self, name: str, holder: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                "DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder)
+            )
+
+
+class FileLockBackend:
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._fds: dict[str, int] = {}
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        import fcntl
+
+        if name in self._fds:
+            return True
+        path = os.path.join(self.directory, f"{name}.lock")
+        fd = os.open(path, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fds[name] = fd
+        return True
+
+    def release(self, name: str, holder: str) -> None:
+        fd = self._fds.pop(name, None)
+        if fd is not None:
+            os.close(fd)
+
+
+class RedisLeaseBackend:
+    # 只有持有者本人可以續約/釋放
+    _RENEW = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    _RELEASE = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, client, prefix: str = "laigf:lease:") -> None:
+        self.r = client
+        self.prefix = prefix
+        self._renew = client.register_script(self._RENEW)
+        self._release = client.register_script(self._RELEASE)
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        key, ms = self.prefix + name, int(ttl * 1000)
+        if self.r.set(key, holder, nx=True, px=ms):
+            return True
+        return bool(self._renew(keys=[key], args=[holder, ms]))
+
+    def release(self, name: str, holder: str) -> None:
+        self._release(keys=[self.prefix + name], args=[holder])
+
+
+class LeaderElector:
+    """Background thread that keeps (or keeps trying to get) the lease."""
+
+    def __init__(
+        self,
+        backend: LeaseBackend,
+        name: str = "scheduler",
+        ttl: float = 30.0,
+        on_elected: Callable[[], None] | None = None,
+        on_revoked: Callable[[], None] | None = None,
+    ) -> None:
+        self.backend = backend
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.on_elected = on_elected
+        self.on_revoked = on_revoked
+        self.is_leader = False
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._tick()
+        self._thread = threading.Thread(target=self._run, name="leader", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        if self.is_leader:
+            self._set_leader(False)
+            self.backend.release(self.name, self.holder)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.ttl / 3):
+            self._tick()
+
+    def _tick(self) -> None:
+        try:
+            leader = self.backend.acquire(self.name, self.holder, self.ttl)
+        except Exception:
+            logging.exception("lease %s: acquire failed", self.name)
+            leader = False
+        if leader != self.is_leader:
+            self._set_leader(leader)
+
+    def _set_leader(self, leader: bool) -> None:
+        self.is_leader = leader
+        role = "leader" if leader else "follower"
+        logging.info("lease %s: %s is %s", self.name, self.holder, role)
+        callback = self.on_elected if leader else self.on_revoked
+        if callback:
+            try:
+                callback()
+            except Exception:
+                logging.exception("lease %s: callback failed", self.name)
+
+    def leader_only(self, func):
+        """Decorator skipping the call on followers (guards against pause races)."""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.is_leader:
+                logging.info("skip %s: not leader", func.__name__)
+                return None
+            return func(*args, **kwargs)
+
+        return wrapper
+
+
+def make_backend(kind: str, path: str, redis_url: str | None = None) -> LeaseBackend:
+    if kind == "redis":
+        import redis
+
+        return RedisLeaseBackend(redis.Redis.from_url(redis_url))
+    if kind == "file":
+        return FileLockBackend(os.path.dirname(os.path.abspath(path)))
+    if kind == "sqlite":
+        return SQLiteLeaseBackend(path)
+    raise ValueError(f"unknown lease backend: {kind!r}")
+
+
+__all__ = [
+    "FileLockBackend",
+    "LeaderElector",
+    "LeaseBackend",
+    "RedisLeaseBackend",
+    "SQLiteLeaseBackend",
+    "make_backend",
+]
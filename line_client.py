@@ -0,0 +1,151 @@
+"""Single entry point for LINE Messaging API calls.
+
+The webhook handler runs on the event loop, so it must not wait on LINE.
+:class:`LineClient` owns one ``ApiClient`` and a small thread pool.  Its
+urllib3 pool has one keep-alive connection per worker.  :meth:`reply`,
+:meth:`push` and :meth:`multicast` queue the call and return a
+:class:`~concurrent.futures.Future` right away.  The current trace (see
+:func:`tracing.wrap`) stays open until the call finishes.
+
+Replies are built with :func:`reply_composer.compose`.  The first
+:data:`~reply_composer.MAX_MESSAGES` go out as the reply.  Overflow is
+pushed to the user, and so is the whole reply when LINE rejects the token
+as expired or already used.  Pushes count against the monthly message
+quota; replies do not.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+from concurrent.futures import Future
+from typing import Iterable
+
+from linebot.v3.messaging import (
+    ApiClient,
+    Configuration,
+    MessagingApi,
+    MessagingApiBlob,
+    MulticastRequest,
+    PushMessageRequest,
+    ReplyMessageRequest,
+    TextMessage,
+)
+from linebot.v3.messaging.exceptions import ApiException
+
+import metrics
+import tracing
+from pools import CountingPool
+from reply_composer import MAX_MESSAGES, compose, pack
+
+MULTICAST_LIMIT = 500
+
+
+def text_message(text: str) -> TextMessage:
+    return TextMessage(text=text)
+
+
+class LineClient:
+    def __init__(
+        self, access_token: str, host: str = "https://api.line.me", workers: int = 8
+    ) -> None:
+        cfg = Configuration(access_token=access_token, host=host)
+        cfg.connection_pool_maxsize = workers  # 每個 worker 一條連線重複使用
+        self.api_client = ApiClient(configuration=cfg)
+        self.api = MessagingApi(self.api_client)
+        self.blob = MessagingApiBlob(self.api_client)
+        self.pool = CountingPool(workers, thread_name_prefix="line")
+
+    def reply(
+        self, reply_token: str, parts: Iterable, to: str | None = None
+    ) -> Future:
+        """Reply with ``parts`` (strings and message objects); push overflow to ``to``."""
+        messages = compose(parts, text_message)
+        future = self._submit(self._reply, reply_token, messages, to)
+        # 沒有人會等 reply 的結果，失敗要在這裡留下紀錄
+        future.add_done_callback(_log_failure)
+        return future
+
+    def push(self, to: str, parts: Iterable) -> Future:
+        return self._submit(self._push, to, compose(parts, text_message))
+
+    def multicast(self, to: list[str], parts: Iterable) -> Future:
+        return self._submit(self._multicast, list(to), compose(parts, text_message))
+
+    def content(self, message_id: str) -> Future:
+        """Download user-sent media; the future resolves to the bytes."""
+        return self._submit(self._content, message_id)
+
+    def pending(self) -> int:
+        """Calls waiting for a worker."""
+        return self.pool.pending()
+
+    def close(self) -> None:
+        """Finish queued calls (shutdown)."""
+        self.pool.shutdown(wait=True)
+
+    def _submit(self, func, *args) -> Future:
+        return self.pool.submit(tracing.wrap(func), *args)
+
+    def _reply(self, reply_token: str, messages: list, to: str | None) -> None:
+        if not messages:
+            return
+        batches = pack(messages)
+        try:
+            with tracing.span("line.reply", count=len(batches[0])):
+                self.api.reply_message(
+                    ReplyMessageRequest(reply_token=reply_token, messages=batches[0])
+                )
+            metrics.LINE_MESSAGES.labels("reply").inc(len(batches[0]))
+            batches = batches[1:]
+        except ApiException as exc:
+            # 只有 reply token 過期或已用過才改用 push；訊息本身有錯就照樣失敗
+            if not is_invalid_reply_token(exc) or to is None:
+                raise
+            logging.warning("reply token rejected; pushing %d messages", len(messages))
+        for i, batch in enumerate(batches):
+            if to is None:
+                dropped = sum(len(b) for b in batches[i:])
+                metrics.LINE_MESSAGES.labels("dropped").inc(dropped)
+                logging.warning("no push target; dropped %d messages", dropped)
+                return
+            self._push(to, batch)
+
+    def _content(self, message_id: str) -> bytes:
+        with tracing.span("line.content"):
+            return bytes(self.blob.get_message_content(message_id))
+
+    def _push(self, to: str, messages: list) -> None:
+        for batch in pack(messages):
+            with tracing.span("line.push", count=len(batch)):
+                self.api.push_message(PushMessageRequest(to=to, messages=batch))
+            metrics.LINE_MESSAGES.labels("push").inc(len(batch))
+
+    def _multicast(self, to: list[str], messages: list) -> None:
+        for i in range(0, len(to), MULTICAST_LIMIT):
+            chunk = to[i : i + MULTICAST_LIMIT]
+            for batch in pack(messages, MAX_MESSAGES):
+                with tracing.span("line.multicast", count=len(chunk)):
+                    self.api.multicast(MulticastRequest(to=chunk, messages=batch))
+                metrics.LINE_MESSAGES.labels("multicast").inc(len(batch) * len(chunk))
+
+
+def is_invalid_reply_token(exc: ApiException) -> bool:
+    """True for LINE's ``400 Invalid reply token`` (expired or already used)."""
+    if exc.status != 400 or not exc.body:
+        return False
+    body = exc.body.decode() if isinstance(exc.body, bytes) else str(exc.body)
+    try:
+        message = json.loads(body).get("message", "")
+    except (ValueError, AttributeError):
+        message = body
+    return "invalid reply token" in message.lower()
+
+
+def _log_failure(future: Future) -> None:
+    exc = future.exception()
+    if exc is not None:
+        logging.error("LINE reply failed", exc_info=exc)
+
+
+__all__ = ["LineClient", "MULTICAST_LIMIT", "is_invalid_reply_token", "text_message"]
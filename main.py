@@ -1,42 +1,64 @@
 import asyncio
 import datetime
+import functools
+import html
 import logging
 import random
 import sqlite3
-import tempfile
 import textwrap
+import time
 import uuid
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import openai
 import pytz
 import uvicorn
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.date import DateTrigger
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse
+from apscheduler.jobstores.base import JobLookupError
+from fastapi import FastAPI, Header, Request, Form
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 import os
 from dotenv import load_dotenv
-from payment_gateway import generate_check_mac_value
+from payment_gateway import EcpaySigner
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    AudioMessage,
-    ImageMessage,
-    MessagingApi,
-    ReplyMessageRequest,
-    TextMessage,
-)
-from linebot.v3.messaging.api_client import ApiClient
-from linebot.v3.messaging.configuration import Configuration
+from linebot.v3.messaging import AudioMessage, ImageMessage
 from linebot.v3.webhook import WebhookHandler
 from linebot.v3.webhooks import AudioMessageContent, MessageEvent, TextMessageContent
 
+import admin_stats
 import config
+import metrics
+import resilience
+import tracing
+import usage_ledger
+from commands import classify_command
+from dedup import DedupStore, RedisDedupStore
 from generate_image_bytes import generate_image_bytes
-from gpt_chat import ask_openai, is_over_token_quota, is_user_whitelisted
-from image_uploader_r2 import upload_audio_to_r2, upload_image_to_r2
-from personas import DEFAULT_PERSONA, PERSONAS
+from leader import LeaderElector, make_backend
+from media_catalog import MediaCatalog, RedisMediaCatalog, sweep
+from line_client import LineClient
+from gpt_chat import ask_openai, fallback_reply, is_user_whitelisted
+from image_uploader_r2 import (
+    delete_from_r2,
+    upload_audio_to_r2,
+    upload_image_variants,
+)
+from payment_pipeline import PaymentPipeline
+from prefetch import PrefetchStage
+from personas import DEFAULT_PERSONA, DEFAULT_WRAPPER, PERSONAS, WRAPPERS
+from push_scheduler import PushScheduler, Slot, get_timezone
+from rate_limit import LoadGovernor, RateLimiter, parse_limits
+from response_cache import SMALL_TALK, ResponseCache
+from storage import is_expired, make_store
+from transcriber import AudioTooLong, Transcriber
 from tts import synthesize_speech
+from usage_ledger import (
+    ALL_USERS,
+    RedisUsageBackend,
+    SQLiteUsageBackend,
+    UsageLedger,
+)
 
 # ---------------------------
 # 基本設定
@@ -47,11 +69,13 @@ load_dotenv()
 MERCHANT_ID = os.getenv("ECPAY_MERCHANT_ID")
 HASH_KEY = os.getenv("ECPAY_HASH_KEY")
 HASH_IV = os.getenv("ECPAY_HASH_IV")
+ecpay_signer = EcpaySigner(HASH_KEY, HASH_IV)
 handler = WebhookHandler(config.LINE_CHANNEL_SECRET)
 
-line_cfg = Configuration(access_token=config.LINE_ACCESS_TOKEN)
-api_client = ApiClient(configuration=line_cfg)
-line_bot_api = MessagingApi(api_client=api_client)
+# 所有 LINE API 呼叫共用一個 client（連線重複使用，送出不阻塞 webhook）
+line = LineClient(
+    config.LINE_ACCESS_TOKEN, config.LINE_API_ENDPOINT, workers=config.LINE_WORKERS
+)
 
 # Time‑zone & Logger
 tz = pytz.timezone("Asia/Taipei")
@@ -69,12 +93,24 @@ PLANS = {
 
 # OpenAI
 openai.api_key = config.OPENAI_API_KEY
+openai.base_url = config.OPENAI_BASE_URL
 PROMPT = "晴子醬與用戶的對話，請輸出繁體中文，口語可愛語氣。"
 
 # ---------------------------
 # 資料庫
 # ---------------------------
-conn = sqlite3.connect("users.db", check_same_thread=False)
+def open_db() -> sqlite3.Connection:
+    """New users.db connection.
+
+    Every component gets its own connection and guards it with its own lock;
+    sharing one connection between two locks lets one thread commit another
+    thread's half-done transaction.
+    """
+    return sqlite3.connect("users.db", timeout=10, check_same_thread=False)
+
+
+conn = open_db()  # 只用於建表與遷移
+conn.execute("PRAGMA journal_mode=WAL")
 cur = conn.cursor()
 CREATE_USERS_TABLE_SQL = textwrap.dedent(
     """
@@ -85,7 +121,9 @@ CREATE_USERS_TABLE_SQL = textwrap.dedent(
         free_count    INT DEFAULT 10,
         paid_until    TEXT,
         persona       TEXT DEFAULT 'rina',
-        group_personas TEXT
+        group_personas TEXT,
+        timezone      TEXT,
+        push_opt_out  INT DEFAULT 0
     );
     """
 )
@@ -101,123 +139,270 @@ if "persona" not in cols:
 if "group_personas" not in cols:
     cur.execute("ALTER TABLE users ADD COLUMN group_personas TEXT")
     conn.commit()
+if "timezone" not in cols:
+    cur.execute("ALTER TABLE users ADD COLUMN timezone TEXT")
+    cur.execute("ALTER TABLE users ADD COLUMN push_opt_out INT DEFAULT 0")
+    conn.commit()
 
 FREE_QUOTA = 10  # 免費可用次數
-MONTH_LIMIT = 100  # 月訊息量上限（之後擴充）
+MONTH_LIMIT = config.MONTH_LIMIT  # 月訊息量上限（0 = 不限）
+
+# 使用者資料：本機 SQLite（預設）或多台 instance 共用的 Redis
+store = make_store(
+    config.STORAGE_BACKEND, open_db(), config.REDIS_URL, FREE_QUOTA, DEFAULT_PERSONA
+)
+
+# 重送去重：LINE webhookEventId（ECPay 訂單由 store.extend_membership 把關）
+if config.STORAGE_BACKEND == "redis":
+    webhook_dedup = RedisDedupStore(store.r, "line", ttl=24 * 60 * 60)
+else:
+    webhook_dedup = DedupStore(open_db(), "line", ttl=24 * 60 * 60)
+
+# /admin/stats 的計數器：事件即時增減，定期用獨立連線對帳
+user_stats = admin_stats.UserStats(
+    (lambda: admin_stats.redis_snapshot(store, config.ADMIN_NEAR_QUOTA))
+    if config.STORAGE_BACKEND == "redis"
+    else functools.partial(
+        admin_stats.sqlite_snapshot, open_db(), config.ADMIN_NEAR_QUOTA
+    ),
+    near_quota=config.ADMIN_NEAR_QUOTA,
+    interval=config.ADMIN_STATS_RECONCILE,
+)
+
+# R2 上的圖片/語音登記（到期由 leader 定期清理）
+# Redis 模式下所有 instance 共用一份：leader 的清理才看得到其他台上傳的檔案
+if config.STORAGE_BACKEND == "redis":
+    media_catalog = RedisMediaCatalog(store.r)
+else:
+    media_catalog = MediaCatalog(open_db())
+
+# 流量控制：每位使用者/指令的 token bucket + 全域負載調節
+rate_limiter = RateLimiter(parse_limits(config.RATE_LIMITS))
+load_governor = LoadGovernor(
+    degrade_inflight=config.LOAD_DEGRADE_INFLIGHT,
+    text_only_inflight=config.LOAD_TEXT_ONLY_INFLIGHT,
+    max_inflight=config.LOAD_MAX_INFLIGHT,
+    degrade_latency=config.LOAD_DEGRADE_LATENCY,
+    text_only_latency=config.LOAD_TEXT_ONLY_LATENCY,
+)
+resilience.configure(config.HEDGE_WORKERS)
+resilience.add_observer(lambda name, secs, ok: load_governor.observe(name, secs))
+resilience.add_observer(metrics.observe_upstream)
+resilience.add_observer(usage_ledger.observe_upstream)
+resilience.add_observer(
+    lambda name, secs, ok: tracing.record(f"upstream.{name}", secs, ok)
+)
+# 用量帳本：每則訊息的 token / 圖片 / TTS 字數，批次寫入並維護月統計
+# （Redis 模式下多台 instance 共用月統計，月上限與 token 預算才是全域的）
+ledger = UsageLedger(
+    RedisUsageBackend(store.r)
+    if config.STORAGE_BACKEND == "redis"
+    else SQLiteUsageBackend(open_db()),
+    tz=tz,
+    flush_every=config.USAGE_FLUSH_SECONDS,
+)
+
+# 推播後使用者常見的回應：prefetch 會預先產生回覆，所以也要能進回覆快取
+PUSH_REPLIES = {
+    "morning": ("早安", "早", "起床了", "剛起床", "吃了", "還沒吃"),
+    "noon": ("午安", "吃飽了", "吃了", "還沒吃"),
+    "night": ("晚安", "好累", "好睏", "睡不著"),
+}
+
+# 寒暄類短訊息的回覆快取（RESPONSE_CACHE_SIZE=0 關閉）
+response_cache = (
+    ResponseCache(
+        max_entries=config.RESPONSE_CACHE_SIZE,
+        variants=config.RESPONSE_CACHE_VARIANTS,
+        ttl=config.RESPONSE_CACHE_TTL,
+        phrases=tuple(dict.fromkeys(SMALL_TALK + sum(PUSH_REPLIES.values(), ()))),
+    )
+    if config.RESPONSE_CACHE_SIZE
+    else None
+)
+tracing.configure(
+    config.TRACE_SAMPLE_RATE,
+    config.TRACE_EXPORT_PATH,
+    config.TRACE_SLOW_MS,
+    config.TRACE_SLOW_LOG,
+)
 
 # ---------------------------
 # 公用函式
 # ---------------------------
 
 
+@metrics.timed(metrics.DB_SECONDS, "get_user")
+@tracing.traced("db.get_user")
 def get_user(uid: str):
     """抓取／初始化使用者資料"""
-    cur.execute(
-        "SELECT msg_count, is_paid, free_count, paid_until, persona, group_personas FROM users WHERE user_id=?",
-        (uid,),
-    )
-    row = cur.fetchone()
-    if not row:
-        cur.execute(
-            "INSERT INTO users(user_id, free_count, persona, group_personas) VALUES(?, ?, ?, NULL)",
-            (uid, FREE_QUOTA, DEFAULT_PERSONA),
-        )
-        conn.commit()
-        return 0, 0, FREE_QUOTA, None, DEFAULT_PERSONA, None
-    return row
+    return store.get_user(uid)
 
 
+@metrics.timed(metrics.DB_SECONDS, "update_msg_stat")
+@tracing.traced("db.update_msg_stat")
 def update_msg_stat(uid: str, decr_free: bool = False):
     """統一更新訊息統計與免費額度"""
-    if decr_free:
-        cur.execute(
-            "UPDATE users SET msg_count = msg_count + 1, free_count = free_count - 1 WHERE user_id = ?",
-            (uid,),
-        )
-    else:
-        cur.execute(
-            "UPDATE users SET msg_count = msg_count + 1 WHERE user_id = ?", (uid,)
-        )
-    conn.commit()
+    store.incr(uid, msg_count=1, free_count=-1 if decr_free else 0)
 
 
+@metrics.timed(metrics.DB_SECONDS, "dec_free")
+@tracing.traced("db.dec_free")
 def dec_free(uid: str):
-    cur.execute(
-        "UPDATE users SET free_count = free_count - 1 WHERE user_id = ?", (uid,)
-    )
-    conn.commit()
+    store.incr(uid, free_count=-1)
 
 
-def transcribe_audio(p: Path) -> str:
-    with p.open("rb") as f:
+def transcribe_audio(data: bytes, filename: str) -> str:
+    """Whisper transcript of one preprocessed chunk (see :mod:`transcriber`)."""
+
+    def _create(timeout: float) -> str:
         return openai.audio.transcriptions.create(
             model="whisper-1",
-            file=f,
+            file=(filename, data),
             response_format="text",
             language="zh",
             prompt=PROMPT,
             temperature=0,
-        ).strip()
-
-
-def _romanticize(text: str) -> str:
-    """Return text rewritten in a romantic tone."""
-    openings = [
-        "親愛的，",
-        "嗨～寶貝，",
-        "嘿，親親，",
-    ]
-    bridges = [
-        "其實呢，",
-        "說真的，",
-        "我想告訴你，",
-    ]
-    endings = [
-        "嘿嘿～",
-        "嘻嘻～",
-        "愛你唷！",
-    ]
-    return f"{random.choice(openings)}{random.choice(bridges)}{text}，{random.choice(endings)}"
-
-
-async def quick_reply(reply_token: str, text: str) -> None:
-    """Send a simple text reply via LINE."""
-    try:
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text=text)],
-            )
+            timeout=timeout,
         )
-    except Exception as exc:
-        logging.exception("quick_reply: %s", exc)
+
+    return resilience.call("whisper", _create, timeout=30).strip()
+
+
+# 語音：前處理與分段轉錄在自己的執行緒池，不佔 webhook 執行緒
+transcriber = Transcriber(
+    transcribe_audio,
+    workers=config.ASR_WORKERS,
+    max_queue=config.ASR_MAX_QUEUE,
+    max_seconds=config.ASR_MAX_SECONDS,
+    chunk_seconds=config.ASR_CHUNK_SECONDS,
+)
+
+
+def is_over_token_quota() -> bool:
+    """Local guard: this month's tokens (all users) past 80% of the budget."""
+    budget = config.OPENAI_MONTHLY_TOKENS
+    return bool(budget) and ledger.monthly(ALL_USERS).tokens >= budget * 0.8
+
+
+def over_month_limit(uid: str) -> bool:
+    if not MONTH_LIMIT or is_user_whitelisted(uid):
+        return False
+    return ledger.monthly(uid).messages >= MONTH_LIMIT
+
+
+def user_tier(uid: str, paid) -> str:
+    if is_user_whitelisted(uid):
+        return "whitelist"
+    return "paid" if paid else "free"
+
+
+def rate_limited(e, uid: str, command: str, tier: str, display_name: str) -> bool:
+    """Reply with a cool-down message and return True when over the limit."""
+    if rate_limiter.allow(uid, command, tier):
+        return False
+    wait = rate_limiter.retry_after(uid, command, tier)
+    respond(e, f"{display_name}有點忙不過來，{wait} 秒後再找我好嗎🥺")
+    return True
+
+
+def chat_answer(text: str, persona: str, model, cacheable: bool) -> str:
+    """Upstream answer for ``text``, served from the response cache when possible."""
+    key = response_cache.key(text) if response_cache and cacheable else None
+    if key is None:
+        metrics.RESPONSE_CACHE.labels("bypass").inc()
+        return ask_openai(text, persona, model)
+    answer = response_cache.get(persona, key)
+    if answer is not None:
+        metrics.RESPONSE_CACHE.labels("hit").inc()
+        tracing.annotate(cache="hit")
+        return answer
+    metrics.RESPONSE_CACHE.labels("miss").inc()
+    answer = ask_openai(text, persona, model)
+    if answer != fallback_reply(persona):
+        response_cache.put(persona, key, answer)
+    return answer
+
+
+def respond(e, *parts) -> None:
+    """Reply to event ``e`` with ``parts`` (texts, images, audio) without blocking.
+
+    Long texts are split, more than five messages or an expired reply token
+    fall back to push; see :mod:`line_client`.
+    """
+    line.reply(e.reply_token, parts, to=e.source.user_id)
+
+
+def is_duplicate_event(e) -> bool:
+    """Return True when this webhook event was already handled (LINE redelivery)."""
+    event_id = getattr(e, "webhook_event_id", None)
+    tracing.annotate(event_id=event_id, user=e.source.user_id)
+    if webhook_dedup.claim(event_id):
+        return False
+    logging.info("skip redelivered event %s", event_id)
+    return True
+
+
+def release_event(e) -> None:
+    """Forget a claimed event whose handling failed, so LINE's redelivery runs."""
+    webhook_dedup.release(getattr(e, "webhook_event_id", None))
 
 
 # LINE 事件
 # ---------------------------
 @handler.add(MessageEvent, message=TextMessageContent)
 def on_text(e):
-    process(e, e.message.text.strip())
+    if is_duplicate_event(e):
+        return
+    try:
+        with load_governor.slot(), ledger.metered(e.source.user_id):
+            process(e, e.message.text.strip())
+    except BaseException:
+        # webhook 會回 500、LINE 會重送：不能讓重送被當成重複事件丟掉
+        release_event(e)
+        raise
 
 
 @handler.add(MessageEvent, message=AudioMessageContent)
 def on_audio(e):
-    uid = e.source.user_id
-    tmp = Path(tempfile.gettempdir()) / f"{uuid.uuid4()}.m4a"
-    stream = line_bot_api.get_message_content(e.message.id)
-    with tmp.open("wb") as f:
-        for chunk in stream.iter_content():
-            f.write(chunk)
+    if is_duplicate_event(e):
+        return
+    # 下載在 LINE client 的執行緒進行，完成後交給轉文字的執行緒池
+    # （之後的失敗不會讓 webhook 回 500，LINE 也不會重送）
     try:
-        txt = transcribe_audio(tmp)
+        download = line.content(e.message.id)
+    except BaseException:
+        release_event(e)
+        raise
+    download.add_done_callback(tracing.wrap(lambda f: queue_audio(e, f)))
+
+
+def queue_audio(e, download) -> None:
+    if transcriber.submit(on_audio_downloaded, e, download) is None:
+        respond(e, f"{audio_display_name(e)}還在聽前面的語音，等一下再傳給我好嗎🥺")
+
+
+def on_audio_downloaded(e, download) -> None:
+    with load_governor.slot(), ledger.metered(e.source.user_id):
+        handle_audio(e, download)
+
+
+def audio_display_name(e) -> str:
+    persona = get_user(e.source.user_id)[4]
+    return PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
+
+
+def handle_audio(e, download):
+    try:
+        txt = transcriber.transcribe(download.result())
+    except AudioTooLong as er:
+        respond(e, f"{audio_display_name(e)}一次聽不了這麼長🥺（最多 {er.limit:.0f} 秒）")
+        return
     except Exception as er:
         logging.exception("ASR: %s", er)
-        display_name = PERSONAS.get(get_user(uid)[4], PERSONAS[DEFAULT_PERSONA])[
-            "display"
-        ]
-        asyncio.create_task(
-            quick_reply(e.reply_token, f"{display_name}聽不懂這段語音🥺")
-        )
+        txt = ""
+    if not txt:
+        respond(e, f"{audio_display_name(e)}聽不懂這段語音🥺")
         return
     process(e, txt)
 
@@ -228,21 +413,35 @@ def on_audio(e):
 
 
 def process(e, text: str):
+    """Handle one message and record its latency by command and persona."""
+    start = time.perf_counter()
+    command = classify_command(text)
+    token = metrics.request_labels.set((command, "-"))
+    try:
+        with tracing.span("process", command=command):
+            handle_message(e, text)
+    finally:
+        metrics.MESSAGE_SECONDS.labels(*metrics.request_labels.get()).observe(
+            time.perf_counter() - start
+        )
+        metrics.request_labels.reset(token)
+
+
+def handle_message(e, text: str):
     uid = e.source.user_id
 
     # 讀取目前狀態
-    msg_cnt, paid, free_cnt, until, persona, group_personas = get_user(uid)
+    row = get_user(uid)
+    msg_cnt, paid, free_cnt, until, persona, group_personas = row
+    metrics.request_labels.set((metrics.request_labels.get()[0], persona))
+    tracing.annotate(persona=persona)
 
     # 會員是否過期 → 自動取消
-    if (
-        paid
-        and until
-        and datetime.datetime.strptime(until, "%Y-%m-%d").date()
-        < datetime.datetime.now(tz).date()
-    ):
+    if paid and is_expired(until, datetime.datetime.now(tz).date()):
         paid = 0
-        cur.execute("UPDATE users SET is_paid = 0 WHERE user_id = ?", (uid,))
-        conn.commit()
+        store.update(uid, is_paid=0)
+        user_stats.update(row, row._replace(is_paid=0))
+        row = row._replace(is_paid=0)
 
     # ---------------------
     # /help
@@ -259,10 +458,11 @@ def process(e, text: str):
             "/幫我續費      → 快速續費連結\n"
             "/角色 [名稱] → 切換聊天角色\n"
             "/群組 [A B] → 啟用多角色群聊 (輸入 '/群組 取消' 關閉)\n"
+            "/推播 開啟|關閉 → 每日三餐提醒\n"
+            "/時區 [名稱]  → 設定時區，如 Asia/Tokyo\n"
             "/help          → 本幫助\n"
-            "(系統每日三餐自動提醒)\n"
         )
-        asyncio.create_task(quick_reply(e.reply_token, help_msg))
+        respond(e, help_msg)
         return
 
     # ---------------------
@@ -271,39 +471,27 @@ def process(e, text: str):
     if text in ("/購買", "/幫我續費"):
         link = f"https://p.ecpay.com.tw/97C358E?customField={uid}"
         display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
-        asyncio.create_task(
-            quick_reply(
-                e.reply_token, f"點我付款開通 / 續費{display_name} 💖\n🔗 {link}"
-            )
-        )
+        respond(e, f"點我付款開通 / 續費{display_name} 💖\n🔗 {link}")
         return
 
     # ---------------------
     # /狀態查詢
     # ---------------------
     if text == "/狀態查詢":
+        used = ledger.monthly(uid).messages
+        month_usage = f"本月訊息：{used}" + (f" / {MONTH_LIMIT}" if MONTH_LIMIT else "")
         if paid:
             days_left = (
                 (
-                    datetime.datetime.strptime(until, "%Y-%m-%d").date()
+                    datetime.date.fromisoformat(until)
                     - datetime.datetime.now(tz).date()
                 ).days
                 if until
                 else 0
             )
-            asyncio.create_task(
-                quick_reply(
-                    e.reply_token,
-                    f"💎 會員剩 {days_left} 天\n到期日：{until}\n月累計訊息：{msg_cnt}",
-                )
-            )
+            respond(e, f"💎 會員剩 {days_left} 天\n到期日：{until}\n{month_usage}")
         else:
-            asyncio.create_task(
-                quick_reply(
-                    e.reply_token,
-                    f"免費體驗剩 {free_cnt} 次\n月累計訊息：{msg_cnt}\n輸入 /購買 解鎖更多功能 ✨",
-                )
-            )
+            respond(e, f"免費體驗剩 {free_cnt} 次\n{month_usage}\n輸入 /購買 解鎖更多功能 ✨")
         return
 
     # ---------------------
@@ -313,12 +501,7 @@ def process(e, text: str):
         name = text.replace("/角色", "", 1).strip()
         if not name:
             choices = "、".join([p["display"] for p in PERSONAS.values()])
-            asyncio.create_task(
-                quick_reply(
-                    e.reply_token,
-                    f"目前角色：{PERSONAS[persona]['display']}\n可選擇：{choices}",
-                )
-            )
+            respond(e, f"目前角色：{PERSONAS[persona]['display']}\n可選擇：{choices}")
             return
         key = None
         for k, v in PERSONAS.items():
@@ -326,14 +509,12 @@ def process(e, text: str):
                 key = k
                 break
         if not key:
-            asyncio.create_task(quick_reply(e.reply_token, "找不到這個角色名稱喔～"))
+            respond(e, "找不到這個角色名稱喔～")
             return
-        cur.execute("UPDATE users SET persona = ? WHERE user_id = ?", (key, uid))
-        conn.commit()
+        store.update(uid, persona=key)
+        user_stats.update(row, row._replace(persona=key))
         persona = key
-        asyncio.create_task(
-            quick_reply(e.reply_token, f"已切換為 {PERSONAS[key]['display']}")
-        )
+        respond(e, f"已切換為 {PERSONAS[key]['display']}")
         return
 
     # ---------------------
@@ -349,16 +530,13 @@ def process(e, text: str):
                 msg = f"目前群組角色：{display}\n輸入 '/群組 角色1 角色2' 重新設定，或 '/群組 取消' 停用"
             else:
                 msg = "尚未設定群組角色。輸入 '/群組 角色1 角色2' 啟用"
-            asyncio.create_task(quick_reply(e.reply_token, msg))
+            respond(e, msg)
             return
 
         if names in ("取消", "關閉"):
-            cur.execute(
-                "UPDATE users SET group_personas = NULL WHERE user_id = ?", (uid,)
-            )
-            conn.commit()
+            store.update(uid, group_personas=None)
             group_personas = None
-            asyncio.create_task(quick_reply(e.reply_token, "已停用群組聊天"))
+            respond(e, "已停用群組聊天")
             return
 
         keys = []
@@ -369,18 +547,49 @@ def process(e, text: str):
                     break
         keys = list(dict.fromkeys(keys))
         if len(keys) < 2:
-            asyncio.create_task(
-                quick_reply(e.reply_token, "請至少指定兩個有效角色名稱")
-            )
+            respond(e, "請至少指定兩個有效角色名稱")
             return
-        cur.execute(
-            "UPDATE users SET group_personas = ? WHERE user_id = ?",
-            (",".join(keys), uid),
-        )
-        conn.commit()
+        store.update(uid, group_personas=",".join(keys))
         group_personas = ",".join(keys)
         disp = "、".join(PERSONAS[k]["display"] for k in keys)
-        asyncio.create_task(quick_reply(e.reply_token, f"已設定群組角色：{disp}"))
+        respond(e, f"已設定群組角色：{disp}")
+        return
+
+    # ---------------------
+    # /推播 /時區
+    # ---------------------
+    if text.startswith("/推播"):
+        arg = text.replace("/推播", "", 1).strip()
+        if arg not in ("開啟", "關閉"):
+            respond(e, "請輸入 /推播 開啟 或 /推播 關閉")
+            return
+        store.update(uid, push_opt_out=int(arg == "關閉"))
+        if arg == "關閉":
+            push_scheduler.forget(uid)
+        else:
+            push_scheduler.schedule(uid, store.push_settings(uid)[0])
+        respond(e, f"每日提醒已{arg}")
+        return
+
+    if text.startswith("/時區"):
+        name = text.replace("/時區", "", 1).strip()
+        if not name:
+            respond(e, "請輸入 /時區 名稱，例如 /時區 Asia/Tokyo")
+            return
+        if get_timezone(name, None) is None:
+            respond(e, f"看不懂這個時區：{name}")
+            return
+        store.update(uid, timezone=name)
+        if not store.push_settings(uid)[1]:
+            push_scheduler.schedule(uid, name)  # 依新時區重排
+        respond(e, f"時區已設定為 {name}")
+        return
+
+    # 以下（畫圖、朗讀、聊天）都計入月用量：成功回覆時呼叫 count_message()
+    # （拒絕、限流、失敗的回覆不算）
+    if over_month_limit(uid):
+        display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
+        respond(e, f"本月已達 {MONTH_LIMIT} 則訊息上限，下個月再來找{display_name}喔🥺")
         return
 
     # ---------------------
@@ -389,40 +598,42 @@ def process(e, text: str):
     if text.startswith("/畫圖"):
         prompt = text.replace("/畫圖", "", 1).strip()
         if not prompt:
-            asyncio.create_task(quick_reply(e.reply_token, "請輸入 /畫圖 主題"))
+            respond(e, "請輸入 /畫圖 主題")
             return
 
         # 權限檢查
         can_use = paid or is_user_whitelisted(uid) or free_cnt > 0
         if not can_use:
             display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
-            asyncio.create_task(
-                quick_reply(
-                    e.reply_token, f"免費次數用完，輸入 /購買 開通{display_name}💖"
-                )
-            )
+            respond(e, f"免費次數用完，輸入 /購買 開通{display_name}💖")
             return
 
+        display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
+        # 先看負載再扣使用者的 token：因負載拒絕的請求不該用掉額度
+        level = load_governor.level()
+        if level >= LoadGovernor.TEXT_ONLY:
+            respond(e, f"現在找{display_name}畫畫的人太多了，晚點再試🥺")
+            return
+        if rate_limited(e, uid, "image", user_tier(uid, paid), display_name):
+            return
+        size = 512 if level == LoadGovernor.DEGRADED else 768
+
         try:
-            url = upload_image_to_r2(generate_image_bytes(prompt))
-            display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=e.reply_token,
-                    messages=[
-                        TextMessage(text=f"{display_name}畫好了～\n主題：{prompt}"),
-                        ImageMessage(original_content_url=url, preview_image_url=url),
-                    ],
-                )
-            )
-            if not (paid or is_user_whitelisted(uid)):
-                dec_free(uid)
+            image = generate_image_bytes(prompt, size)
+            url, preview_url = upload_image_variants(image, uid, media_catalog)
         except Exception as er:
             logging.exception("/畫圖: %s", er)
-            display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
-            asyncio.create_task(
-                quick_reply(e.reply_token, f"{display_name}畫畫失敗⋯稍後再試🥺")
-            )
+            respond(e, f"{display_name}畫畫失敗⋯稍後再試🥺")
+            return
+        respond(
+            e,
+            f"{display_name}畫好了～\n主題：{prompt}",
+            ImageMessage(original_content_url=url, preview_image_url=preview_url),
+        )
+        usage_ledger.count_message()
+        if not (paid or is_user_whitelisted(uid)):
+            dec_free(uid)
+            user_stats.update(row, row._replace(free_count=free_cnt - 1))
         return
 
     # ---------------------
@@ -431,20 +642,21 @@ def process(e, text: str):
     if text.startswith("/朗讀"):
         display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
         speech = text.replace("/朗讀", "", 1).strip() or f"你好，我是{display_name}！"
+        if load_governor.level() >= LoadGovernor.TEXT_ONLY:
+            # 高負載時降級為純文字（不呼叫上游，不扣 token）
+            respond(e, speech)
+            return
+        if rate_limited(e, uid, "tts", user_tier(uid, paid), display_name):
+            return
         try:
             audio_bytes, dur = synthesize_speech(speech)
-            url = upload_audio_to_r2(audio_bytes)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=e.reply_token,
-                    messages=[AudioMessage(original_content_url=url, duration=dur)],
-                )
-            )
+            url = upload_audio_to_r2(audio_bytes, owner=uid, catalog=media_catalog)
         except Exception as er:
             logging.exception("/朗讀: %s", er)
-            asyncio.create_task(
-                quick_reply(e.reply_token, f"{display_name}朗讀失敗⋯🥺")
-            )
+            respond(e, f"{display_name}朗讀失敗⋯🥺")
+            return
+        respond(e, AudioMessage(original_content_url=url, duration=dur))
+        usage_ledger.count_message()
         return
 
     # ---------------------
@@ -453,76 +665,129 @@ def process(e, text: str):
     can_chat = paid or is_user_whitelisted(uid) or free_cnt > 0
     if not can_chat:
         display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
-        asyncio.create_task(
-            quick_reply(
-                e.reply_token, f"免費體驗已用完，輸入 /購買 解鎖{display_name}💖"
-            )
-        )
+        respond(e, f"免費體驗已用完，輸入 /購買 解鎖{display_name}💖")
+        return
+
+    display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
+    level = load_governor.level()
+    if level == LoadGovernor.SHED:
+        respond(e, f"{display_name}這邊塞車了，等我一下下再說好嗎🥺")
+        return
+    if rate_limited(e, uid, "chat", user_tier(uid, paid), display_name):
         return
+    model = config.OPENAI_DEGRADED_MODEL if level >= LoadGovernor.DEGRADED else None
 
     # 取得回覆
-    wrappers = {k: v["wrapper"] for k, v in PERSONAS.items()}
     if group_personas:
         reply_parts = []
         for key in group_personas.split(","):
-            func = wrappers.get(key, PERSONAS[DEFAULT_PERSONA]["wrapper"])
-            if is_over_token_quota():
+            func = WRAPPERS.get(key, DEFAULT_WRAPPER)
+            with tracing.span("quota_check"):
+                over_quota = is_over_token_quota()
+            if over_quota:
                 disp = PERSONAS.get(key, PERSONAS[DEFAULT_PERSONA])["display"]
                 reply = f"{disp}今天嘴巴破皮...🥺"
             else:
-                reply = func(ask_openai(text, key))
+                answer = ask_openai(text, key, model)
+                with tracing.span("wrapper", persona=key):
+                    reply = func(answer)
             reply_parts.append(reply)
-        reply_txt = "\n\n".join(reply_parts)
+        # 每個角色各一則訊息
+        respond(e, *reply_parts)
     else:
-        wrap_func = wrappers.get(persona, PERSONAS[DEFAULT_PERSONA]["wrapper"])
-        if is_over_token_quota():
-            display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
+        wrap_func = WRAPPERS.get(persona, DEFAULT_WRAPPER)
+        with tracing.span("quota_check"):
+            over_quota = is_over_token_quota()
+        if over_quota:
             reply_txt = f"{display_name}今天嘴巴破皮...🥺"
         else:
-            reply_txt = wrap_func(ask_openai(text, persona))
-    line_bot_api.reply_message_with_http_info(
-        ReplyMessageRequest(
-            reply_token=e.reply_token, messages=[TextMessage(text=reply_txt)]
-        )
-    )
+            # 引用回覆代表在接續上下文 → 不走快取
+            quoted = getattr(e.message, "quoted_message_id", None)
+            answer = chat_answer(text, persona, model, cacheable=not quoted)
+            with tracing.span("wrapper", persona=persona):
+                reply_txt = wrap_func(answer)
+        respond(e, reply_txt)
 
     # 更新統計 & 免費額度
-    update_msg_stat(uid, decr_free=not (paid or is_user_whitelisted(uid)))
+    usage_ledger.count_message()
+    decr_free = not (paid or is_user_whitelisted(uid))
+    update_msg_stat(uid, decr_free=decr_free)
+    user_stats.message(persona)
+    if decr_free:
+        user_stats.update(row, row._replace(free_count=free_cnt - 1))
 
 
 # ---------------------------
 # FastAPI Endpoints
 # ---------------------------
+# LINE SDK 的 handler 是同步的：放到 thread pool 執行，事件迴圈不會被卡住，
+# 多則訊息才能同時處理（LoadGovernor 的 inflight 門檻也才有意義）
+webhook_pool = ThreadPoolExecutor(config.WEBHOOK_WORKERS, thread_name_prefix="webhook")
+
+
+def handle_webhook(body: str, signature: str) -> None:
+    with resilience.deadline(config.WEBHOOK_DEADLINE), tracing.start_trace(
+        "callback"
+    ):
+        handler.handle(body, signature)
+
+
 @app.post("/callback")
 async def callback(req: Request):
+    start = time.perf_counter()
     signature = req.headers.get("x-line-signature")
     body: bytes = await req.body()
 
     try:
-        handler.handle(body.decode(), signature)
+        await asyncio.get_running_loop().run_in_executor(
+            webhook_pool, handle_webhook, body.decode(), signature
+        )
     except InvalidSignatureError:
         return "Invalid signature"
+    finally:
+        WEBHOOK_TIMER.observe(time.perf_counter() - start)
 
     return "OK"
 
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {"status": "ok", "breakers": resilience.breaker_states()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/stats")
+def admin_stats_endpoint(authorization: str | None = Header(None)):
+    if not admin_stats.authorized(authorization, config.ADMIN_TOKEN):
+        return JSONResponse({"error": "unauthorized"}, status_code=401)
+    return user_stats.view()
 
 
 @app.get("/", response_class=HTMLResponse)
-def root():
-    return """
+def root(uid: str = ""):
+    options = "".join(
+        f'<option value="{amount}">{name}（{days} 日）NT${amount}</option>'
+        for amount, (name, days) in PLANS.items()
+    )
+    return f"""
     <h2>AI 女友付款測試</h2>
     <form method="post" action="/ecpay_checkout">
+        <input type="hidden" name="uid" value="{html.escape(uid)}"/>
+        <select name="plan">{options}</select>
         <button type="submit">我要付款</button>
     </form>
     """
 
 
 @app.post("/ecpay_checkout", response_class=HTMLResponse)
-def checkout():
+def checkout(plan: int = Form(39), uid: str = Form("")):
+    if plan not in PLANS:
+        return HTMLResponse("找不到這個方案", status_code=400)
+    name, days = PLANS[plan]
     order_id = str(uuid.uuid4()).replace("-", "")[:20]
     now = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
 
@@ -531,59 +796,85 @@ def checkout():
         "MerchantTradeNo": order_id,
         "MerchantTradeDate": now,
         "PaymentType": "aio",
-        "TotalAmount": "50",
+        "TotalAmount": str(plan),
         "TradeDesc": "AI 女友戀愛聊天服務",
-        "ItemName": "體驗曖昧包(1日)",
+        "ItemName": f"{name}({days}日)",
         "ReturnURL": "https://你的網址/payment_callback",
         "ClientBackURL": "https://你的網址/success",
         "ChoosePayment": "ALL",
+        "CustomField1": uid,
     }
 
-    params["CheckMacValue"] = generate_check_mac_value(params, HASH_KEY, HASH_IV)
+    params["CheckMacValue"] = ecpay_signer.sign(params)
 
     html_form = f"""
     <form id="ecpay_form" method="post" action="https://payment.ecpay.com.tw/Cashier/AioCheckOut/V5">
-        {''.join(f'<input type="hidden" name="{k}" value="{v}"/>' for k, v in params.items())}
+        {''.join(f'<input type="hidden" name="{k}" value="{html.escape(str(v))}"/>' for k, v in params.items())}
     </form>
     <script>document.getElementById("ecpay_form").submit();</script>
     """
     return HTMLResponse(content=html_form)
 
 
-@app.post("/payment_callback")
-async def payment_callback(request: Request):
-    form_data = await request.form()
-    logging.info("ECPay 回傳資料：%s", form_data)
-
-    uid = form_data.get("CustomField1")
+def apply_payment(form: dict) -> str | None:
+    """Extend the payer's membership; returns the confirmation text (worker thread)."""
+    trade_no = form.get("MerchantTradeNo")
+    uid = form.get("CustomField1")
+    if form.get("RtnCode") != "1":
+        logging.info("ECPay %s 未付款成功 RtnCode=%s", trade_no, form.get("RtnCode"))
+        return None
+    if form.get("SimulatePaid") == "1":
+        # 綠界後台的「模擬付款」沒有實際收款，不能開通會員
+        logging.warning("ECPay %s 為模擬付款，不開通", trade_no)
+        return None
     try:
-        amt = int(form_data.get("TradeAmt", 0))
+        plan = PLANS.get(int(form.get("TradeAmt", 0)))
     except ValueError:
-        amt = 0
-    plan = PLANS.get(amt)
-
-    if uid and plan:
-        days = plan[1]
-        cur.execute("SELECT paid_until FROM users WHERE user_id = ?", (uid,))
-        row = cur.fetchone()
-        today = datetime.datetime.now(tz).date()
-        if row and row[0]:
-            current = datetime.datetime.strptime(row[0], "%Y-%m-%d").date()
-            base = current if current >= today else today
-        else:
-            base = today
-        new_until = base + datetime.timedelta(days=days)
-        cur.execute(
-            "UPDATE users SET is_paid = 1, paid_until = ? WHERE user_id = ?",
-            (new_until.isoformat(), uid),
+        plan = None
+    if not uid or not plan:
+        logging.warning("ECPay %s 無法對應使用者或方案", trade_no)
+        return None
+    # 先讀使用者（失敗 → 尚未登記訂單，整筆重試）
+    before = store.get_user(uid)
+    # 訂單紀錄和會員延長在同一個交易內：同一筆訂單只延長一次，失敗時兩者都不生效
+    with tracing.span("payment.extend", days=plan[1]):
+        new_until = store.extend_membership(
+            uid, plan[1], datetime.datetime.now(tz).date(), trade_no=trade_no
         )
-        conn.commit()
+    if new_until is None:
+        logging.info("skip duplicate payment notification %s", trade_no)
+        return None
+    user_stats.update(before, before._replace(is_paid=1, paid_until=new_until))
+    persona = before.persona
+    display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
+    return (
+        f"💖 已開通「{plan[0]}」！\n會員到期日：{new_until}\n"
+        f"{display_name}會好好陪你的～"
+    )
+
 
-    return "1|OK"
+def push_text(uid: str, text: str) -> None:
+    line.push(uid, [text]).result()
+
+
+payment_pipeline = PaymentPipeline(config.PAYMENT_DB_PATH, apply_payment, push_text)
+
+
+@app.post("/payment_callback", response_class=PlainTextResponse)
+async def payment_callback(request: Request):
+    form = dict(await request.form())
+    trade_no = form.get("MerchantTradeNo")
+    if not ecpay_signer.verify(form):
+        logging.warning("ECPay 通知驗證失敗：%s", trade_no)
+        return PlainTextResponse("0|CheckMacValue Error", status_code=400)
+    logging.info("ECPay 回傳：%s RtnCode=%s", trade_no, form.get("RtnCode"))
+    # 只寫入佇列就回覆，開通由背景 worker 處理
+    await asyncio.to_thread(payment_pipeline.enqueue, form)
+    return PlainTextResponse("1|OK")
 
 
 # ---------------------------
-# 廣播與到期提醒
+# 推播與到期提醒
 # ---------------------------
 random_topics = [
     "你今天吃了什麼好吃的～？我想聽！🍱",
@@ -599,84 +890,310 @@ auto_msgs = {
     "night": ["晚安🌙 今天辛苦了！", "夜深了，放下手機讓眼睛休息 💤"],
 }
 
-sched = BackgroundScheduler(timezone=tz)
 
+def make_jobstore():
+    """Persistent job store so job schedules survive restarts."""
+    if not config.SCHEDULER_JOBSTORE_URL:
+        return MemoryJobStore()
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 
-def broadcast(msgs):
-    try:
-        line_bot_api.broadcast([TextMessage(text=random.choice(msgs))])
-    except Exception as e:
-        logging.exception("broadcast: %s", e)
+    return SQLAlchemyJobStore(url=config.SCHEDULER_JOBSTORE_URL)
 
 
-def broadcast_random():
-    broadcast(random_topics)
-    schedule_next_random()
+sched = BackgroundScheduler(
+    timezone=tz,
+    jobstores={"default": make_jobstore()},
+    job_defaults={"coalesce": True, "misfire_grace_time": 300},
+)
 
 
-def schedule_next_random():
-    now = datetime.datetime.now(tz)
-    run = now.replace(
-        hour=random.randint(9, 22),
-        minute=random.choice([0, 30]),
-        second=0,
-        microsecond=0,
-    )
-    if run <= now:
-        run += datetime.timedelta(days=1)
-    sched.add_job(broadcast_random, trigger=DateTrigger(run_date=run))
+# 已停用的 job：全域廣播與每小時排程（持久化 job store 裡可能還留著）
+LEGACY_JOBS = (
+    "meal_morning",
+    "meal_noon",
+    "meal_night",
+    "random_topic",
+    "push_plan",
+)
+
+
+def on_elected() -> None:
+    """Became leader: drop legacy broadcast jobs, then run jobs."""
+    for job_id in LEGACY_JOBS:
+        try:
+            sched.remove_job(job_id)
+        except JobLookupError:
+            pass
+    sched.resume()
+    # 補排還沒有佇列的使用者（包括在其他 instance 重新開啟推播的人；
+    # 停用推播、改時區則由 tick 送出前向 store 確認）
+    sched.modify_job("push_backfill", next_run_time=datetime.datetime.now(tz))
+    logging.info("Scheduler resumed (leader)")
+
+
+def on_revoked() -> None:
+    sched.pause()
+    logging.info("Scheduler paused (follower)")
+
+
+elector = LeaderElector(
+    make_backend(config.LEADER_BACKEND, config.LEADER_LEASE_PATH, config.REDIS_URL),
+    ttl=config.LEADER_LEASE_TTL,
+    on_elected=on_elected,
+    on_revoked=on_revoked,
+)
+
+# ---------------------------
+# 個人化推播：依使用者時區，在時段內按 user ID 打散送出
+# ---------------------------
+PUSH_SLOTS = (
+    Slot(
+        "morning",
+        7,
+        30,
+        config.PUSH_WINDOW,
+        auto_msgs["morning"],
+        replies=PUSH_REPLIES["morning"],
+    ),
+    Slot(
+        "noon",
+        11,
+        30,
+        config.PUSH_WINDOW,
+        auto_msgs["noon"],
+        replies=PUSH_REPLIES["noon"],
+    ),
+    Slot(
+        "night",
+        22,
+        0,
+        config.PUSH_WINDOW,
+        auto_msgs["night"],
+        replies=PUSH_REPLIES["night"],
+    ),
+    # 隨機話題：09:00–22:00 之間，每位使用者每天不同時間
+    Slot("random", 9, 0, 13 * 60 * 60, random_topics, daily_jitter=True),
+)
+
+
+# 推播時段前先把回覆與開場白產生好，尖峰時直接從快取/池子拿
+PREFETCH_UID = "__prefetch__"  # 用量記在這個虛擬使用者，仍計入全體 token 預算
+
+
+def prefetch_answer(prompt: str, persona: str) -> str | None:
+    if is_over_token_quota():
+        return None
+    with ledger.metered(PREFETCH_UID):
+        answer = ask_openai(prompt, persona)
+    return None if answer == fallback_reply(persona) else answer
+
+
+prefetch = PrefetchStage(
+    prefetch_answer,
+    PUSH_SLOTS,
+    PERSONAS,
+    response_cache,
+    tz,
+    lead=config.PREFETCH_LEAD,
+    size=config.PREFETCH_SIZE,
+    workers=config.PREFETCH_WORKERS,
+    openers=lambda: elector.is_leader,
+)
+
+
+def compose_push(slot: Slot, uids: list[str]) -> list[tuple[str, list[str]]]:
+    """One text per persona: a prefetched opener (wrapped now) or the fixed text."""
+    users = store.get_users(uids)
+    fallback = (random.choice(slot.messages), [])
+    groups = []
+    by_persona: dict[str, list[str]] = {}
+    for uid in uids:
+        row = users.get(uid)
+        by_persona.setdefault(row.persona if row else DEFAULT_PERSONA, []).append(uid)
+    for persona, members in by_persona.items():
+        opener = prefetch.opener(slot.name, persona)
+        if opener is None:
+            fallback[1].extend(members)
+            continue
+        wrap = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["wrapper"]
+        groups.append((wrap(opener), members))
+    if fallback[1]:
+        groups.append(fallback)
+    return groups
+
+
+def push_multicast(uids: list[str], text: str) -> None:
+    with tracing.span("push.send", count=len(uids)):
+        line.multicast(uids, [text]).result()
+
+
+push_scheduler = PushScheduler(
+    open_db(),
+    store.push_recipients,
+    push_multicast,
+    PUSH_SLOTS,
+    default_tz=tz,
+    bucket=config.PUSH_BUCKET,
+    compose=compose_push,
+    settings=store.push_settings_many,
+)
+
 
+@elector.leader_only
+@metrics.timed(metrics.JOB_SECONDS, "push_backfill")
+@tracing.traced("job.push_backfill", root=True)
+def backfill_pushes():
+    added = push_scheduler.backfill()
+    logging.info("push backfill: %d queued", added)
 
-# 固定三餐提醒
-sched.add_job(lambda: broadcast(auto_msgs["morning"]), "cron", hour=7, minute=30)
-sched.add_job(lambda: broadcast(auto_msgs["noon"]), "cron", hour=11, minute=30)
-sched.add_job(lambda: broadcast(auto_msgs["night"]), "cron", hour=22, minute=0)
 
-# 隨機主題
+@elector.leader_only
+@metrics.timed(metrics.JOB_SECONDS, "push_tick")
+@tracing.traced("job.push_tick", root=True)
+def send_due_pushes():
+    push_scheduler.tick()
+
+
+# 全表掃描只在當選時與每天清晨一次；平常由 tick 在送出後排下一次
+sched.add_job(
+    backfill_pushes,
+    "cron",
+    hour=4,
+    minute=0,
+    id="push_backfill",
+    replace_existing=True,
+)
+sched.add_job(
+    send_due_pushes,
+    "interval",
+    seconds=config.PUSH_BUCKET,
+    id="push_tick",
+    replace_existing=True,
+)
 
 # ---------------------------
 # 會員到期前提醒（每天 10:00）
 # ---------------------------
 
 
+@elector.leader_only
+@metrics.timed(metrics.JOB_SECONDS, "expiry_reminders")
+@tracing.traced("job.expiry_reminders", root=True)
 def send_expiry_reminders():
     tomorrow = (
         (datetime.datetime.now(tz) + datetime.timedelta(days=1)).date().isoformat()
     )
-    cur.execute(
-        "SELECT user_id, paid_until, persona FROM users WHERE is_paid = 1 AND paid_until = ?",
-        (tomorrow,),
-    )
-    for uid, date_str, persona in cur.fetchall():
+    sent = []
+    for uid, date_str, persona in store.users_expiring(tomorrow):
         display_name = PERSONAS.get(persona, PERSONAS[DEFAULT_PERSONA])["display"]
+        text = f"{display_name}提醒：會員將於 {date_str} 到期～\n輸入 /幫我續費 立即續約 💖"
+        sent.append((uid, line.push(uid, [text])))
+    # 先全部送進 LINE client 再等結果，推播可並行
+    for uid, future in sent:
         try:
-            line_bot_api.push_message(
-                uid,
-                [
-                    TextMessage(
-                        text=f"{display_name}提醒：會員將於 {date_str} 到期～\n輸入 /幫我續費 立即續約 💖"
-                    )
-                ],
-            )
+            future.result()
         except Exception as e:
-            logging.exception("reminder push: %s", e)
+            logging.exception("reminder push %s: %s", uid, e)
+
+
+sched.add_job(
+    send_expiry_reminders,
+    "cron",
+    hour=10,
+    minute=0,
+    id="expiry_reminders",
+    replace_existing=True,
+)
+
+# ---------------------------
+# R2 媒體清理
+# ---------------------------
+DAY = 24 * 60 * 60
+MEDIA_RETENTION = {
+    "image": config.MEDIA_IMAGE_DAYS * DAY,
+    "preview": config.MEDIA_IMAGE_DAYS * DAY,
+    "audio": config.MEDIA_AUDIO_DAYS * DAY,
+}
+
+
+@elector.leader_only
+@metrics.timed(metrics.JOB_SECONDS, "media_sweep")
+@tracing.traced("job.media_sweep", root=True)
+def sweep_media():
+    deleted = sweep(media_catalog, delete_from_r2, MEDIA_RETENTION)
+    if deleted:
+        logging.info("media sweep: %d objects deleted", deleted)
 
 
-sched.add_job(send_expiry_reminders, "cron", hour=10, minute=0)
+sched.add_job(
+    sweep_media,
+    "interval",
+    seconds=config.MEDIA_SWEEP_INTERVAL,
+    id="media_sweep",
+    replace_existing=True,
+)
+
+# ---------------------------
+# 監控指標
+# ---------------------------
+WEBHOOK_TIMER = metrics.WEBHOOK_SECONDS.labels()
+metrics.Gauge(
+    "inflight_requests", "Messages being processed", lambda: load_governor.inflight
+)
+metrics.Gauge("load_level", "Load level (0=normal, 3=shed)", load_governor.level)
+metrics.Gauge(
+    "hedge_queue_depth",
+    "Hedged requests waiting for a worker",
+    resilience.pending,
+)
+metrics.Gauge(
+    "asr_queue_depth", "Voice messages waiting to be transcribed", transcriber.pending
+)
+metrics.Gauge("line_queue_depth", "LINE API calls waiting for a worker", line.pending)
+metrics.Gauge("scheduler_jobs", "Jobs in the scheduler", lambda: len(sched.get_jobs()))
+metrics.Gauge("push_queue_depth", "Queued personalised pushes", push_scheduler.pending)
+metrics.Gauge(
+    "payment_queue_depth",
+    "Payment notifications waiting to be applied",
+    payment_pipeline.pending,
+)
+metrics.Gauge("scheduler_leader", "1 if this node runs jobs", lambda: elector.is_leader)
+metrics.Gauge(
+    "circuit_open",
+    "Circuit breaker state (0=closed, 1=half-open, 2=open)",
+    lambda: {
+        (name,): {"closed": 0, "half_open": 1, "open": 2}[state]
+        for name, state in resilience.breaker_states().items()
+    },
+    ("upstream",),
+)
 
 
 @app.on_event("startup")
 def start_scheduler() -> None:
-    """Start background scheduler when the app starts."""
-    schedule_next_random()
-    sched.start()
-    logging.info("Scheduler started")
+    """Start the scheduler paused; only the elected leader resumes it."""
+    ledger.start()
+    payment_pipeline.start()
+    if config.PREFETCH_LEAD:
+        prefetch.start()
+    user_stats.start()
+    sched.start(paused=True)
+    elector.start()
+    logging.info("Scheduler started (leader=%s)", elector.is_leader)
 
 
 @app.on_event("shutdown")
 def shutdown_scheduler() -> None:
     """Shutdown background scheduler when the app stops."""
+    elector.stop()
     sched.shutdown()
+    payment_pipeline.stop()
+    prefetch.stop()
+    user_stats.stop()
+    webhook_pool.shutdown(wait=True)
+    transcriber.close()
+    line.close()
+    ledger.stop()
     logging.info("Scheduler stopped")
 
 # ---------------------------
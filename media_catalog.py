@@ -0,0 +1,263 @@
+"""Catalog of media objects written to R2, and the sweeper that expires them.
+
+Every generated image, preview and ``/朗讀`` clip is uploaded to the bucket.
+Before this module there was no record of them and nothing ever deleted
+them.  Now each upload is recorded in the ``media`` table: key, owner, kind,
+size, content hash, and upload and last-access times.
+
+:class:`MediaCatalog` keeps the table in SQLite.  :class:`RedisMediaCatalog`
+keeps it in Redis (``STORAGE_BACKEND=redis``).  Several instances then see
+each other's uploads: content is deduplicated across machines, and the
+leader's sweep also expires what the followers uploaded.
+
+Keys are built by :func:`media_key` as ``<kind>/<YYYY>/<MM>/<DD>/<name>.<ext>``.
+A listing or a bucket lifecycle rule can then target one kind and one day
+without scanning millions of flat ``uuid4`` names.
+
+:func:`sweep` deletes objects whose last access is older than their kind's
+retention.  It sends multi-object delete requests of up to
+:data:`DELETE_BATCH` keys each (the S3 maximum).  A key is removed from the
+catalog only after the bucket confirms the delete, so failed keys are retried
+on the next sweep.
+"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterable
+
+DELETE_BATCH = 1000
+
+CREATE_MEDIA_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS media(
+    key         TEXT PRIMARY KEY,
+    owner       TEXT,
+    kind        TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    sha256      TEXT,
+    created_at  REAL NOT NULL,
+    last_access REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS media_kind_access ON media(kind, last_access);
+CREATE INDEX IF NOT EXISTS media_kind_hash ON media(kind, sha256);
+"""
+
+
+def media_key(kind: str, name: str, ext: str, when: float | None = None) -> str:
+    """``<kind>/<YYYY>/<MM>/<DD>/<name>.<ext>`` (UTC date of ``when``)."""
+    day = datetime.datetime.fromtimestamp(
+        time.time() if when is None else when, datetime.timezone.utc
+    )
+    return f"{kind}/{day:%Y/%m/%d}/{name}.{ext}"
+
+
+class MediaCatalog:
+    """SQLite-backed record of uploaded objects; safe to share between threads."""
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        self._lock = threading.Lock()
+        with self._lock:
+            self.conn.executescript(CREATE_MEDIA_TABLE_SQL)
+            self.conn.commit()
+
+    def record(
+        self,
+        key: str,
+        owner: str | None,
+        kind: str,
+        size: int,
+        sha256: str | None = None,
+        now: float | None = None,
+    ) -> None:
+        """Add an uploaded object (re-uploading a key refreshes its access time)."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO media VALUES(?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET last_access = excluded.last_access",
+                (key, owner, kind, size, sha256, now, now),
+            )
+            self.conn.commit()
+
+    def find(self, kind: str, sha256: str, now: float | None = None) -> str | None:
+        """Key of an object with this content hash, marking it accessed."""
+        now = time.time() if now is None else now
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT key FROM media WHERE kind = ? AND sha256 = ? LIMIT 1",
+                (kind, sha256),
+            ).fetchone()
+            if row:
+                self.conn.execute(
+                    "UPDATE media SET last_access = ? WHERE key = ?", (now, row[0])
+                )
+                self.conn.commit()
+        return row[0] if row else None
+
+    def expired(
+        self, kind: str, before: float, limit: int = DELETE_BATCH
+    ) -> list[str]:
+        """Keys of ``kind`` last accessed before ``before`` (oldest first)."""
+        with self._lock:
+            return [
+                key
+                for (key,) in self.conn.execute(
+                    "SELECT key FROM media WHERE kind = ? AND last_access < ? "
+                    "ORDER BY last_access LIMIT ?",
+                    (kind, before, limit),
+                )
+            ]
+
+    def forget(self, keys: Iterable[str]) -> None:
+        with self._lock:
+            self.conn.executemany(
+                "DELETE FROM media WHERE key = ?", [(k,) for k in keys]
+            )
+            self.conn.commit()
+
+
+class RedisMediaCatalog:
+    """Same interface as :class:`MediaCatalog`, in Redis.
+
+    * ``<prefix>media:<kind>``: sorted set of keys scored by last access,
+    * ``<prefix>media:obj:<key>``: hash of owner, kind, size, hash and
+      upload time,
+    * ``<prefix>media:sha:<kind>:<sha256>``: the key holding that content.
+    """
+
+    def __init__(self, client, prefix: str = "laigf:") -> None:
+        self.r = client
+        self.prefix = prefix
+
+    def _by_access(self, kind: str) -> str:
+        return f"{self.prefix}media:{kind}"
+
+    def _obj(self, key: str) -> str:
+        return f"{self.prefix}media:obj:{key}"
+
+    def _sha(self, kind: str, sha256: str) -> str:
+        return f"{self.prefix}media:sha:{kind}:{sha256}"
+
+    def record(
+        self,
+        key: str,
+        owner: str | None,
+        kind: str,
+        size: int,
+        sha256: str | None = None,
+        now: float | None = None,
+    ) -> None:
+        """Add an uploaded object (re-uploading a key refreshes its access time)."""
+        now = time.time() if now is None else now
+        fields = {"kind": kind, "size": size, "created_at": now}
+        if owner:
+            fields["owner"] = owner
+        if sha256:
+            fields["sha256"] = sha256
+        pipe = self.r.pipeline(transaction=True)
+        # 已登記過的鍵只更新存取時間（同 SQLite 版的 ON CONFLICT）
+        for name, value in fields.items():
+            pipe.hsetnx(self._obj(key), name, value)
+        pipe.zadd(self._by_access(kind), {key: now})
+        if sha256:
+            pipe.set(self._sha(kind, sha256), key, nx=True)
+        pipe.execute()
+
+    def find(self, kind: str, sha256: str, now: float | None = None) -> str | None:
+        """Key of an object with this content hash, marking it accessed."""
+        now = time.time() if now is None else now
+        key = self.r.get(self._sha(kind, sha256))
+        if key is None:
+            return None
+        # XX：只更新還在目錄裡的鍵（清理與查詢同時發生時不會把它加回來）
+        pipe = self.r.pipeline(transaction=False)
+        pipe.zadd(self._by_access(kind), {key: now}, xx=True)
+        pipe.zscore(self._by_access(kind), key)
+        return key.decode() if pipe.execute()[1] is not None else None
+
+    def expired(
+        self, kind: str, before: float, limit: int = DELETE_BATCH
+    ) -> list[str]:
+        """Keys of ``kind`` last accessed before ``before`` (oldest first)."""
+        keys = self.r.zrangebyscore(
+            self._by_access(kind), "-inf", f"({before}", start=0, num=limit
+        )
+        return [k.decode() for k in keys]
+
+    def forget(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(self._obj(key), "kind", "sha256")
+        meta = []
+        for key, (kind, sha256) in zip(keys, pipe.execute()):
+            # 沒有 obj 的鍵：種類取自鍵的前綴（media_key 的格式）
+            kind = kind.decode() if kind else key.split("/", 1)[0]
+            sha_key = self._sha(kind, sha256.decode()) if sha256 else None
+            meta.append((key, kind, sha_key))
+        # 內容索引只在還指向這個鍵時才刪
+        sha_keys = [sha_key for _, _, sha_key in meta if sha_key]
+        pipe = self.r.pipeline(transaction=False)
+        for sha_key in sha_keys:
+            pipe.get(sha_key)
+        indexed = dict(zip(sha_keys, pipe.execute()))
+        pipe = self.r.pipeline(transaction=True)
+        for key, kind, sha_key in meta:
+            pipe.delete(self._obj(key))
+            pipe.zrem(self._by_access(kind), key)
+            if sha_key and indexed.get(sha_key) == key.encode():
+                pipe.delete(sha_key)
+        pipe.execute()
+
+
+def sweep(
+    catalog: MediaCatalog | RedisMediaCatalog,
+    delete: Callable[[list[str]], list[str]],
+    retention: dict[str, float],
+    now: float | None = None,
+    batch: int = DELETE_BATCH,
+) -> int:
+    """Delete objects older than ``retention[kind]`` seconds; returns the count.
+
+    ``delete(keys)`` removes up to ``batch`` objects in one request and
+    returns the keys that failed.
+    """
+    now = time.time() if now is None else now
+    deleted = 0
+    for kind, seconds in retention.items():
+        if seconds <= 0:
+            continue  # 0 = 永久保留
+        while True:
+            keys = catalog.expired(kind, now - seconds, batch)
+            if not keys:
+                break
+            failed = set(delete(keys))
+            done = [k for k in keys if k not in failed]
+            catalog.forget(done)
+            deleted += len(done)
+            if failed:
+                # 留待下次清理重試，避免同一批失敗的鍵在這裡無限循環
+                logging.warning(
+                    "media sweep: %d %s objects not deleted", len(failed), kind
+                )
+                break
+            if len(keys) < batch:
+                break
+    return deleted
+
+
+__all__ = [
+    "CREATE_MEDIA_TABLE_SQL",
+    "DELETE_BATCH",
+    "MediaCatalog",
+    "RedisMediaCatalog",
+    "media_key",
+    "sweep",
+]
@@ -0,0 +1,244 @@
+"""Minimal Prometheus-style metrics.
+
+Counters and histograms are resolved to a per-label-set *child* once (with
+:meth:`Histogram.labels`) and the child only bumps preallocated list slots,
+so observing a value takes no lock and allocates nothing.  Under heavy
+thread contention an increment may occasionally be lost, which is an
+acceptable trade for metrics that stay on in production.
+
+:func:`render` produces the text exposition format served at ``/metrics``.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import functools
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+# 預設延遲分桶（秒）：涵蓋 SQLite 的毫秒級到 SDXL 的數十秒
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40)
+
+# (command, persona) of the message currently being handled
+request_labels: contextvars.ContextVar[tuple[str, str]] = contextvars.ContextVar(
+    "request_labels", default=("-", "-")
+)
+
+_registry: list["_Metric"] = []
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _fmt_labels(self, values: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, doc, labelnames)
+        self._children: dict[tuple, _CounterChild] = {}
+
+    def labels(self, *values: str) -> _CounterChild:
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, _CounterChild())
+        return child
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def samples(self) -> Iterable[str]:
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{self._fmt_labels(values)} {child.value}"
+
+
+class Gauge(_Metric):
+    """Gauge read from a callback at scrape time.
+
+    ``func`` returns either a number or a ``{label_values_tuple: number}`` map.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        func: Callable[[], float | dict[tuple, float]],
+        labelnames: Iterable[str] = (),
+    ) -> None:
+        super().__init__(name, doc, labelnames)
+        self.func = func
+
+    def samples(self) -> Iterable[str]:
+        try:
+            value = self.func()
+        except Exception:
+            return
+        if isinstance(value, dict):
+            for values, v in value.items():
+                yield f"{self.name}{self._fmt_labels(values)} {float(v)}"
+        else:
+            yield f"{self.name} {float(value)}"
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "stats")
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.stats = [0.0, 0]  # sum, count
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        stats = self.stats
+        stats[0] += value
+        stats[1] += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labelnames: Iterable[str] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, doc, labelnames)
+        self.bounds = tuple(sorted(buckets))
+        self._children: dict[tuple, _HistogramChild] = {}
+
+    def labels(self, *values: str) -> _HistogramChild:
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, _HistogramChild(self.bounds))
+        return child
+
+    def samples(self) -> Iterable[str]:
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, n in zip(self.bounds, child.counts):
+                cumulative += n
+                labels = self._fmt_labels(values, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            total = child.stats[1]
+            inf = self._fmt_labels(values, 'le="+Inf"')
+            yield f"{self.name}_bucket{inf} {total}"
+            yield f"{self.name}_sum{self._fmt_labels(values)} {child.stats[0]}"
+            yield f"{self.name}_count{self._fmt_labels(values)} {total}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def timed(hist: Histogram, *values: str):
+    """Decorator observing the wrapped function's duration in ``hist``."""
+    child = hist.labels(*values)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.doc}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+# ---------------------------
+# 共用指標
+# ---------------------------
+WEBHOOK_SECONDS = Histogram("webhook_seconds", "Time spent handling /callback")
+MESSAGE_SECONDS = Histogram(
+    "message_seconds", "Time spent processing one message", ("command", "persona")
+)
+UPSTREAM_SECONDS = Histogram(
+    "upstream_seconds",
+    "Upstream API call latency",
+    ("upstream", "outcome", "command", "persona"),
+)
+DB_SECONDS = Histogram(
+    "db_seconds",
+    "SQLite query time",
+    ("op",),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5),
+)
+JOB_SECONDS = Histogram("job_seconds", "Scheduler job duration", ("job",))
+RESPONSE_CACHE = Counter(
+    "response_cache_requests_total",
+    "Chat replies looked up in the response cache (hit/miss/bypass)",
+    ("result",),
+)
+LINE_MESSAGES = Counter(
+    "line_messages_total",
+    "Messages sent to LINE by delivery path (reply/push/multicast/dropped)",
+    ("via",),
+)
+
+
+def observe_upstream(name: str, seconds: float, ok: bool) -> None:
+    """Observer for :func:`resilience.add_observer`."""
+    command, persona = request_labels.get()
+    outcome = "ok" if ok else "error"
+    UPSTREAM_SECONDS.labels(name, outcome, command, persona).observe(seconds)
+
+
+__all__ = [
+    "Counter",
+    "DB_SECONDS",
+    "Gauge",
+    "Histogram",
+    "JOB_SECONDS",
+    "LINE_MESSAGES",
+    "MESSAGE_SECONDS",
+    "RESPONSE_CACHE",
+    "UPSTREAM_SECONDS",
+    "WEBHOOK_SECONDS",
+    "observe_upstream",
+    "render",
+    "request_labels",
+    "timed",
+]
@@ -12,14 +12,23 @@ libraries and follows the algorithm described in ECPay's documentation:
    uppercase.
 
 This helper can be used by other modules when signing requests to the ECPay
-gateway.
+gateway.  :class:`EcpaySigner` produces identical values faster when many
+orders are signed with the same credentials.  URL-encoding and lowercasing
+both work character by character, so the encoded ``HashKey``/``HashIV``
+parts are computed once (the prefix is even folded into a reusable MD5
+state) and only the order fields are encoded per call.
 """
 
 from __future__ import annotations
 
+import functools
 import hashlib
+import hmac
+from typing import Iterable
 from urllib.parse import quote_plus
 
+_SAFE = "-_.!*()"
+
 
 def generate_check_mac_value(
     params: dict[str, str], hash_key: str, hash_iv: str
@@ -40,10 +49,58 @@ def generate_check_mac_value(
     # Sort parameters alphabetically by key.
     query = "&".join(f"{k}={v}" for k, v in sorted(filtered.items()))
     raw = f"HashKey={hash_key}&{query}&HashIV={hash_iv}"
-    encoded = quote_plus(raw, safe="-_.!*()")
+    encoded = quote_plus(raw, safe=_SAFE)
     mac = hashlib.md5(encoded.lower().encode("utf-8")).hexdigest().upper()
     return mac
 
 
-__all__ = ["generate_check_mac_value"]
+@functools.lru_cache(maxsize=4096)
+def _encode(text: str) -> bytes:
+    """URL-encoded, lowercased ``text``; names and repeated values hit the cache."""
+    return quote_plus(text, safe=_SAFE).lower().encode("ascii")
+
+
+class EcpaySigner:
+    """CheckMacValue generator bound to one merchant's HashKey/HashIV."""
+
+    _EQ = _encode("=")
+    _AMP = _encode("&")
+
+    def __init__(self, hash_key: str, hash_iv: str) -> None:
+        self._prefix = hashlib.md5(_encode(f"HashKey={hash_key}&"))
+        self._suffix = _encode(f"&HashIV={hash_iv}")
+        self._orders: dict[tuple, list[str]] = {}
+
+    def _sorted_keys(self, params: dict[str, str]) -> list[str]:
+        # 同一種訂單的欄位組合固定 → 排序結果快取
+        fields = tuple(params)
+        keys = self._orders.get(fields)
+        if keys is None:
+            keys = sorted(k for k in fields if k != "CheckMacValue")
+            if len(self._orders) < 64:
+                self._orders[fields] = keys
+        return keys
+
+    def sign(self, params: dict[str, str]) -> str:
+        """Same result as :func:`generate_check_mac_value` for these credentials."""
+        eq = self._EQ
+        body = self._AMP.join(
+            _encode(k) + eq + _encode(str(params[k])) for k in self._sorted_keys(params)
+        )
+        digest = self._prefix.copy()
+        digest.update(body)
+        digest.update(self._suffix)
+        return digest.hexdigest().upper()
+
+    def sign_many(self, orders: Iterable[dict[str, str]]) -> list[str]:
+        """Sign a batch of orders (e.g. renewal links for every expiring user)."""
+        sign = self.sign
+        return [sign(order) for order in orders]
+
+    def verify(self, params: dict[str, str]) -> bool:
+        received = str(params.get("CheckMacValue", "")).upper()
+        return hmac.compare_digest(received.encode(), self.sign(params).encode())
+
+
+__all__ = ["EcpaySigner", "generate_check_mac_value"]
 
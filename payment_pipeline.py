@@ -0,0 +1,209 @@
+"""Durable queue for ECPay payment notifications.
+
+``/payment_callback`` only verifies the CheckMacValue, stores the raw
+notification with :meth:`PaymentPipeline.enqueue` and answers ``1|OK``.
+A worker thread then applies the notifications in arrival order.
+
+* Notifications are keyed by ``MerchantTradeNo``.  ECPay's repeated
+  notifications are absorbed by the primary key, except that a successful
+  one (``RtnCode=1``) replaces an earlier unsuccessful one for the same
+  trade and is applied again.
+* Each row moves ``pending`` → ``applied`` / ``ignored``, or ``failed``
+  after ``max_attempts``, and is retried with backoff in between.
+* ``apply`` is expected to be idempotent per trade number.  ``main.py``
+  passes the number to ``store.extend_membership``, which records it in
+  the same transaction as the extension (shared between instances when
+  Redis is used).
+
+The queue lives in its own SQLite file with its own connection, so a burst
+of payments after a promotion never waits behind chat traffic.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+import tracing
+
+CREATE_PAYMENT_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS payment_notifications(
+    trade_no     TEXT PRIMARY KEY,
+    received_at  REAL NOT NULL,
+    payload      TEXT NOT NULL,
+    status       TEXT NOT NULL DEFAULT 'pending',
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    error        TEXT,
+    applied_at   REAL
+);
+CREATE INDEX IF NOT EXISTS payment_pending
+    ON payment_notifications(status, next_attempt);
+"""
+
+
+class PaymentPipeline:
+    """Store notifications durably and apply them on a background worker.
+
+    ``apply(form)`` returns a confirmation text for the payer, or ``None``
+    when the notification needs no action.  ``notify(uid, text)`` sends that
+    confirmation; its failures are logged and never undo the activation.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        apply: Callable[[dict], str | None],
+        notify: Callable[[str, str], None],
+        max_attempts: int = 5,
+        backoff: float = 5.0,
+        poll: float = 5.0,
+    ) -> None:
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(CREATE_PAYMENT_TABLE_SQL)
+        self.apply = apply
+        self.notify = notify
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll = poll
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def enqueue(self, form: dict) -> bool:
+        """Persist a verified notification; return False if it was already queued.
+
+        A successful notification replaces an earlier unsuccessful one for
+        the same trade (e.g. an ATM order first reported as unpaid).
+        """
+        trade_no = form.get("MerchantTradeNo")
+        if not trade_no:
+            return False
+        payload = json.dumps(form, ensure_ascii=False)
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT payload FROM payment_notifications WHERE trade_no = ?",
+                (trade_no,),
+            ).fetchone()
+            if row is None:
+                self.conn.execute(
+                    "INSERT INTO payment_notifications"
+                    "(trade_no, received_at, payload) VALUES(?, ?, ?)",
+                    (trade_no, time.time(), payload),
+                )
+            elif _succeeded(form) and not _succeeded(json.loads(row[0])):
+                self.conn.execute(
+                    "UPDATE payment_notifications SET received_at = ?, payload = ?, "
+                    "status = 'pending', attempts = 0, next_attempt = 0, "
+                    "error = NULL, applied_at = NULL WHERE trade_no = ?",
+                    (time.time(), payload, trade_no),
+                )
+            else:
+                return False
+            self.conn.commit()
+        self._wake.set()
+        return True
+
+    def status(self, trade_no: str) -> str | None:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT status FROM payment_notifications WHERE trade_no = ?",
+                (trade_no,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def pending(self) -> int:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM payment_notifications WHERE status = 'pending'"
+            ).fetchone()[0]
+
+    def process_pending(self, limit: int = 50) -> int:
+        """Apply due notifications; returns how many were handled."""
+        now = time.time()
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT trade_no, payload, attempts FROM payment_notifications "
+                "WHERE status = 'pending' AND next_attempt <= ? "
+                "ORDER BY received_at LIMIT ?",
+                (now, limit),
+            ).fetchall()
+        for trade_no, payload, attempts in rows:
+            with tracing.start_trace("job.payment", trade_no=trade_no):
+                self._process(trade_no, json.loads(payload), attempts)
+        return len(rows)
+
+    def _process(self, trade_no: str, form: dict, attempts: int) -> None:
+        try:
+            with tracing.span("payment.apply", attempt=attempts + 1):
+                text = self.apply(form)
+        except Exception as exc:
+            logging.exception("payment %s: apply failed", trade_no)
+            self._retry(trade_no, attempts + 1, repr(exc))
+            return
+        self._finish(trade_no, "applied" if text else "ignored")
+        if text:
+            try:
+                with tracing.span("payment.notify"):
+                    self.notify(form.get("CustomField1"), text)
+            except Exception:
+                logging.exception("payment %s: confirmation push failed", trade_no)
+
+    def _retry(self, trade_no: str, attempts: int, error: str) -> None:
+        status = "failed" if attempts >= self.max_attempts else "pending"
+        with self._lock:
+            self.conn.execute(
+                "UPDATE payment_notifications SET attempts = ?, error = ?, status = ?, "
+                "next_attempt = ? WHERE trade_no = ?",
+                (
+                    attempts,
+                    error,
+                    status,
+                    time.time() + self.backoff * 2 ** (attempts - 1),
+                    trade_no,
+                ),
+            )
+            self.conn.commit()
+
+    def _finish(self, trade_no: str, status: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                "UPDATE payment_notifications SET status = ?, applied_at = ?, "
+                "attempts = attempts + 1 WHERE trade_no = ?",
+                (status, time.time(), trade_no),
+            )
+            self.conn.commit()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="payments", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                handled = self.process_pending()
+            except Exception:
+                logging.exception("payment worker")
+                handled = 0
+            if not handled:
+                self._wake.wait(self.poll)
+
+
+def _succeeded(form: dict) -> bool:
+    return str(form.get("RtnCode")) == "1"
+
+
+__all__ = ["CREATE_PAYMENT_TABLE_SQL", "PaymentPipeline"]
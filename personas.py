@@ -19,3 +19,7 @@ PERSONAS = {
 }
 
 DEFAULT_PERSONA = "rina"
+
+# 每則訊息都要查 wrapper，對照表只在載入時建一次
+WRAPPERS = {k: v["wrapper"] for k, v in PERSONAS.items()}
+DEFAULT_WRAPPER = PERSONAS[DEFAULT_PERSONA]["wrapper"]
@@ -0,0 +1,47 @@
+"""Thread pools that report how much work is waiting for a worker.
+
+The queue-depth gauges (hedged calls, voice messages, LINE API calls) need
+the number of submitted tasks that have not started yet.
+:class:`CountingPool` keeps that number itself instead of reading the
+executor's private work queue.
+"""
+
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class CountingPool(ThreadPoolExecutor):
+    """``ThreadPoolExecutor`` with a public :meth:`pending` count."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._waiting = 0
+        self._count_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        self._add(1)
+        try:
+            future = super().submit(self._started, fn, *args, **kwargs)
+        except BaseException:
+            self._add(-1)
+            raise
+        # 取消的工作不會開始，也要扣掉
+        future.add_done_callback(lambda f: f.cancelled() and self._add(-1))
+        return future
+
+    def _started(self, fn, *args, **kwargs):
+        self._add(-1)
+        return fn(*args, **kwargs)
+
+    def _add(self, n: int) -> None:
+        with self._count_lock:
+            self._waiting += n
+
+    def pending(self) -> int:
+        """Tasks submitted but not yet picked up by a worker."""
+        return self._waiting
+
+
+__all__ = ["CountingPool"]
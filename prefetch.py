@@ -0,0 +1,184 @@
+"""Generate the replies for a push burst before the push goes out.
+
+Right after the morning/noon/night pushes thousands of users answer at
+once ("早安", "吃飽了", "好睏").  Each answer is a chat completion, so the
+model API sees a spike exactly when the webhook does.  :class:`PrefetchStage`
+runs a few minutes (``lead``) before each :class:`~push_scheduler.Slot`
+opens and does that work at a fixed pace on its own small pool.
+
+* **Follow-ups**: every ``Slot.replies`` phrase is answered ``size`` times
+  per persona.  The answers go into the :class:`~response_cache.ResponseCache`
+  through :meth:`~response_cache.ResponseCache.fill`.  The normal chat path
+  then serves them as cache hits during the burst and still applies the
+  persona ``wrapper`` to them.
+* **Openers**: ``size`` persona-voiced versions of the push itself.
+  :meth:`opener` hands one out while the slot's window is open.  The caller
+  wraps it when sending, and falls back to the slot's fixed messages when
+  the pool is empty.
+
+Slot times are taken in ``tz`` (the server timezone).  Users in other
+timezones fall back to live calls, as before.
+"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Sequence
+
+import tracing
+from push_scheduler import Slot
+from response_cache import ResponseCache
+
+OPENER_PROMPT = (
+    "請你主動傳一則簡短的訊息給對方（一到兩句），主題和這些例子一樣，"
+    "但用你自己的話說：{examples}"
+)
+
+
+class PrefetchStage:
+    """Fill reply pools ``lead`` seconds before each slot opens."""
+
+    def __init__(
+        self,
+        generate: Callable[[str, str], str | None],
+        slots: Sequence[Slot],
+        personas: Iterable[str],
+        cache: ResponseCache | None,
+        tz: datetime.tzinfo,
+        lead: int = 300,
+        linger: int = 1800,
+        size: int = 3,
+        workers: int = 2,
+        interval: float = 60,
+        openers: Callable[[], bool] = lambda: True,
+    ) -> None:
+        self.generate = generate
+        self.slots = list(slots)
+        self.personas = list(personas)
+        self.cache = cache
+        self.tz = tz
+        self.lead = lead
+        self.linger = linger
+        self.size = size
+        self.interval = interval
+        # 開場白只有送推播的 leader 用得到
+        self.openers_enabled = openers
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="prefetch")
+        # (slot, persona) -> (開場白, 失效時間)
+        self._openers: dict[tuple[str, str], tuple[list[str], float]] = {}
+        self._done: set[tuple[str, datetime.date]] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def due(self, now: float) -> list[tuple[Slot, datetime.date, float]]:
+        """``(slot, day, start)`` for slots opening within ``lead`` (or still open)."""
+        today = datetime.datetime.fromtimestamp(now, self.tz).date()
+        out = []
+        for slot in self.slots:
+            for day in (today - datetime.timedelta(days=1), today):
+                if (slot.name, day) in self._done:
+                    continue
+                start = self._localize(day, slot)
+                if start - self.lead <= now < start + slot.window:
+                    out.append((slot, day, start))
+            # 明天的時段也可能在 lead 之內（跨午夜）
+            tomorrow = today + datetime.timedelta(days=1)
+            start = self._localize(tomorrow, slot)
+            if (slot.name, tomorrow) not in self._done and start - self.lead <= now:
+                out.append((slot, tomorrow, start))
+        return out
+
+    def _localize(self, day: datetime.date, slot: Slot) -> float:
+        local = datetime.datetime.combine(day, datetime.time(slot.hour, slot.minute))
+        if hasattr(self.tz, "localize"):  # pytz
+            return self.tz.localize(local).timestamp()
+        return local.replace(tzinfo=self.tz).timestamp()
+
+    def run_once(self, now: float | None = None) -> int:
+        """Fill every due slot; returns the number of answers generated."""
+        now = time.time() if now is None else now
+        generated = 0
+        for slot, day, start in self.due(now):
+            with tracing.start_trace("job.prefetch", slot=slot.name):
+                generated += self._fill(slot, start + slot.window + self.linger)
+            self._done.add((slot.name, day))
+        # 只留最近幾天的紀錄
+        cutoff = datetime.datetime.fromtimestamp(now, self.tz).date()
+        self._done = {d for d in self._done if (cutoff - d[1]).days < 2}
+        return generated
+
+    def _fill(self, slot: Slot, expires: float) -> int:
+        jobs = []
+        for persona in self.personas:
+            if self.cache is not None:
+                for phrase in slot.replies:
+                    key = self.cache.key(phrase)
+                    if key is None:
+                        logging.warning("prefetch: %r is not cacheable", phrase)
+                        continue
+                    jobs.append(("reply", persona, key, phrase))
+            if self.openers_enabled():
+                examples = "、".join(slot.messages)
+                prompt = OPENER_PROMPT.format(examples=examples)
+                jobs.append(("opener", persona, slot.name, prompt))
+        futures = [
+            (job, [self._submit(job[3], job[1]) for _ in range(self.size)])
+            for job in jobs
+        ]
+        generated = 0
+        for (kind, persona, key, _), results in futures:
+            answers = list(dict.fromkeys(r for f in results if (r := _result(f))))
+            generated += len(answers)
+            if not answers:
+                continue
+            if kind == "reply":
+                self.cache.fill(persona, key, answers)
+            else:
+                with self._lock:
+                    self._openers[(key, persona)] = (answers, expires)
+        logging.info("prefetch %s: %d answers", slot.name, generated)
+        return generated
+
+    def _submit(self, prompt: str, persona: str):
+        return self.pool.submit(tracing.wrap(self.generate), prompt, persona)
+
+    def opener(self, slot: str, persona: str, now: float | None = None) -> str | None:
+        """A pre-generated opener for ``slot`` in ``persona``'s voice, if any."""
+        now = time.time() if now is None else now
+        with self._lock:
+            answers, expires = self._openers.get((slot, persona), ((), 0))
+        return random.choice(answers) if answers and now < expires else None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception("prefetch failed")
+
+
+def _result(future) -> str | None:
+    try:
+        return future.result()
+    except Exception:
+        logging.exception("prefetch generation failed")
+        return None
+
+
+__all__ = ["OPENER_PROMPT", "PrefetchStage"]
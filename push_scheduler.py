@@ -0,0 +1,314 @@
+"""Per-user, timezone-aware scheduled pushes.
+
+The old meal reminders were three global cron broadcasts at fixed
+Asia/Taipei times, so every follower got the message in the same second and
+their replies hit the webhook together.  Instead:
+
+* Each user has one ``push_queue`` row per :class:`Slot`, holding the next
+  delivery time in *their* timezone plus a per-user jitter inside the slot's
+  window (indexed by ``due_at``).  :meth:`PushScheduler.schedule` writes
+  the rows when a user joins or changes their push settings.
+* :meth:`PushScheduler.tick` (every ``bucket`` seconds) reads only the rows
+  that are due, groups them by slot and sends one multicast per text and
+  500 recipients; ``compose`` picks the texts (e.g. one per persona).  A
+  delivered row moves on to its next occurrence.  A failed group is retried
+  with backoff and skipped after ``max_attempts``.
+* The queue is local to the leader, but users change their settings on
+  whichever instance receives the message.  With ``settings``, ``tick``
+  re-reads the due users' push settings from the user store before sending:
+  opted-out users' rows are deleted and rows of users whose timezone
+  changed are rescheduled instead of sent.
+* :meth:`PushScheduler.backfill` enrolls users who have no rows yet.  It is
+  the only full pass over the users and runs on election and once a day.
+
+The jitter is derived from a hash of the user ID, so a user gets the morning
+message at the same minute every day while the whole population is spread
+evenly across the window.
+"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import logging
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable, Sequence
+
+import pytz
+
+CREATE_PUSH_QUEUE_SQL = """
+CREATE TABLE IF NOT EXISTS push_queue(
+    user_id  TEXT NOT NULL,
+    slot     TEXT NOT NULL,
+    due_at   INTEGER NOT NULL,
+    timezone TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(user_id, slot)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS push_queue_due ON push_queue(due_at);
+"""
+
+MULTICAST_LIMIT = 500  # LINE multicast 一次最多 500 人
+
+
+@dataclass(frozen=True)
+class Slot:
+    """A daily push starting at ``hour:minute`` local time, spread over ``window``."""
+
+    name: str
+    hour: int
+    minute: int
+    window: int  # seconds
+    messages: Sequence[str]
+    daily_jitter: bool = False  # True → 每天換一個時間（隨機話題）
+    replies: Sequence[str] = ()  # 使用者常見的回應，供 prefetch 預先產生回覆
+
+
+def jitter(uid: str, slot: Slot, day: datetime.date) -> int:
+    """Deterministic offset in ``[0, slot.window)`` for this user."""
+    seed = f"{uid}:{slot.name}"
+    if slot.daily_jitter:
+        seed += f":{day.isoformat()}"
+    digest = hashlib.sha256(seed.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % max(slot.window, 1)
+
+
+def get_timezone(name: str | None, default: datetime.tzinfo) -> datetime.tzinfo:
+    if not name:
+        return default
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        return default
+
+
+def next_due(
+    uid: str, slot: Slot, tz: datetime.tzinfo, now: datetime.datetime
+) -> datetime.datetime:
+    """First delivery time of ``slot`` for ``uid`` strictly after ``now``."""
+    today = now.astimezone(tz).date()
+    for offset in range(3):
+        day = today + datetime.timedelta(days=offset - 1)
+        start = tz.localize(
+            datetime.datetime.combine(day, datetime.time(slot.hour, slot.minute))
+        )
+        due = start + datetime.timedelta(seconds=jitter(uid, slot, day))
+        if due > now:
+            return due
+    raise AssertionError("unreachable: a slot recurs every day")
+
+
+# (slot, 收件人) → [(文字, 收件人), ...]
+Compose = Callable[[Slot, list[str]], Iterable[tuple[str, list[str]]]]
+
+
+def _one_text(slot: Slot, uids: list[str]) -> list[tuple[str, list[str]]]:
+    return [(random.choice(slot.messages), uids)]
+
+
+class PushScheduler:
+    """Queue and deliver pushes; :meth:`tick` is meant to run on the leader only.
+
+    ``compose(slot, uids)`` splits a chunk of recipients into
+    ``(text, uids)`` groups (e.g. one text per persona); by default everyone
+    gets one of ``slot.messages``.  ``settings(uids)`` returns the current
+    ``{uid: (timezone, opted_out)}`` of due users (unknown users omitted).
+    """
+
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        recipients: Callable[[], object],
+        send: Callable[[list[str], str], None],
+        slots: Sequence[Slot],
+        default_tz: datetime.tzinfo,
+        bucket: int = 60,
+        max_late: int = 3600,
+        max_attempts: int = 3,
+        backoff: int = 60,
+        compose: Compose | None = None,
+        settings: Callable[[list[str]], dict[str, tuple[str | None, bool]]]
+        | None = None,
+    ) -> None:
+        self.conn = conn
+        self.recipients = recipients
+        self.send = send
+        self.compose = compose or _one_text
+        self.settings = settings
+        self.slots = {s.name: s for s in slots}
+        self.default_tz = default_tz
+        self.bucket = bucket
+        self.max_late = max_late
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript(CREATE_PUSH_QUEUE_SQL)
+            cols = {c[1] for c in self.conn.execute("PRAGMA table_info(push_queue)")}
+            if "timezone" not in cols:  # 舊版佇列
+                self.conn.execute("ALTER TABLE push_queue ADD COLUMN timezone TEXT")
+                self.conn.execute(
+                    "ALTER TABLE push_queue "
+                    "ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+                )
+            self.conn.commit()
+
+    def _rows(self, uid: str, tz_name: str | None, now: datetime.datetime) -> list:
+        tz = get_timezone(tz_name, self.default_tz)
+        return [
+            (uid, slot.name, int(next_due(uid, slot, tz, now).timestamp()), tz_name)
+            for slot in self.slots.values()
+        ]
+
+    def schedule(
+        self, uid: str, tz_name: str | None, now: datetime.datetime | None = None
+    ) -> None:
+        """(Re)queue the next delivery of every slot for ``uid``.
+
+        Call when a user joins, turns pushes back on or changes timezone.
+        """
+        now = now or datetime.datetime.now(pytz.utc)
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO push_queue(user_id, slot, due_at, timezone) "
+                "VALUES(?, ?, ?, ?)",
+                self._rows(uid, tz_name, now),
+            )
+            self.conn.commit()
+
+    def backfill(self, now: datetime.datetime | None = None) -> int:
+        """Queue opted-in users that have no rows yet; returns the rows added.
+
+        Existing rows are kept (``INSERT OR IGNORE``).  This pass reads every
+        user, so it runs on election and once a day, not on every tick.
+        """
+        now = now or datetime.datetime.now(pytz.utc)
+        added = 0
+        for batch in self.recipients():
+            rows = [r for uid, tz_name in batch for r in self._rows(uid, tz_name, now)]
+            with self.lock:
+                cur = self.conn.executemany(
+                    "INSERT OR IGNORE INTO push_queue(user_id, slot, due_at, timezone) "
+                    "VALUES(?, ?, ?, ?)",
+                    rows,
+                )
+                self.conn.commit()
+            added += max(cur.rowcount, 0)
+        return added
+
+    def tick(self, now: float | None = None) -> int:
+        """Send every push due by ``now``; returns the number of recipients."""
+        now = int(now if now is not None else time.time())
+        after = datetime.datetime.fromtimestamp(now, pytz.utc)
+        sent = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT user_id, slot, due_at, timezone, attempts FROM push_queue "
+                    "WHERE due_at <= ? ORDER BY due_at LIMIT ?",
+                    (now, MULTICAST_LIMIT * 4),
+                ).fetchall()
+            if not rows:
+                return sent
+            # 設定可能是在其他 instance 改的（這份佇列只有 leader 在送）→ 以 store 為準
+            latest = self.settings(list({r[0] for r in rows})) if self.settings else {}
+            by_slot: dict[str, list[tuple]] = {}
+            advance, retry, drop, moved = [], [], [], []
+            for row in rows:
+                uid, slot, due_at, tz_name = row[:4]
+                tz_now, opted_out = latest.get(uid, (tz_name, False))
+                if slot not in self.slots or opted_out:
+                    drop.append((uid, slot))
+                elif tz_now != tz_name:
+                    moved.append((uid, slot, tz_now))
+                # 停機太久錯過的推播直接跳過，不要中午才說早安
+                elif now - due_at > self.max_late:
+                    advance.append(row)
+                else:
+                    by_slot.setdefault(slot, []).append(row)
+            for slot, slot_rows in by_slot.items():
+                for i in range(0, len(slot_rows), MULTICAST_LIMIT):
+                    chunk = {r[0]: r for r in slot_rows[i : i + MULTICAST_LIMIT]}
+                    for text, uids in self.compose(self.slots[slot], list(chunk)):
+                        group = [chunk[uid] for uid in uids]
+                        try:
+                            self.send(uids, text)
+                        except Exception:
+                            logging.exception("push %s to %d users", slot, len(uids))
+                            for r in group:
+                                # 重試幾次仍失敗就放棄這一次，排下一次
+                                if r[4] + 1 < self.max_attempts:
+                                    retry.append(r)
+                                else:
+                                    advance.append(r)
+                            continue
+                        sent += len(group)
+                        advance.extend(group)
+            with self.lock:
+                self.conn.executemany(
+                    "UPDATE push_queue SET due_at = ?, attempts = 0 "
+                    "WHERE user_id = ? AND slot = ?",
+                    [
+                        (
+                            int(self._next(uid, slot, tz_name, after).timestamp()),
+                            uid,
+                            slot,
+                        )
+                        for uid, slot, _, tz_name, _ in advance
+                    ],
+                )
+                self.conn.executemany(
+                    "UPDATE push_queue SET due_at = ?, attempts = attempts + 1 "
+                    "WHERE user_id = ? AND slot = ?",
+                    [
+                        (now + self.backoff * 2**attempts, uid, slot)
+                        for uid, slot, _, _, attempts in retry
+                    ],
+                )
+                self.conn.executemany(
+                    "UPDATE push_queue SET due_at = ?, timezone = ?, attempts = 0 "
+                    "WHERE user_id = ? AND slot = ?",
+                    [
+                        (
+                            int(self._next(uid, slot, tz_name, after).timestamp()),
+                            tz_name,
+                            uid,
+                            slot,
+                        )
+                        for uid, slot, tz_name in moved
+                    ],
+                )
+                self.conn.executemany(
+                    "DELETE FROM push_queue WHERE user_id = ? AND slot = ?", drop
+                )
+                self.conn.commit()
+
+    def _next(
+        self, uid: str, slot: str, tz_name: str | None, after: datetime.datetime
+    ) -> datetime.datetime:
+        tz = get_timezone(tz_name, self.default_tz)
+        return next_due(uid, self.slots[slot], tz, after)
+
+    def forget(self, uid: str) -> None:
+        """Drop the user's queued pushes (opt-out)."""
+        with self.lock:
+            self.conn.execute("DELETE FROM push_queue WHERE user_id = ?", (uid,))
+            self.conn.commit()
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM push_queue").fetchone()[0]
+
+
+__all__ = [
+    "CREATE_PUSH_QUEUE_SQL",
+    "PushScheduler",
+    "Slot",
+    "get_timezone",
+    "jitter",
+    "next_due",
+]
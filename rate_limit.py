@@ -0,0 +1,168 @@
+"""Per-user rate limiting and adaptive load shedding.
+
+:class:`RateLimiter` keeps one token bucket per ``(user, command)`` pair; the
+bucket size and refill speed come from the user's tier (``free``, ``paid`` or
+``whitelist``).  :class:`LoadGovernor` watches in-flight requests and upstream
+latency and tells callers how much work they may still do.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+
+# tier -> command -> (次數, 秒數)
+DEFAULT_LIMITS: dict[str, dict[str, tuple[int, int]]] = {
+    "free": {"chat": (10, 60), "image": (3, 3600), "tts": (5, 3600)},
+    "paid": {"chat": (30, 60), "image": (20, 3600), "tts": (30, 3600)},
+    "whitelist": {"chat": (60, 60), "image": (60, 3600), "tts": (60, 3600)},
+}
+
+
+def parse_limits(spec: str | None) -> dict[str, dict[str, tuple[int, int]]]:
+    """Merge ``"paid.chat=30/60,free.image=3/3600"`` overrides into the defaults."""
+    limits = {tier: dict(cmds) for tier, cmds in DEFAULT_LIMITS.items()}
+    for item in filter(None, (s.strip() for s in (spec or "").split(","))):
+        name, _, value = item.partition("=")
+        tier, _, command = name.strip().partition(".")
+        count, _, seconds = value.partition("/")
+        if not (tier and command and count and seconds):
+            raise ValueError(f"invalid rate limit spec: {item!r}")
+        limits.setdefault(tier, {})[command] = (int(count), int(seconds))
+    return limits
+
+
+class RateLimiter:
+    """Token buckets keyed by ``(user_id, command)``.
+
+    Each bucket is a two-item list ``[tokens, last_refill]`` so a hundred
+    thousand active users cost only a few megabytes.  Idle buckets (which
+    would be full anyway) are dropped every ``prune_every`` calls.
+    """
+
+    def __init__(
+        self,
+        limits: dict[str, dict[str, tuple[int, int]]] | None = None,
+        prune_every: int = 10_000,
+    ) -> None:
+        self.limits = limits or DEFAULT_LIMITS
+        self.prune_every = prune_every
+        self._buckets: dict[tuple[str, str], list[float]] = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def allow(self, uid: str, command: str, tier: str = "free") -> bool:
+        """Consume one token; return ``False`` when the user is over the limit."""
+        limit = self.limits.get(tier, self.limits["free"]).get(command)
+        if limit is None:
+            return True
+        capacity, period = limit
+        rate = capacity / period
+        now = time.monotonic()
+        key = (uid, command)
+        with self._lock:
+            self._calls += 1
+            if self._calls % self.prune_every == 0:
+                self._prune(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(capacity), now]
+            else:
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def retry_after(self, uid: str, command: str, tier: str = "free") -> int:
+        """Seconds until the next token is available (rounded up)."""
+        capacity, period = self.limits.get(tier, self.limits["free"])[command]
+        with self._lock:
+            bucket = self._buckets.get((uid, command))
+            if bucket is None or bucket[0] >= 1:
+                return 0
+            return int((1 - bucket[0]) * period / capacity) + 1
+
+    def _prune(self, now: float) -> None:
+        longest = max(p for cmds in self.limits.values() for _, p in cmds.values())
+        stale = [k for k, b in self._buckets.items() if now - b[1] > longest]
+        for k in stale:
+            del self._buckets[k]
+
+
+class LoadGovernor:
+    """Decide whether to serve, degrade or shed based on load.
+
+    Levels, from cheapest to most drastic:
+
+    * ``NORMAL``    – full service.
+    * ``DEGRADED``  – cheaper chat model and smaller images.
+    * ``TEXT_ONLY`` – refuse image and speech generation.
+    * ``SHED``      – reply with a short busy message without calling upstream.
+    """
+
+    NORMAL, DEGRADED, TEXT_ONLY, SHED = range(4)
+
+    def __init__(
+        self,
+        degrade_inflight: int = 8,
+        text_only_inflight: int = 16,
+        max_inflight: int = 32,
+        degrade_latency: float = 8.0,
+        text_only_latency: float = 15.0,
+        alpha: float = 0.2,
+        stale_after: float = 60.0,
+    ) -> None:
+        self.degrade_inflight = degrade_inflight
+        self.text_only_inflight = text_only_inflight
+        self.max_inflight = max_inflight
+        self.degrade_latency = degrade_latency
+        self.text_only_latency = text_only_latency
+        self.alpha = alpha
+        self.stale_after = stale_after
+        self.inflight = 0
+        # upstream -> [moving average, last sample time]
+        self.latency: dict[str, list[float]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        with self._lock:
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+    def observe(self, upstream: str, seconds: float) -> None:
+        """Feed one upstream latency sample into its moving average."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self.latency.get(upstream)
+            if entry is None or now - entry[1] > self.stale_after:
+                self.latency[upstream] = [seconds, now]
+            else:
+                entry[0] += self.alpha * (seconds - entry[0])
+                entry[1] = now
+
+    def level(self) -> int:
+        inflight = self.inflight
+        # 太久沒有樣本的上游不再影響判斷，避免降級後永遠回不來
+        cutoff = time.monotonic() - self.stale_after
+        worst = max(
+            (avg for avg, ts in list(self.latency.values()) if ts >= cutoff),
+            default=0.0,
+        )
+        if inflight > self.max_inflight:
+            return self.SHED
+        if inflight > self.text_only_inflight or worst >= self.text_only_latency:
+            return self.TEXT_ONLY
+        if inflight > self.degrade_inflight or worst >= self.degrade_latency:
+            return self.DEGRADED
+        return self.NORMAL
+
+
+__all__ = ["DEFAULT_LIMITS", "LoadGovernor", "RateLimiter", "parse_limits"]
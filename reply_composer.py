@@ -0,0 +1,90 @@
+"""Turn a handler's output into LINE-sized messages.
+
+LINE accepts at most :data:`MAX_MESSAGES` messages per reply or push call
+and :data:`MAX_TEXT_LENGTH` characters per text message.  Handlers hand
+over *parts*: plain strings (one per persona in a group chat) and ready
+message objects (images, audio).
+
+* :func:`compose` turns each string into one or more text messages.
+  Text longer than the limit is cut by :func:`split_text` at sentence
+  boundaries.
+* :func:`pack` groups the result into batches.  :class:`line_client.LineClient`
+  replies with the first batch and pushes the rest.
+
+Nothing here imports the LINE SDK: the text message type is passed in by
+the caller.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Callable, Iterable, TypeVar
+
+MAX_MESSAGES = 5
+MAX_TEXT_LENGTH = 5000
+
+# 句尾（中英文標點、刪節號、波浪號、換行）之後切開，標點留在前一句
+_SENTENCE_END = re.compile(r"(?<=[。！？!?…～\n])")
+
+T = TypeVar("T")
+
+
+def text_length(text: str) -> int:
+    """Length as LINE counts it (UTF-16 code units, so an emoji counts as 2)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_text(text: str, limit: int = MAX_TEXT_LENGTH) -> list[str]:
+    """Split ``text`` into chunks of at most ``limit``, preferring sentence ends."""
+    if text_length(text) <= limit:
+        return [text]
+    chunks: list[str] = []
+    buf = ""
+    for sentence in _SENTENCE_END.split(text):
+        if text_length(buf) + text_length(sentence) <= limit:
+            buf += sentence
+            continue
+        if buf:
+            chunks.append(buf)
+        # 沒有斷句點的超長段落只能硬切
+        while text_length(sentence) > limit:
+            cut = limit
+            while text_length(sentence[:cut]) > limit:
+                # 一個字最多佔 2 個單位，每次至少退一個字
+                cut -= (text_length(sentence[:cut]) - limit + 1) // 2
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:]
+        buf = sentence
+    if buf:
+        chunks.append(buf)
+    return chunks
+
+
+def compose(parts: Iterable, make_text: Callable[[str], T]) -> list:
+    """Flatten ``parts`` into messages.
+
+    Strings become ``make_text(chunk)`` for every chunk of :func:`split_text`
+    (empty strings are dropped).  Any other part is kept as is.
+    """
+    messages = []
+    for part in parts:
+        if isinstance(part, str):
+            messages.extend(make_text(chunk) for chunk in split_text(part) if chunk)
+        else:
+            messages.append(part)
+    return messages
+
+
+def pack(messages: list[T], size: int = MAX_MESSAGES) -> list[list[T]]:
+    """Group ``messages`` into batches of at most ``size``."""
+    return [messages[i : i + size] for i in range(0, len(messages), size)]
+
+
+__all__ = [
+    "MAX_MESSAGES",
+    "MAX_TEXT_LENGTH",
+    "compose",
+    "pack",
+    "split_text",
+    "text_length",
+]
@@ -0,0 +1,282 @@
+"""Circuit breakers, deadlines, retry budgets and hedged calls for upstream APIs.
+
+Every outbound call (OpenAI, Replicate, ElevenLabs, R2) goes through
+:func:`call`, which
+
+* fails fast while the upstream's :class:`CircuitBreaker` is open,
+* clamps the per-attempt timeout to whatever is left of the request deadline
+  set with :func:`deadline` (the webhook sets one so a slow upstream cannot
+  hold a worker past the point where LINE's reply token is still useful),
+* retries transient errors with full-jitter backoff while the shared
+  :class:`RetryBudget` allows it, and
+* optionally hedges: if the first attempt has not answered after
+  ``hedge_after`` seconds a second one is started and the first result wins.
+
+The wrapped function receives the timeout (in seconds) it should pass to its
+HTTP client.  Observers registered with :func:`add_observer` are told the
+latency and outcome of every attempt.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from typing import Callable, TypeVar
+
+from pools import CountingPool
+
+T = TypeVar("T")
+
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "deadline", default=None
+)
+# 對沖時兩個 attempt 都在這裡跑；大小由 configure() 依 webhook 併發數設定
+_hedge_pool = CountingPool(max_workers=8, thread_name_prefix="hedge")
+
+
+def configure(hedge_workers: int) -> None:
+    """Size the pool running hedged attempts.
+
+    Every in-flight hedged call holds one or two of its threads, so it must
+    be larger than the number of concurrent callers or chat concurrency is
+    silently capped at the pool size.
+    """
+    global _hedge_pool
+    old = _hedge_pool
+    _hedge_pool = CountingPool(max_workers=hedge_workers, thread_name_prefix="hedge")
+    old.shutdown(wait=False)
+
+
+def pending() -> int:
+    """Hedged attempts waiting for a free thread."""
+    return _hedge_pool.pending()
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when no time is left in the current request deadline."""
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Bound every upstream call made inside the block to ``seconds`` in total."""
+    end = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(end if current is None else min(current, end))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining(default: float) -> float:
+    """Seconds left before the active deadline, capped at ``default``."""
+    end = _deadline.get()
+    if end is None:
+        return default
+    return min(default, end - time.monotonic())
+
+
+class CircuitBreaker:
+    """Classic closed → open → half-open breaker.
+
+    After ``failure_threshold`` consecutive failures the breaker opens for
+    ``reset_timeout`` seconds, then lets a single probe through.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(
+        self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                return True
+            # half-open：探測請求尚未回來前不放行其他請求
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opens += 1
+                    logging.warning("circuit %s opened", self.name)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """Allow retries for at most ``ratio`` of recent requests.
+
+    Each request deposits ``ratio`` tokens and each retry withdraws one, so a
+    fully failing upstream sees at most ``1 + ratio`` times normal traffic.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 3.0) -> None:
+        self.ratio = ratio
+        self.max_tokens = max(min_tokens, 10.0)
+        self.tokens = min_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+breakers: dict[str, CircuitBreaker] = {}
+retry_budget = RetryBudget()
+observers: list[Callable[[str, float, bool], None]] = []
+
+
+def add_observer(func: Callable[[str, float, bool], None]) -> None:
+    """Register ``func(upstream, seconds, ok)`` to be called after each attempt."""
+    observers.append(func)
+
+
+def _notify(name: str, seconds: float, ok: bool) -> None:
+    for func in observers:
+        try:
+            func(name, seconds, ok)
+        except Exception:
+            logging.exception("resilience observer failed")
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = breakers.get(name)
+    if breaker is None:
+        breaker = breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+def breaker_states() -> dict[str, str]:
+    return {name: b.state for name, b in breakers.items()}
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Return False for client errors (4xx except 429) that retrying won't fix."""
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None) or getattr(exc, "status_code", None)
+    if isinstance(status, int) and 400 <= status < 500 and status != 429:
+        return False
+    return not isinstance(exc, (CircuitOpenError, ValueError))
+
+
+def _hedged(fn: Callable[[float], T], timeout: float, hedge_after: float) -> T:
+    ctx = contextvars.copy_context()
+    futures = [_hedge_pool.submit(ctx.copy().run, fn, timeout)]
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done:
+        futures.append(
+            _hedge_pool.submit(ctx.copy().run, fn, max(timeout - hedge_after, 0.1))
+        )
+    error: BaseException | None = None
+    waiting = set(futures)
+    end = time.monotonic() + timeout
+    while waiting:
+        done, waiting = wait(
+            waiting, timeout=max(end - time.monotonic(), 0), return_when=FIRST_COMPLETED
+        )
+        if not done:
+            break
+        for fut in done:
+            if fut.exception() is None:
+                return fut.result()
+            error = fut.exception()
+    raise error or DeadlineExceeded(f"hedged call timed out after {timeout:.1f}s")
+
+
+def call(
+    name: str,
+    fn: Callable[[float], T],
+    timeout: float,
+    retries: int = 1,
+    backoff: float = 0.5,
+    hedge_after: float | None = None,
+) -> T:
+    """Call ``fn(timeout)`` against upstream ``name`` with the policies above."""
+    breaker = get_breaker(name)
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        budget = remaining(timeout)
+        if budget <= 0:
+            raise DeadlineExceeded(f"{name}: no time left in request deadline")
+        if not breaker.allow():
+            raise CircuitOpenError(f"{name}: circuit open")
+        start = time.perf_counter()
+        try:
+            if hedge_after and budget > hedge_after:
+                result = _hedged(fn, budget, hedge_after)
+            else:
+                result = fn(budget)
+        except Exception as exc:
+            _notify(name, time.perf_counter() - start, False)
+            if not is_transient(exc):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            if attempt > retries or not retry_budget.withdraw():
+                raise
+            sleep = random.uniform(0, backoff * 2 ** (attempt - 1))
+            if remaining(timeout) <= sleep:
+                raise
+            logging.warning("%s failed (%s), retry %d", name, exc, attempt)
+            time.sleep(sleep)
+        else:
+            _notify(name, time.perf_counter() - start, True)
+            breaker.record_success()
+            return result
+
+
+__all__ = [
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "DeadlineExceeded",
+    "RetryBudget",
+    "add_observer",
+    "breaker_states",
+    "breakers",
+    "call",
+    "configure",
+    "deadline",
+    "get_breaker",
+    "pending",
+    "remaining",
+]
@@ -0,0 +1,219 @@
+"""Per-persona cache of chat replies for short small-talk messages.
+
+Greetings such as "早安" / "晚安～～" / "在嗎?" make up a large share of the
+traffic and each cost a full chat completion.  :class:`ResponseCache` keys
+replies by the *normalised* message: NFKC, lower case, punctuation, symbols
+and whitespace removed, long character runs collapsed, and sentence-final
+particles (喔/哦/啦…) dropped.  Only small talk is cached.  The message must
+be one of :data:`SMALL_TALK` plus filler words such as 今天, 寶貝 or
+particles, so a short real question never gets another user's answer.  A
+lookup first tries the exact key.  When NumPy is installed it then tries
+the most similar cached key by cosine similarity of hashed character
+1–2-gram vectors ("寶貝早安" ≈ "早安寶貝").
+
+Each key is answered by the upstream ``variants`` times (keeping the
+distinct answers) before it starts serving hits, and a hit returns one of
+them at random.  Callers pass the raw answer through the persona ``wrapper``
+afterwards, so a cached reply still gets a fresh opening/ending every time.
+"""
+
+from __future__ import annotations
+
+import random
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+try:
+    import numpy as np
+except ImportError:  # 沒有 NumPy → 只做完全比對
+    np = None
+
+_RUNS = re.compile(r"(.)\1{2,}")
+# 句尾語氣詞只改變語氣（回覆本來就會經過 wrapper），比對時去掉
+_PARTICLES = re.compile(r"[喔哦噢唷啊呀啦囉嘛欸耶哇]+$")
+
+# 可以快取的寒暄；訊息去掉這些詞之後只能剩下 _FILLER
+SMALL_TALK = (
+    "早安",
+    "午安",
+    "晚安",
+    "在嗎",
+    "在不在",
+    "想你",
+    "愛你",
+    "你好",
+    "哈囉",
+    "安安",
+    "嗨",
+    "hi",
+    "hello",
+    "好累",
+    "好睏",
+    "好無聊",
+    "睡不著",
+    "掰掰",
+    "bye",
+    "謝謝",
+)
+_FILLER = re.compile(
+    r"(?:今天|今晚|寶貝|親愛的|老婆|我|你|也|好|了|安|哈|嘿|嗎|呢|吧"
+    r"|喔|哦|噢|唷|啊|呀|啦|囉|嘛|欸|耶|哇)*"
+)
+
+
+def normalize(text: str) -> str:
+    """Canonical form used as the cache key ("早安～～!!" → "早安")."""
+    text = unicodedata.normalize("NFKC", text).lower().replace("妳", "你")
+    text = "".join(
+        ch for ch in text if unicodedata.category(ch)[0] not in ("P", "S", "Z", "C")
+    )
+    return _PARTICLES.sub("", _RUNS.sub(r"\1", text))
+
+
+def is_small_talk(key: str, phrases=SMALL_TALK) -> bool:
+    """True when ``key`` is one small-talk phrase plus filler words."""
+    for phrase in phrases:
+        if phrase in key and _FILLER.fullmatch(key.replace(phrase, "", 1)):
+            return True
+    return False
+
+
+def _ngrams(key: str) -> list[str]:
+    return list(key) + [key[i : i + 2] for i in range(len(key) - 1)]
+
+
+def vectorize(key: str, dim: int):
+    """L2-normalised hashed character n-gram vector (NumPy float32)."""
+    vec = np.zeros(dim, dtype=np.float32)
+    for gram in _ngrams(key):
+        vec[zlib.crc32(gram.encode()) % dim] += 1.0
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+@dataclass
+class _Entry:
+    answers: list[str] = field(default_factory=list)
+    puts: int = 0
+    created: float = field(default_factory=time.monotonic)
+    vec: object = None
+
+
+class _PersonaCache:
+    def __init__(self) -> None:
+        self.entries: OrderedDict[str, _Entry] = OrderedDict()
+        self.keys: list[str] = []
+        self.matrix = None  # 與 keys 對應的向量矩陣，entries 變動後重建
+
+    def invalidate(self) -> None:
+        self.matrix = None
+
+
+class ResponseCache:
+    """Bounded LRU of upstream answers, one namespace per persona."""
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        variants: int = 3,
+        ttl: float = 6 * 60 * 60,
+        max_len: int = 12,
+        threshold: float = 0.8,
+        dim: int = 512,
+        phrases: tuple[str, ...] = SMALL_TALK,
+    ) -> None:
+        self.max_entries = max_entries
+        self.variants = variants
+        self.ttl = ttl
+        self.max_len = max_len
+        self.threshold = threshold
+        self.dim = dim
+        # 長的片語先比，"在不在" 不會被當成 "在" + 其他字
+        self.phrases = tuple(sorted(phrases, key=len, reverse=True))
+        self.similarity = np is not None
+        self._personas: dict[str, _PersonaCache] = {}
+        self._lock = threading.Lock()
+
+    def key(self, text: str) -> str | None:
+        """Cache key for ``text`` or ``None`` when it is not small talk."""
+        key = normalize(text)
+        if not key or len(key) > self.max_len or not is_small_talk(key, self.phrases):
+            return None
+        return key
+
+    def get(self, persona: str, key: str) -> str | None:
+        """Cached answer, or ``None`` on a miss or while still collecting variants."""
+        now = time.monotonic()
+        with self._lock:
+            cache = self._personas.get(persona)
+            if cache is None:
+                return None
+            entry = cache.entries.get(key)
+            if entry is None and self.similarity:
+                key = self._nearest(cache, key)
+                entry = cache.entries.get(key) if key else None
+            if entry is None:
+                return None
+            if now - entry.created > self.ttl:
+                del cache.entries[key]
+                cache.invalidate()
+                return None
+            if entry.puts < self.variants:
+                return None
+            cache.entries.move_to_end(key)
+            return random.choice(entry.answers)
+
+    def put(self, persona: str, key: str, answer: str) -> None:
+        with self._lock:
+            cache = self._personas.setdefault(persona, _PersonaCache())
+            entry = cache.entries.get(key)
+            if entry is None:
+                entry = cache.entries[key] = _Entry()
+                if self.similarity:
+                    entry.vec = vectorize(key, self.dim)
+                cache.invalidate()
+                while len(cache.entries) > self.max_entries:
+                    cache.entries.popitem(last=False)
+            cache.entries.move_to_end(key)
+            entry.puts += 1
+            if answer not in entry.answers and len(entry.answers) < self.variants:
+                entry.answers.append(answer)
+
+    def fill(self, persona: str, key: str, answers: list[str]) -> None:
+        """Replace ``key``'s entry with pre-generated ``answers`` (see :mod:`prefetch`).
+
+        The entry starts fresh (new TTL) and serves hits right away when
+        there are at least ``variants`` answers.
+        """
+        with self._lock:
+            cache = self._personas.setdefault(persona, _PersonaCache())
+            entry = _Entry(answers=list(answers[: self.variants]), puts=len(answers))
+            if self.similarity:
+                entry.vec = vectorize(key, self.dim)
+            cache.entries[key] = entry
+            cache.entries.move_to_end(key)
+            cache.invalidate()
+            while len(cache.entries) > self.max_entries:
+                cache.entries.popitem(last=False)
+
+    def _nearest(self, cache: _PersonaCache, key: str) -> str | None:
+        if not cache.entries:
+            return None
+        if cache.matrix is None:
+            cache.keys = list(cache.entries)
+            cache.matrix = np.stack([cache.entries[k].vec for k in cache.keys])
+        scores = cache.matrix @ vectorize(key, self.dim)
+        best = int(np.argmax(scores))
+        return cache.keys[best] if scores[best] >= self.threshold else None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(c.entries) for c in self._personas.values())
+
+
+__all__ = ["ResponseCache", "SMALL_TALK", "is_small_talk", "normalize", "vectorize"]
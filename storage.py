@@ -0,0 +1,492 @@
+"""User state storage backends.
+
+:class:`UserStore` is the interface ``main.py`` uses for every read/write of
+user data (quota counters, persona, membership).  Two implementations:
+
+* :class:`SQLiteUserStore` – the original ``users`` table on a connection of
+  its own, behind a lock so the webhook, scheduler and payment threads can
+  share it.
+* :class:`RedisUserStore` – one hash per user in Redis, so several app
+  instances on different machines can serve the same users.  Counter
+  updates are pipelined into a single round-trip and batch reads use one
+  pipeline for any number of users.
+
+Pick one with :func:`make_store` (``STORAGE_BACKEND=sqlite|redis``).
+"""
+
+from __future__ import annotations
+
+import abc
+import datetime
+import sqlite3
+import threading
+from typing import Iterable, Iterator, NamedTuple
+
+USER_COLUMNS = (
+    "msg_count",
+    "is_paid",
+    "free_count",
+    "paid_until",
+    "persona",
+    "group_personas",
+)
+# 已套用訂單的保留時間（ECPay 重送通知的期間遠短於此）
+TRADE_TTL = 400 * 24 * 60 * 60
+# 可以用 update() 直接寫入的欄位（timezone / push_opt_out 為推播設定，不在 UserRow 內）
+UPDATABLE = frozenset(
+    {"is_paid", "paid_until", "persona", "group_personas", "timezone", "push_opt_out"}
+)
+
+
+class UserRow(NamedTuple):
+    msg_count: int
+    is_paid: int
+    free_count: int
+    paid_until: str | None
+    persona: str
+    group_personas: str | None
+
+
+def extend_from(current: str | None, days: int, today: datetime.date) -> str:
+    """New ``paid_until`` after adding ``days`` to an active or lapsed membership."""
+    base = today
+    if current:
+        until = datetime.date.fromisoformat(current)
+        if until >= today:
+            base = until
+    return (base + datetime.timedelta(days=days)).isoformat()
+
+
+def is_expired(paid_until: str | None, today: datetime.date) -> bool:
+    """Whether a membership ending on ``paid_until`` has lapsed by ``today``."""
+    # fromisoformat 是 C 實作，比 strptime 快一個數量級（每則訊息都會檢查）
+    return bool(paid_until) and datetime.date.fromisoformat(paid_until) < today
+
+
+class UserStore(abc.ABC):
+    """Interface for user state; methods are safe to call from any thread."""
+
+    def __init__(self, free_quota: int, default_persona: str) -> None:
+        self.free_quota = free_quota
+        self.default_persona = default_persona
+
+    def new_row(self) -> UserRow:
+        return UserRow(0, 0, self.free_quota, None, self.default_persona, None)
+
+    @abc.abstractmethod
+    def get_user(self, uid: str) -> UserRow:
+        """Return the user's row, creating it with the free quota if missing."""
+
+    @abc.abstractmethod
+    def get_users(self, uids: Iterable[str]) -> dict[str, UserRow]:
+        """Batch read; unknown users are omitted (not created)."""
+
+    @abc.abstractmethod
+    def incr(self, uid: str, msg_count: int = 0, free_count: int = 0) -> None:
+        """Add to the message counter and/or the free quota in one round-trip."""
+
+    @abc.abstractmethod
+    def update(self, uid: str, **fields) -> None:
+        """Overwrite the given fields (names from :data:`UPDATABLE`)."""
+
+    @abc.abstractmethod
+    def extend_membership(
+        self, uid: str, days: int, today: datetime.date, trade_no: str | None = None
+    ) -> str | None:
+        """Atomically mark the user paid and push ``paid_until`` by ``days``.
+
+        With ``trade_no`` the extension is recorded together with the order in
+        the same transaction; an order that was already applied changes
+        nothing and returns ``None``.
+        """
+
+    @abc.abstractmethod
+    def users_expiring(self, date: str) -> list[tuple[str, str, str]]:
+        """``(user_id, paid_until, persona)`` of paid users expiring on ``date``."""
+
+    @abc.abstractmethod
+    def push_settings(self, uid: str) -> tuple[str | None, bool]:
+        """``(timezone, opted_out)`` of one user."""
+
+    @abc.abstractmethod
+    def push_settings_many(
+        self, uids: Iterable[str]
+    ) -> dict[str, tuple[str | None, bool]]:
+        """Batch :meth:`push_settings`; unknown users are omitted."""
+
+    @abc.abstractmethod
+    def push_recipients(
+        self, batch: int = 500
+    ) -> Iterator[list[tuple[str, str | None]]]:
+        """Yield batches of ``(user_id, timezone)`` for users accepting pushes."""
+
+    @staticmethod
+    def _check_fields(fields: dict) -> None:
+        unknown = set(fields) - UPDATABLE
+        if unknown:
+            raise ValueError(f"cannot update {sorted(unknown)}")
+
+
+class SQLiteUserStore(UserStore):
+    def __init__(
+        self, conn: sqlite3.Connection, free_quota: int, default_persona: str
+    ) -> None:
+        super().__init__(free_quota, default_persona)
+        self.conn = conn
+        self.lock = threading.RLock()
+        # 已套用的訂單；和 users 的更新在同一個交易內寫入
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS membership_trades("
+            "trade_no TEXT PRIMARY KEY, user_id TEXT NOT NULL, "
+            "days INTEGER NOT NULL, paid_until TEXT NOT NULL)"
+        )
+        conn.commit()
+
+    def get_user(self, uid: str) -> UserRow:
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id=?", (uid,)
+            ).fetchone()
+            if row:
+                return UserRow(*row)
+            self.conn.execute(
+                "INSERT INTO users(user_id, free_count, persona, group_personas) "
+                "VALUES(?, ?, ?, NULL)",
+                (uid, self.free_quota, self.default_persona),
+            )
+            self.conn.commit()
+        return self.new_row()
+
+    def get_users(self, uids: Iterable[str]) -> dict[str, UserRow]:
+        uids = list(uids)
+        out: dict[str, UserRow] = {}
+        # SQLite 參數上限 999 → 分批查詢
+        with self.lock:
+            for i in range(0, len(uids), 500):
+                chunk = uids[i : i + 500]
+                marks = ",".join("?" * len(chunk))
+                for uid, *row in self.conn.execute(
+                    f"SELECT user_id, {', '.join(USER_COLUMNS)} FROM users "
+                    f"WHERE user_id IN ({marks})",
+                    chunk,
+                ):
+                    out[uid] = UserRow(*row)
+        return out
+
+    def incr(self, uid: str, msg_count: int = 0, free_count: int = 0) -> None:
+        with self.lock:
+            self.conn.execute(
+                "UPDATE users SET msg_count = msg_count + ?, "
+                "free_count = free_count + ? WHERE user_id = ?",
+                (msg_count, free_count, uid),
+            )
+            self.conn.commit()
+
+    def update(self, uid: str, **fields) -> None:
+        self._check_fields(fields)
+        if not fields:
+            return
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        with self.lock:
+            self.conn.execute(
+                f"UPDATE users SET {assignments} WHERE user_id = ?",
+                (*fields.values(), uid),
+            )
+            self.conn.commit()
+
+    def extend_membership(
+        self, uid: str, days: int, today: datetime.date, trade_no: str | None = None
+    ) -> str | None:
+        with self.lock:
+            try:
+                row = self.conn.execute(
+                    "SELECT paid_until FROM users WHERE user_id = ?", (uid,)
+                ).fetchone()
+                new_until = extend_from(row[0] if row else None, days, today)
+                if trade_no is not None and not self.conn.execute(
+                    "INSERT OR IGNORE INTO membership_trades VALUES(?, ?, ?, ?)",
+                    (trade_no, uid, days, new_until),
+                ).rowcount:
+                    self.conn.rollback()
+                    return None  # 這筆訂單已經套用過
+                if row is None:
+                    self.conn.execute(
+                        "INSERT INTO users(user_id, free_count, persona) "
+                        "VALUES(?, ?, ?)",
+                        (uid, self.free_quota, self.default_persona),
+                    )
+                self.conn.execute(
+                    "UPDATE users SET is_paid = 1, paid_until = ? WHERE user_id = ?",
+                    (new_until, uid),
+                )
+                self.conn.commit()
+            except BaseException:
+                # 中途失敗 → 訂單紀錄和會員期限一起撤回
+                self.conn.rollback()
+                raise
+        return new_until
+
+    def users_expiring(self, date: str) -> list[tuple[str, str, str]]:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT user_id, paid_until, persona FROM users "
+                "WHERE is_paid = 1 AND paid_until = ?",
+                (date,),
+            ).fetchall()
+
+    def push_settings(self, uid: str) -> tuple[str | None, bool]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT timezone, push_opt_out FROM users WHERE user_id = ?", (uid,)
+            ).fetchone()
+        return (row[0], bool(row[1])) if row else (None, False)
+
+    def push_settings_many(
+        self, uids: Iterable[str]
+    ) -> dict[str, tuple[str | None, bool]]:
+        uids = list(uids)
+        out: dict[str, tuple[str | None, bool]] = {}
+        with self.lock:
+            for i in range(0, len(uids), 500):
+                chunk = uids[i : i + 500]
+                marks = ",".join("?" * len(chunk))
+                for uid, tz, opt_out in self.conn.execute(
+                    "SELECT user_id, timezone, push_opt_out FROM users "
+                    f"WHERE user_id IN ({marks})",
+                    chunk,
+                ):
+                    out[uid] = (tz, bool(opt_out))
+        return out
+
+    def push_recipients(
+        self, batch: int = 500
+    ) -> Iterator[list[tuple[str, str | None]]]:
+        last = ""
+        while True:
+            # keyset 分頁：每批只鎖一下，不會長時間佔住連線
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT user_id, timezone FROM users "
+                    "WHERE push_opt_out = 0 AND user_id > ? ORDER BY user_id LIMIT ?",
+                    (last, batch),
+                ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last = rows[-1][0]
+
+
+class RedisUserStore(UserStore):
+    """Users as Redis hashes ``<prefix>user:<uid>``.
+
+    A set ``<prefix>expiring:<date>`` indexes paid users by expiry date so
+    the daily reminder never scans the keyspace.
+    """
+
+    def __init__(
+        self, client, free_quota: int, default_persona: str, prefix: str = "laigf:"
+    ) -> None:
+        super().__init__(free_quota, default_persona)
+        self.r = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, free_quota: int, default_persona: str):
+        import redis
+
+        return cls(redis.Redis.from_url(url), free_quota, default_persona)
+
+    def _key(self, uid: str) -> str:
+        return f"{self.prefix}user:{uid}"
+
+    def _expiring_key(self, date: str) -> str:
+        return f"{self.prefix}expiring:{date}"
+
+    @staticmethod
+    def _decode(raw: dict) -> UserRow:
+        def s(name):
+            v = raw.get(name.encode())
+            return v.decode() if v not in (None, b"") else None
+
+        return UserRow(
+            int(raw.get(b"msg_count", 0)),
+            int(raw.get(b"is_paid", 0)),
+            int(raw.get(b"free_count", 0)),
+            s("paid_until"),
+            s("persona"),
+            s("group_personas"),
+        )
+
+    def get_user(self, uid: str) -> UserRow:
+        key = self._key(uid)
+        raw = self.r.hgetall(key)
+        if raw:
+            return self._decode(raw)
+        row = self.new_row()
+        pipe = self.r.pipeline()
+        # HSETNX 逐欄寫入：兩個 instance 同時建立同一位使用者也不會互相覆蓋
+        for name, value in zip(USER_COLUMNS, row):
+            pipe.hsetnx(key, name, "" if value is None else value)
+        pipe.hgetall(key)
+        return self._decode(pipe.execute()[-1])
+
+    def get_users(self, uids: Iterable[str]) -> dict[str, UserRow]:
+        uids = list(uids)
+        pipe = self.r.pipeline(transaction=False)
+        for uid in uids:
+            pipe.hgetall(self._key(uid))
+        return {
+            uid: self._decode(raw) for uid, raw in zip(uids, pipe.execute()) if raw
+        }
+
+    def incr(self, uid: str, msg_count: int = 0, free_count: int = 0) -> None:
+        key = self._key(uid)
+        pipe = self.r.pipeline(transaction=False)
+        if msg_count:
+            pipe.hincrby(key, "msg_count", msg_count)
+        if free_count:
+            pipe.hincrby(key, "free_count", free_count)
+        pipe.execute()
+
+    def update(self, uid: str, **fields) -> None:
+        self._check_fields(fields)
+        if not fields:
+            return
+        mapping = {k: "" if v is None else v for k, v in fields.items()}
+        key = self._key(uid)
+        if "paid_until" not in fields and "is_paid" not in fields:
+            self.r.hset(key, mapping=mapping)
+            return
+
+        def write(pipe, old: UserRow) -> None:
+            new = old._replace(**{k: v for k, v in fields.items() if k in old._fields})
+            pipe.hset(key, mapping=mapping)
+            if new.is_paid and new.paid_until:
+                pipe.sadd(self._expiring_key(new.paid_until), key)
+
+        self._transact(key, write)
+
+    def extend_membership(
+        self, uid: str, days: int, today: datetime.date, trade_no: str | None = None
+    ) -> str | None:
+        key = self._key(uid)
+        trade_key = f"{self.prefix}trade:{trade_no}" if trade_no is not None else None
+        self.get_user(uid)
+        result = []
+
+        def write(pipe, old: UserRow) -> None:
+            new_until = extend_from(old.paid_until, days, today)
+            pipe.hset(key, mapping={"is_paid": 1, "paid_until": new_until})
+            pipe.sadd(self._expiring_key(new_until), key)
+            if trade_key:
+                pipe.set(trade_key, uid, ex=TRADE_TTL)
+            result.append(new_until)
+
+        # 訂單鍵一起 WATCH：兩台 instance 同時處理同一筆訂單只有一台會成功
+        watch = (trade_key,) if trade_key else ()
+        if not self._transact(key, write, watch=watch):
+            return None  # 這筆訂單已經套用過
+        return result[-1]
+
+    def _transact(self, key: str, write, watch: tuple[str, ...] = ()) -> bool:
+        """Run ``write(pipe, old_row)`` in WATCH/MULTI, keeping the expiry index.
+
+        Extra ``watch`` keys must not exist yet; if any does, nothing is
+        written and ``False`` is returned.
+        """
+        from redis import WatchError
+
+        while True:
+            with self.r.pipeline() as pipe:
+                try:
+                    pipe.watch(key, *watch)
+                    if watch and pipe.exists(*watch):
+                        pipe.unwatch()
+                        return False
+                    old = self._decode(pipe.hgetall(key))
+                    pipe.multi()
+                    if old.paid_until:
+                        pipe.srem(self._expiring_key(old.paid_until), key)
+                    write(pipe, old)
+                    pipe.execute()
+                    return True
+                except WatchError:
+                    continue  # 其他 instance 同時修改 → 重試
+
+    def users_expiring(self, date: str) -> list[tuple[str, str, str]]:
+        keys = [k.decode() for k in self.r.smembers(self._expiring_key(date))]
+        uids = [k[len(self._key("")) :] for k in keys]
+        return [
+            (uid, row.paid_until, row.persona)
+            for uid, row in self.get_users(uids).items()
+            if row.is_paid and row.paid_until == date
+        ]
+
+    def push_settings(self, uid: str) -> tuple[str | None, bool]:
+        tz, opt_out = self.r.hmget(self._key(uid), "timezone", "push_opt_out")
+        return (tz.decode() if tz else None, bool(opt_out) and opt_out != b"0")
+
+    def push_settings_many(
+        self, uids: Iterable[str]
+    ) -> dict[str, tuple[str | None, bool]]:
+        uids = list(uids)
+        pipe = self.r.pipeline(transaction=False)
+        for uid in uids:
+            pipe.exists(self._key(uid))
+            pipe.hmget(self._key(uid), "timezone", "push_opt_out")
+        replies = pipe.execute()
+        return {
+            uid: (tz.decode() if tz else None, bool(opt_out) and opt_out != b"0")
+            for uid, exists, (tz, opt_out) in zip(uids, replies[::2], replies[1::2])
+            if exists
+        }
+
+    def push_recipients(
+        self, batch: int = 500
+    ) -> Iterator[list[tuple[str, str | None]]]:
+        start = len(self._key(""))
+        keys: list[bytes] = []
+        for key in self.r.scan_iter(match=self._key("*"), count=batch):
+            keys.append(key)
+            if len(keys) >= batch:
+                yield self._prefs(keys, start)
+                keys = []
+        if keys:
+            yield self._prefs(keys, start)
+
+    def _prefs(self, keys: list[bytes], start: int) -> list[tuple[str, str | None]]:
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, "timezone", "push_opt_out")
+        return [
+            (key.decode()[start:], tz.decode() if tz else None)
+            for key, (tz, opt_out) in zip(keys, pipe.execute())
+            if not opt_out or opt_out == b"0"
+        ]
+
+
+def make_store(
+    backend: str,
+    conn: sqlite3.Connection | None,
+    redis_url: str | None,
+    free_quota: int,
+    default_persona: str,
+) -> UserStore:
+    if backend == "redis":
+        if not redis_url:
+            raise EnvironmentError("STORAGE_BACKEND=redis 需要設定 REDIS_URL")
+        return RedisUserStore.from_url(redis_url, free_quota, default_persona)
+    if backend == "sqlite":
+        return SQLiteUserStore(conn, free_quota, default_persona)
+    raise ValueError(f"unknown storage backend: {backend!r}")
+
+
+__all__ = [
+    "RedisUserStore",
+    "SQLiteUserStore",
+    "UserRow",
+    "UserStore",
+    "extend_from",
+    "is_expired",
+    "make_store",
+]
@@ -0,0 +1,115 @@
+"""Fixtures that run the real ``main`` module with its upstreams stubbed.
+
+``main`` builds everything at import time (SQLite files in the working
+directory, the LINE webhook handler, the scheduler), so it is imported
+once per session inside a scratch directory, with the configuration set
+before :mod:`config` is read.  Tests reach it through ``/callback`` or the
+LINE handlers; only calls that would leave the process are replaced.
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import importlib
+import json
+import os
+import sys
+import time
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+CHANNEL_SECRET = "test-channel-secret"
+APP_ENV = {
+    "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+    "LINE_ACCESS_TOKEN": "test-access-token",
+    "STORAGE_BACKEND": "sqlite",
+    "LEADER_BACKEND": "sqlite",
+    "SCHEDULER_JOBSTORE_URL": "",
+    "TRACE_EXPORT_PATH": "",
+    "TRACE_SLOW_LOG": "",
+    "PREFETCH_LEAD": "0",
+    "OPENAI_HEDGE_AFTER": "0",
+}
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """The ``main`` module, imported in a scratch directory."""
+    with pytest.MonkeyPatch.context() as mp:
+        for name, value in APP_ENV.items():
+            mp.setenv(name, value)
+        mp.chdir(tmp_path_factory.mktemp("app"))
+        if "config" in sys.modules:
+            importlib.reload(sys.modules["config"])
+        try:
+            import main
+        except ModuleNotFoundError as exc:
+            pytest.skip(f"main needs {exc.name}")
+    yield main
+    main.line.close()
+
+
+@pytest.fixture
+def sent(app, monkeypatch):
+    """Stub LINE replies and OpenAI; returns the ``(uid, parts)`` replied."""
+    out = []
+    monkeypatch.setattr(
+        app, "respond", lambda e, *parts: out.append((e.source.user_id, parts))
+    )
+    monkeypatch.setattr(app, "ask_openai", lambda text, persona, model=None: "好呀")
+    monkeypatch.setattr(app, "response_cache", None)
+    return out
+
+
+def text_event(uid: str, text: str) -> dict:
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": uid},
+        "webhookEventId": uuid.uuid4().hex.upper()[:26],
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "message": {
+            "type": "text",
+            "id": str(uuid.uuid4().int)[:15],
+            "quoteToken": uuid.uuid4().hex,
+            "text": text,
+        },
+    }
+
+
+def signed(*events: dict) -> tuple[bytes, dict]:
+    """Webhook body and headers as LINE would send them."""
+    body = json.dumps(
+        {"destination": "Utest", "events": list(events)}, ensure_ascii=False
+    ).encode()
+    digest = hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()
+    return body, {"x-line-signature": base64.b64encode(digest).decode()}
+
+
+def client(app):
+    """HTTP client for the app; handler errors come back as 500 responses."""
+    import httpx
+
+    transport = httpx.ASGITransport(app=app.app, raise_app_exceptions=False)
+    return httpx.AsyncClient(transport=transport, base_url="http://test")
+
+
+async def post_webhook(c, *events: dict):
+    body, headers = signed(*events)
+    return await c.post("/callback", content=body, headers=headers)
+
+
+def deliver(app, *events: dict):
+    """POST ``events`` to ``/callback`` and wait for the handler to finish."""
+
+    async def run():
+        async with client(app) as c:
+            return await post_webhook(c, *events)
+
+    return asyncio.run(run())
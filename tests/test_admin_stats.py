@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from admin_stats import UserStats, authorized, redis_snapshot, sqlite_snapshot
+from storage import RedisUserStore, SQLiteUserStore, UserRow
+
+USERS_SQL = """
+CREATE TABLE users(
+    user_id TEXT PRIMARY KEY,
+    msg_count     INT DEFAULT 0,
+    is_paid       INT DEFAULT 0,
+    free_count    INT DEFAULT 10,
+    paid_until    TEXT,
+    persona       TEXT DEFAULT 'rina',
+    group_personas TEXT,
+    timezone      TEXT,
+    push_opt_out  INT DEFAULT 0
+);
+"""
+
+
+def sqlite_setup():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    conn.execute(USERS_SQL)
+    store = SQLiteUserStore(conn, free_quota=10, default_persona="rina")
+    return store, lambda: sqlite_snapshot(conn, 3)
+
+
+def redis_setup():
+    fakeredis = pytest.importorskip("fakeredis")
+    store = RedisUserStore(fakeredis.FakeRedis(), free_quota=10, default_persona="rina")
+    return store, lambda: redis_snapshot(store, 3, batch=2)
+
+
+@pytest.fixture(params=[sqlite_setup, redis_setup], ids=["sqlite", "redis"])
+def setup(request):
+    return request.param()
+
+
+def test_reconcile_counts_users_by_persona_and_state(setup):
+    store, snapshot = setup
+    for uid in ("u1", "u2", "u3", "u4"):
+        store.get_user(uid)
+    store.update("u2", persona="sora", is_paid=1)
+    store.incr("u3", msg_count=8, free_count=-8)  # 剩 2 → near_quota
+    store.incr("u4", msg_count=1, free_count=-10)  # 用完
+
+    stats = UserStats(snapshot)
+    stats.reconcile()
+    view = stats.view()
+    assert view["users"] == 4
+    assert view["personas"]["rina"] == {
+        "paid": 0, "free": 1, "near_quota": 1, "exhausted": 1
+    }
+    assert view["personas"]["sora"]["paid"] == 1
+    assert view["messages"] == {"rina": 9}
+    assert stats.drift == 4  # 從空的計數器開始
+
+
+def test_events_update_counters_between_reconciliations(setup):
+    store, snapshot = setup
+    store.get_user("u1")
+    stats = UserStats(snapshot)
+    stats.reconcile()
+
+    before = store.get_user("u1")
+    store.update("u1", persona="mika")
+    after = before._replace(persona="mika")
+    stats.update(before, after)
+    stats.message("mika")
+    paid = after._replace(is_paid=1)
+    store.update("u1", is_paid=1)
+    stats.update(after, paid)
+    view = stats.view()
+    assert view["personas"] == {
+        "mika": {"paid": 1, "free": 0, "near_quota": 0, "exhausted": 0}
+    }
+    assert view["messages"] == {"mika": 1}
+
+    # 事件與資料庫一致 → 對帳沒有誤差
+    store.incr("u1", msg_count=1)
+    stats.reconcile()
+    assert stats.drift == 0
+    assert stats.view()["personas"]["mika"]["paid"] == 1
+
+
+def test_authorized_requires_exact_bearer_token():
+    assert authorized("Bearer s3cret", "s3cret")
+    assert not authorized("Bearer s3cre", "s3cret")
+    assert not authorized("s3cret", "s3cret")
+    assert not authorized(None, "s3cret")
+    assert not authorized("Bearer ", "")  # 沒設定 token → 一律拒絕
+
+
+def test_changes_during_reconcile_are_kept():
+    free = UserRow(0, 0, 10, None, "rina", None)
+    paid = free._replace(is_paid=1)
+    stats = None
+
+    def snapshot():
+        # 查詢進行中有人付款；查詢結果還看不到這筆變動
+        stats.update(free, paid)
+        return [("rina", "free", 1, 0)]
+
+    stats = UserStats(snapshot)
+    stats.reconcile()
+    assert stats.view()["personas"]["rina"]["paid"] == 1
+    assert stats.view()["totals"]["free"] == 0
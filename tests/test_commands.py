@@ -0,0 +1,18 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from commands import COMMAND_TYPES, classify_command
+
+
+def test_every_prefix_is_classified():
+    for prefix, name in COMMAND_TYPES:
+        assert classify_command(prefix) == name
+        assert classify_command(f"{prefix} 參數") == name
+
+
+def test_chat_and_unknown_commands():
+    assert classify_command("早安") == "chat"
+    assert classify_command("") == "chat"
+    assert classify_command("/未知指令") == "chat"
+    assert classify_command("我想 /help") == "chat"
@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from conftest import deliver, text_event
+from dedup import DedupStore, RedisDedupStore
+
+
+def test_claim_rejects_redelivery_and_survives_restart(tmp_path):
+    db = tmp_path / "dedup.db"
+    store = DedupStore(sqlite3.connect(db), "line")
+    assert store.claim("evt-1")
+    assert not store.claim("evt-1")
+    assert store.claim("evt-2")
+
+    # 重新啟動：記憶體清空，仍應由 SQLite 擋下
+    restarted = DedupStore(sqlite3.connect(db), "line")
+    assert not restarted.claim("evt-1")
+    # 不同 namespace 互不影響
+    assert DedupStore(sqlite3.connect(db), "ecpay").claim("evt-1")
+
+
+def test_release_and_expiry():
+    conn = sqlite3.connect(":memory:")
+    store = DedupStore(conn, "ecpay", ttl=60)
+    assert store.claim("T1")
+    store.release("T1")
+    assert store.claim("T1")
+
+    conn.execute("UPDATE dedup_keys SET seen_at = seen_at - 3600")
+    store._recent.clear()
+    assert store.claim("T1")
+    assert store.claim("")  # 沒有事件 ID 時不去重
+
+
+def test_redis_store_shared_between_instances():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    a, b = RedisDedupStore(client, "line"), RedisDedupStore(client, "line")
+    assert a.claim("evt-1")
+    assert not b.claim("evt-1")
+    b.release("evt-1")
+    assert a.claim("evt-1")
+
+
+def test_failed_event_is_processed_on_redelivery(app, sent, monkeypatch):
+    real_get_user = app.get_user
+    failures = [sqlite3.OperationalError("database is locked")]
+
+    def flaky_get_user(uid):
+        if failures:
+            raise failures.pop()
+        return real_get_user(uid)
+
+    monkeypatch.setattr(app, "get_user", flaky_get_user)
+    uid = "Uredelivery" + os.urandom(4).hex()
+    event = text_event(uid, "在嗎")
+    assert deliver(app, event).status_code == 500
+    assert sent == []
+    # LINE 重送同一個 webhookEventId：這次要處理
+    assert deliver(app, event).status_code == 200
+    assert [u for u, _ in sent] == [uid]
+    # 處理成功後的重送才是重複事件
+    assert deliver(app, event).status_code == 200
+    assert len(sent) == 1
@@ -24,3 +24,30 @@ def test_generate_check_mac_value():
         )
         == expected
     )
+
+
+def test_signer_matches_reference_implementation():
+    key, iv = "5294y06JbISpM5x9", "v77hoKGq4kWxNNIS"
+    signer = payment_gateway.EcpaySigner(key, iv)
+    params = {
+        "MerchantID": "2000132",
+        "MerchantTradeNo": "ecpay2015",
+        "MerchantTradeDate": "2015/05/21 13:25:59",
+        "PaymentType": "aio",
+        "TotalAmount": "1000",
+        "TradeDesc": "test",
+        "ItemName": "寵物名牌",
+        "ReturnURL": "http://192.168.0.1",
+        "ChoosePayment": "Credit",
+    }
+    assert signer.sign(params) == "C9DCDD1C7477467E75C87D19ADADF99B"
+
+    orders = [
+        {**params, "MerchantTradeNo": f"T{i}", "ItemName": name, "TotalAmount": i}
+        for i, name in enumerate(["戀人正式包(30日)", "a b+c&d=e", "~'%/?#", "ÄÖ"])
+    ]
+    orders.append({**params, "CheckMacValue": "IGNORED", "CustomField1": "U1"})
+    expected = [payment_gateway.generate_check_mac_value(o, key, iv) for o in orders]
+    assert signer.sign_many(orders) == expected
+    assert signer.verify({**orders[0], "CheckMacValue": expected[0].lower()})
+    assert not signer.verify({**orders[0], "CheckMacValue": expected[1]})
@@ -0,0 +1,34 @@
+import io
+import os
+import sys
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from image_variants import PREVIEW_SIZE, make_variants
+
+
+def png(size=768):
+    buf = io.BytesIO()
+    Image.new("RGBA", (size, size), (255, 128, 0, 255)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def test_variants_are_jpeg_and_preview_is_small():
+    source = png()
+    variants = make_variants(source)
+    with Image.open(io.BytesIO(variants.original)) as original:
+        assert original.format == "JPEG"
+        assert original.size == (768, 768)
+    with Image.open(io.BytesIO(variants.preview)) as preview:
+        assert preview.format == "JPEG"
+        assert max(preview.size) == PREVIEW_SIZE
+    assert len(variants.preview) < len(variants.original)
+
+
+def test_keys_are_deterministic():
+    source = png()
+    assert make_variants(source).digest == make_variants(source).digest
+    assert make_variants(source).digest != make_variants(png(512)).digest
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import leader
+from leader import FileLockBackend, LeaderElector, SQLiteLeaseBackend
+
+
+def test_sqlite_lease_single_holder_and_expiry(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(leader.time, "time", lambda: now[0])
+    a = SQLiteLeaseBackend(str(tmp_path / "leader.db"))
+    b = SQLiteLeaseBackend(str(tmp_path / "leader.db"))
+    assert a.acquire("scheduler", "node-a", ttl=30)
+    assert not b.acquire("scheduler", "node-b", ttl=30)
+    now[0] += 20
+    assert a.acquire("scheduler", "node-a", ttl=30)  # 續約
+    now[0] += 40  # node-a 沒再續約 → 過期
+    assert b.acquire("scheduler", "node-b", ttl=30)
+    assert not a.acquire("scheduler", "node-a", ttl=30)
+    b.release("scheduler", "node-b")
+    assert a.acquire("scheduler", "node-a", ttl=30)
+
+
+def test_file_lock_backend(tmp_path):
+    a, b = FileLockBackend(str(tmp_path)), FileLockBackend(str(tmp_path))
+    assert a.acquire("scheduler", "a", 30)
+    assert not b.acquire("scheduler", "b", 30)
+    a.release("scheduler", "a")
+    assert b.acquire("scheduler", "b", 30)
+
+
+def test_elector_callbacks_and_leader_only(tmp_path):
+    events = []
+    backend = SQLiteLeaseBackend(str(tmp_path / "leader.db"))
+    first = LeaderElector(backend, ttl=30, on_elected=lambda: events.append("up"))
+    second = LeaderElector(backend, ttl=30)
+    job = second.leader_only(lambda: events.append("job"))
+
+    first.start()
+    second.start()
+    assert first.is_leader and not second.is_leader
+    job()
+    first.stop()
+    second._tick()
+    assert second.is_leader
+    job()
+    second.stop()
+    assert events == ["up", "job"]
+
+
+def test_redis_lease_backend():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")  # fakeredis 需要 lupa 執行 Lua script
+    from leader import RedisLeaseBackend
+
+    client = fakeredis.FakeRedis()
+    a, b = RedisLeaseBackend(client), RedisLeaseBackend(client)
+    assert a.acquire("scheduler", "node-a", ttl=30)
+    assert not b.acquire("scheduler", "node-b", ttl=30)
+    assert a.acquire("scheduler", "node-a", ttl=30)
+    b.release("scheduler", "node-b")  # 非持有者釋放無效
+    assert not b.acquire("scheduler", "node-b", ttl=30)
+    a.release("scheduler", "node-a")
+    assert b.acquire("scheduler", "node-b", ttl=30)
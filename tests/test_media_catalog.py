@@ -0,0 +1,70 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from media_catalog import MediaCatalog, RedisMediaCatalog, media_key, sweep
+
+DAY = 24 * 60 * 60
+NOW = 1_715_000_000.0  # 2024-05-06 UTC
+
+
+def sqlite_catalog():
+    return MediaCatalog(sqlite3.connect(":memory:", check_same_thread=False))
+
+
+def redis_catalog():
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisMediaCatalog(fakeredis.FakeRedis())
+
+
+@pytest.fixture(params=[sqlite_catalog, redis_catalog], ids=["sqlite", "redis"])
+def make_catalog(request):
+    return request.param
+
+
+def test_keys_are_kind_and_date_prefixed():
+    assert media_key("image", "abc", "jpg", NOW) == "image/2024/05/06/abc.jpg"
+
+
+def test_find_reuses_content_and_refreshes_access(make_catalog):
+    catalog = make_catalog()
+    catalog.record("image/a.jpg", "U1", "image", 10, "h1", now=NOW - 40 * DAY)
+    assert catalog.find("image", "h1", now=NOW) == "image/a.jpg"
+    assert catalog.find("audio", "h1", now=NOW) is None
+    assert catalog.expired("image", NOW - 30 * DAY) == []
+
+
+def test_sweep_deletes_in_batches_and_keeps_failures(make_catalog):
+    catalog = make_catalog()
+    for i in range(25):
+        catalog.record(f"image/{i:02}.jpg", "U1", "image", 10, now=NOW - 40 * DAY)
+    catalog.record("image/new.jpg", "U1", "image", 10, now=NOW)
+    catalog.record("audio/old.mp3", "U1", "audio", 10, now=NOW - 40 * DAY)
+    requests = []
+
+    def delete(keys):
+        requests.append(len(keys))
+        return ["image/03.jpg"] if "image/03.jpg" in keys else []
+
+    retention = {"image": 30 * DAY, "audio": 0}
+    assert sweep(catalog, delete, retention, now=NOW, batch=10) == 9
+    assert requests == [10]  # 有失敗的鍵 → 這一種類留待下次
+    assert sweep(catalog, lambda keys: [], retention, now=NOW, batch=10) == 16
+    assert catalog.expired("image", NOW + 1) == ["image/new.jpg"]
+    assert catalog.expired("audio", NOW) == ["audio/old.mp3"]  # 0 = 永久保留
+
+
+def test_redis_catalog_is_shared_between_instances():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    follower, leader = RedisMediaCatalog(client), RedisMediaCatalog(client)
+    follower.record("image/a.jpg", "U1", "image", 10, "h1", now=NOW - 40 * DAY)
+    follower.record("image/a.jpg", "U1", "image", 10, "h1", now=NOW - 35 * DAY)
+    assert leader.find("image", "h1", now=NOW - 31 * DAY) == "image/a.jpg"
+    assert sweep(leader, lambda keys: [], {"image": 30 * DAY}, now=NOW) == 1
+    # 清理後內容索引與物件資料也一併移除
+    assert follower.find("image", "h1", now=NOW) is None
+    assert client.keys("laigf:media:*") == []
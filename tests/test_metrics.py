@@ -0,0 +1,44 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import metrics
+
+
+def test_histogram_render_is_cumulative():
+    hist = metrics.Histogram("test_latency_seconds", "test", ("op",), buckets=(0.1, 1))
+    child = hist.labels("get")
+    assert hist.labels("get") is child  # 同一組 label 共用 child
+    for v in (0.05, 0.5, 5):
+        child.observe(v)
+
+    text = metrics.render()
+    assert '# TYPE test_latency_seconds histogram' in text
+    assert 'test_latency_seconds_bucket{op="get",le="0.1"} 1' in text
+    assert 'test_latency_seconds_bucket{op="get",le="1"} 2' in text
+    assert 'test_latency_seconds_bucket{op="get",le="+Inf"} 3' in text
+    assert 'test_latency_seconds_count{op="get"} 3' in text
+
+
+def test_timed_and_gauges():
+    hist = metrics.Histogram("test_job_seconds", "test", ("job",))
+
+    @metrics.timed(hist, "noop")
+    def job():
+        return 42
+
+    assert job() == 42
+    metrics.Gauge("test_depth", "test", lambda: {("q",): 3}, ("queue",))
+    text = metrics.render()
+    assert 'test_job_seconds_count{job="noop"} 1' in text
+    assert 'test_depth{queue="q"} 3.0' in text
+
+
+def test_observe_upstream_uses_request_labels():
+    token = metrics.request_labels.set(("image", "rina"))
+    try:
+        metrics.observe_upstream("replicate", 1.5, True)
+    finally:
+        metrics.request_labels.reset(token)
+    child = metrics.UPSTREAM_SECONDS.labels("replicate", "ok", "image", "rina")
+    assert child.stats[1] == 1
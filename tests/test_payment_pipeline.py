@@ -0,0 +1,129 @@
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import payment_pipeline
+import tracing
+from payment_gateway import EcpaySigner, generate_check_mac_value
+from payment_pipeline import PaymentPipeline
+
+HASH_KEY, HASH_IV = "5294y06JbISpM5x9", "v77hoKGq4kWxNNIS"
+
+
+def form(trade_no="T1", **extra):
+    params = {
+        "MerchantTradeNo": trade_no,
+        "RtnCode": "1",
+        "TradeAmt": "99",
+        "CustomField1": "U1",
+        **extra,
+    }
+    params["CheckMacValue"] = generate_check_mac_value(params, HASH_KEY, HASH_IV)
+    return params
+
+
+def test_verify_check_mac_value():
+    signer = EcpaySigner(HASH_KEY, HASH_IV)
+    params = form()
+    assert signer.verify(params)
+    assert signer.verify({**params, "CheckMacValue": params["CheckMacValue"].lower()})
+    assert not signer.verify({**params, "TradeAmt": "579"})
+    assert not signer.verify({"MerchantTradeNo": "T1"})
+
+
+def test_enqueue_is_idempotent_and_worker_applies_once(tmp_path):
+    applied, pushed = [], []
+
+    def apply(f):
+        applied.append(f["MerchantTradeNo"])
+        return "已開通" if f["RtnCode"] == "1" else None
+
+    pipeline = PaymentPipeline(
+        str(tmp_path / "p.db"), apply, lambda uid, text: pushed.append((uid, text))
+    )
+    assert pipeline.enqueue(form("T1"))
+    assert not pipeline.enqueue(form("T1"))  # ECPay 重送
+    assert pipeline.enqueue(form("T2", RtnCode="10100058"))
+    assert pipeline.pending() == 2
+
+    assert pipeline.process_pending() == 2
+    assert pipeline.process_pending() == 0
+    assert applied == ["T1", "T2"]
+    assert pushed == [("U1", "已開通")]
+    assert pipeline.status("T1") == "applied"
+    assert pipeline.status("T2") == "ignored"
+
+
+def test_success_replaces_earlier_unsuccessful_notification(tmp_path):
+    applied = []
+
+    def apply(f):
+        applied.append(f["RtnCode"])
+        return "已開通" if f["RtnCode"] == "1" else None
+
+    pipeline = PaymentPipeline(str(tmp_path / "p.db"), apply, lambda uid, text: None)
+    assert pipeline.enqueue(form("T1", RtnCode="10100058"))
+    pipeline.process_pending()
+    assert pipeline.status("T1") == "ignored"
+
+    assert pipeline.enqueue(form("T1"))  # 之後才付款成功
+    assert not pipeline.enqueue(form("T1", RtnCode="10100058"))  # 不會被蓋回去
+    assert pipeline.process_pending() == 1
+    assert applied == ["10100058", "1"]
+    assert pipeline.status("T1") == "applied"
+    assert not pipeline.enqueue(form("T1"))
+
+
+def test_failed_apply_is_retried_then_given_up(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(payment_pipeline.time, "time", lambda: now[0])
+    calls = []
+
+    def apply(f):
+        calls.append(1)
+        raise RuntimeError("db down")
+
+    pipeline = PaymentPipeline(
+        str(tmp_path / "p.db"), apply, lambda *a: None, max_attempts=2, backoff=10
+    )
+    pipeline.enqueue(form("T1"))
+    pipeline.process_pending()
+    pipeline.process_pending()  # 還在 backoff
+    assert len(calls) == 1 and pipeline.status("T1") == "pending"
+    now[0] += 11
+    pipeline.process_pending()
+    assert len(calls) == 2 and pipeline.status("T1") == "failed"
+
+
+def test_worker_thread_wakes_on_enqueue(tmp_path):
+    done = threading.Event()
+    pipeline = PaymentPipeline(
+        str(tmp_path / "p.db"), lambda f: "ok", lambda *a: done.set(), poll=30
+    )
+    pipeline.start()
+    try:
+        pipeline.enqueue(form("T9"))
+        assert done.wait(5)
+    finally:
+        pipeline.stop()
+
+
+def test_activation_is_traced_for_the_slow_log(tmp_path):
+    slow = tmp_path / "slow.jsonl"
+    tracing.configure(0.0, None, slow_threshold_ms=0, slow_path=str(slow))
+    try:
+        pipeline = PaymentPipeline(str(tmp_path / "p.db"), lambda f: "ok", lambda *a: 0)
+        pipeline.enqueue(form("T7"))
+        pipeline.process_pending()
+        end = time.time() + 2
+        while time.time() < end and not (slow.exists() and slow.read_text()):
+            time.sleep(0.01)
+        (trace,) = [json.loads(line) for line in slow.read_text().splitlines()]
+    finally:
+        tracing.configure(0.0, None, slow_threshold_ms=1e9)
+    names = [s["name"] for s in trace["spans"]]
+    assert names[0] == "job.payment"
+    assert {"payment.apply", "payment.notify"} <= set(names)
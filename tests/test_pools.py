@@ -0,0 +1,40 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from pools import CountingPool
+
+
+def test_pending_counts_tasks_not_yet_started():
+    pool = CountingPool(1)
+    gate = threading.Event()
+    started = threading.Event()
+
+    def blocked():
+        started.set()
+        gate.wait(2)
+
+    try:
+        running = pool.submit(blocked)
+        started.wait(1)
+        queued = [pool.submit(lambda i=i: i) for i in range(3)]
+        assert pool.pending() == 3
+        assert queued[0].cancel()
+        assert pool.pending() == 2
+    finally:
+        gate.set()
+    running.result(1)
+    assert [f.result(1) for f in queued[1:]] == [1, 2]
+    assert pool.pending() == 0
+    pool.shutdown()
+
+
+def test_submit_after_shutdown_does_not_count():
+    pool = CountingPool(1)
+    pool.shutdown()
+    try:
+        pool.submit(lambda: None)
+    except RuntimeError:
+        pass
+    assert pool.pending() == 0
@@ -0,0 +1,80 @@
+import datetime
+import os
+import sqlite3
+import sys
+import threading
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from prefetch import PrefetchStage
+from push_scheduler import PushScheduler, Slot
+from response_cache import SMALL_TALK, ResponseCache
+
+TAIPEI = pytz.timezone("Asia/Taipei")
+MORNING = Slot(
+    "morning", 7, 30, 1800, ["早安☀️"], replies=("早安", "吃了", "這不是寒暄嗎")
+)
+
+
+def at(hour, minute, day=1):
+    return TAIPEI.localize(datetime.datetime(2024, 5, day, hour, minute)).timestamp()
+
+
+def make_stage(cache, leader=True):
+    calls = []
+    lock = threading.Lock()
+
+    def generate(prompt, persona):
+        with lock:
+            calls.append((prompt, persona))
+            n = len(calls)
+        return f"{persona}:{prompt[:4]}:{n}"
+
+    stage = PrefetchStage(
+        generate, [MORNING], ["rina", "sora"], cache, TAIPEI,
+        lead=300, linger=600, size=3, openers=lambda: leader,
+    )
+    return stage, calls
+
+
+def test_fills_replies_and_openers_only_within_lead():
+    cache = ResponseCache(phrases=SMALL_TALK + ("吃了",))
+    stage, calls = make_stage(cache)
+    assert stage.run_once(at(7, 20)) == 0  # 還沒到 lead
+    # 2 個可快取的回應 + 開場白，各 3 份 × 2 個角色
+    assert stage.run_once(at(7, 26)) == 18
+    assert stage.run_once(at(7, 27)) == 0  # 同一天只做一次
+    assert len(calls) == 18
+
+    # 尖峰時直接命中快取（不必先累積 variants 次上游回覆）
+    assert cache.get("sora", cache.key("吃了～")).startswith("sora:吃了")
+    assert stage.opener("morning", "rina", now=at(7, 40)).startswith("rina:")
+    # 時段結束 + linger 之後開場白失效
+    assert stage.opener("morning", "rina", now=at(8, 11)) is None
+    stage.stop()
+
+
+def test_followers_skip_openers():
+    cache = ResponseCache(phrases=SMALL_TALK + ("吃了",))
+    stage, calls = make_stage(cache, leader=False)
+    assert stage.run_once(at(7, 45)) == 12  # 時段開始後才啟動也補做
+    assert stage.opener("morning", "rina", now=at(7, 46)) is None
+    stage.stop()
+
+
+def test_tick_sends_one_text_per_composed_group():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    sent = []
+
+    def compose(slot, uids):
+        return [(f"hi {uid[-1]}", [uid]) for uid in uids]
+
+    push = PushScheduler(
+        conn, lambda: iter([[("U1", None), ("U2", None)]]),
+        lambda uids, text: sent.append((uids, text)),
+        [MORNING], default_tz=TAIPEI, compose=compose,
+    )
+    push.backfill(TAIPEI.localize(datetime.datetime(2024, 5, 1, 0, 0)))
+    assert push.tick(at(8, 10)) == 2
+    assert sorted(sent) == [(["U1"], "hi 1"), (["U2"], "hi 2")]
@@ -0,0 +1,130 @@
+import datetime
+import os
+import sqlite3
+import sys
+
+import pytest
+
+pytz = pytest.importorskip("pytz")
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from push_scheduler import PushScheduler, Slot, jitter, next_due
+
+TAIPEI = pytz.timezone("Asia/Taipei")
+MORNING = Slot("morning", 7, 30, 2700, ["早安"])
+
+
+def test_jitter_is_stable_and_spread():
+    day = datetime.date(2024, 5, 1)
+    assert jitter("U1", MORNING, day) == jitter("U1", MORNING, day + datetime.timedelta(1))
+    offsets = {jitter(f"U{i}", MORNING, day) for i in range(1000)}
+    assert len(offsets) > 500
+    assert min(offsets) < 300 and max(offsets) > 2400
+    daily = Slot("random", 9, 0, 3600, ["hi"], daily_jitter=True)
+    assert len({jitter("U1", daily, day + datetime.timedelta(d)) for d in range(5)}) > 1
+
+
+def test_next_due_uses_user_timezone():
+    now = TAIPEI.localize(datetime.datetime(2024, 5, 1, 12, 0))
+    due = next_due("U1", MORNING, TAIPEI, now)
+    assert due.astimezone(TAIPEI).date() == datetime.date(2024, 5, 2)
+    tokyo = next_due("U1", MORNING, pytz.timezone("Asia/Tokyo"), now)
+    assert due - tokyo == datetime.timedelta(hours=1)
+
+
+def test_backfill_and_tick_group_by_slot():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    users = [[("U1", None), ("U2", "Asia/Tokyo")], [("U3", "Not/AZone")]]
+    sent = []
+    push = PushScheduler(
+        conn, lambda: iter(users), lambda uids, text: sent.append((uids, text)),
+        [MORNING], default_tz=TAIPEI, max_late=4 * 3600,
+    )
+    now = TAIPEI.localize(datetime.datetime(2024, 5, 1, 0, 0))
+    assert push.backfill(now) == 3
+    assert push.backfill(now) == 0  # 已排入的不重複
+    assert push.tick(now.timestamp()) == 0
+
+    push.forget("U3")
+    morning_end = TAIPEI.localize(datetime.datetime(2024, 5, 1, 8, 15))
+    assert push.tick(morning_end.timestamp()) == 2
+    assert len(sent) == 1 and sorted(sent[0][0]) == ["U1", "U2"]
+    # 送出後排入隔天，同一天不會再送
+    assert push.pending() == 2
+    assert push.tick(morning_end.timestamp() + 3600) == 0
+    next_morning = TAIPEI.localize(datetime.datetime(2024, 5, 2, 8, 15))
+    assert push.tick(next_morning.timestamp()) == 2
+
+
+def test_tick_drops_stale_pushes():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    sent = []
+    push = PushScheduler(
+        conn, lambda: iter([[("U1", None)]]), lambda uids, text: sent.append(uids),
+        [MORNING], default_tz=TAIPEI, max_late=600,
+    )
+    now = TAIPEI.localize(datetime.datetime(2024, 5, 1, 0, 0))
+    push.backfill(now)
+    push.tick(now.timestamp() + 86400)
+    assert sent == [] and push.pending() == 1  # 跳過，排下一次
+
+
+def test_failed_chunk_is_retried_with_backoff():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    calls = []
+
+    def send(uids, text):
+        calls.append(uids)
+        if len(calls) == 1:
+            raise RuntimeError("LINE 500")
+
+    push = PushScheduler(
+        conn, lambda: iter([]), send, [MORNING], default_tz=TAIPEI, backoff=60
+    )
+    now = TAIPEI.localize(datetime.datetime(2024, 5, 1, 0, 0))
+    push.schedule("U1", None, now)
+    due = conn.execute("SELECT due_at FROM push_queue").fetchone()[0]
+    assert push.tick(due) == 0
+    assert push.tick(due + 30) == 0  # 還在 backoff
+    assert push.tick(due + 60) == 1
+    assert calls == [["U1"], ["U1"]]
+
+
+def test_schedule_replaces_rows_on_timezone_change():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    push = PushScheduler(
+        conn, lambda: iter([]), lambda *a: None, [MORNING], default_tz=TAIPEI
+    )
+    now = TAIPEI.localize(datetime.datetime(2024, 5, 1, 0, 0))
+    push.schedule("U1", None, now)
+    before = conn.execute("SELECT due_at FROM push_queue").fetchone()[0]
+    push.schedule("U1", "Asia/Tokyo", now)
+    (after, tz_name), = conn.execute("SELECT due_at, timezone FROM push_queue")
+    assert before - after == 3600 and tz_name == "Asia/Tokyo"
+
+
+def test_tick_rechecks_settings_changed_on_other_instances():
+    # 佇列在 leader；使用者在別台停用推播、改時區，只會寫進共用的 store
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    settings = {"U1": (None, False), "U2": (None, False), "U3": (None, False)}
+    sent = []
+    push = PushScheduler(
+        conn,
+        lambda: iter([[(uid, None) for uid in settings]]),
+        lambda uids, text: sent.extend(uids),
+        [MORNING],
+        default_tz=TAIPEI,
+        settings=lambda uids: {uid: settings[uid] for uid in uids},
+    )
+    now = TAIPEI.localize(datetime.datetime(2024, 5, 1, 0, 0))
+    push.backfill(now)
+    settings["U2"] = (None, True)
+    settings["U3"] = ("America/New_York", False)
+    end = TAIPEI.localize(datetime.datetime(2024, 5, 1, 8, 15)).timestamp()
+    assert push.tick(end) == 1
+    assert sent == ["U1"]
+    rows = dict(conn.execute("SELECT user_id, timezone FROM push_queue"))
+    assert rows == {"U1": None, "U3": "America/New_York"}
+    (due,) = conn.execute("SELECT due_at FROM push_queue WHERE user_id = 'U3'")
+    after = datetime.datetime.fromtimestamp(end, pytz.utc)
+    expected = next_due("U3", MORNING, pytz.timezone("America/New_York"), after)
+    assert due[0] == int(expected.timestamp()) > end
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import sys
+import threading
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import pytest
+
+import rate_limit
+from conftest import client, deliver, post_webhook, text_event
+from rate_limit import LoadGovernor, RateLimiter, parse_limits
+
+
+def test_parse_limits_overrides_defaults():
+    limits = parse_limits("paid.chat=5/10, vip.image=1/60")
+    assert limits["paid"]["chat"] == (5, 10)
+    assert limits["vip"]["image"] == (1, 60)
+    assert limits["free"] == rate_limit.DEFAULT_LIMITS["free"]
+    with pytest.raises(ValueError):
+        parse_limits("paid.chat=5")
+
+
+def test_token_bucket_refills(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    limiter = RateLimiter({"free": {"image": (2, 60)}})
+    assert limiter.allow("u1", "image")
+    assert limiter.allow("u1", "image")
+    assert not limiter.allow("u1", "image")
+    assert limiter.retry_after("u1", "image") == 31
+    assert limiter.allow("u2", "image")  # 其他使用者不受影響
+    assert limiter.allow("u1", "chat")  # 未設定的指令不限制
+    now[0] += 30
+    assert limiter.allow("u1", "image")
+    assert not limiter.allow("u1", "image")
+
+
+def test_load_governor_levels(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    gov = LoadGovernor(
+        degrade_inflight=1, text_only_inflight=2, max_inflight=3, degrade_latency=5
+    )
+    assert gov.level() == LoadGovernor.NORMAL
+    gov.observe("chat", 6)
+    assert gov.level() == LoadGovernor.DEGRADED
+    now[0] += 120  # 舊樣本過期
+    assert gov.level() == LoadGovernor.NORMAL
+    with gov.slot(), gov.slot(), gov.slot(), gov.slot():
+        assert gov.level() == LoadGovernor.SHED
+    assert gov.inflight == 0
+
+
+def test_shed_webhooks_keep_the_users_chat_token(app, sent, monkeypatch):
+    # 走真正的 /callback → webhook thread pool → on_text：上游卡住時後到的請求被卸載
+    gov = LoadGovernor(degrade_inflight=1, text_only_inflight=2, max_inflight=3)
+    monkeypatch.setattr(app, "load_governor", gov)
+    monkeypatch.setattr(app, "rate_limiter", RateLimiter({"free": {"chat": (1, 3600)}}))
+    gate = threading.Event()
+    waiting = []
+
+    def slow_answer(text, persona, model=None):
+        waiting.append(text)
+        gate.wait(5)
+        return "好呀"
+
+    monkeypatch.setattr(app, "ask_openai", slow_answer)
+    run = uuid.uuid4().hex[:8]
+    held = [f"Uheld{run}{i}" for i in range(3)]
+    shed = [f"Ushed{run}{i}" for i in range(2)]
+
+    async def burst():
+        async with client(app) as c:
+            first = [
+                asyncio.create_task(post_webhook(c, text_event(u, "在嗎")))
+                for u in held
+            ]
+            for _ in range(500):
+                if len(waiting) == len(held):
+                    break
+                await asyncio.sleep(0.01)
+            later = [post_webhook(c, text_event(u, "在嗎")) for u in shed]
+            done = await asyncio.gather(*later)
+            gate.set()
+            return done + await asyncio.gather(*first)
+
+    assert all(r.status_code == 200 for r in asyncio.run(burst()))
+    replies = {uid: parts for uid, parts in sent}
+    assert all("塞車" in replies[u][0] for u in shed)
+    assert all("好呀" in replies[u][0] for u in held)
+    assert gov.inflight == 0
+
+    # 被卸載的訊息沒有用掉唯一的 token：負載恢復後照常回覆
+    monkeypatch.setattr(app, "load_governor", LoadGovernor())
+    sent.clear()
+    deliver(app, *(text_event(u, "在嗎") for u in shed))
+    assert sorted(uid for uid, _ in sent) == sorted(shed)
+    assert all("好呀" in parts[0] for _, parts in sent)
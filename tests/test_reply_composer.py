@@ -0,0 +1,71 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from reply_composer import compose, pack, split_text, text_length
+
+
+def test_split_text_prefers_sentence_boundaries():
+    text = "早安！今天天氣很好。" * 3
+    assert split_text(text) == [text]
+    chunks = split_text(text, limit=12)
+    assert chunks == ["早安！今天天氣很好。", "早安！今天天氣很好。", "早安！今天天氣很好。"]
+    assert "".join(chunks) == text
+
+
+def test_split_text_hard_cuts_and_counts_emoji_as_two():
+    assert split_text("a" * 25, limit=10) == ["a" * 10, "a" * 10, "a" * 5]
+    chunks = split_text("🥺" * 7, limit=5)
+    assert all(text_length(c) <= 5 for c in chunks)
+    assert "".join(chunks) == "🥺" * 7
+
+
+def test_compose_and_pack():
+    image = object()
+    messages = compose(["嗨～", "", "長" * 12, image], lambda t: ("text", t))
+    assert messages[0] == ("text", "嗨～")
+    assert messages[-1] is image
+    assert len(messages) == 3
+
+    batches = pack(list(range(12)))
+    assert [len(b) for b in batches] == [5, 5, 2]
+
+
+def test_client_pushes_overflow_and_rejected_replies():
+    pytest.importorskip("linebot.v3.messaging")
+    from linebot.v3.messaging.exceptions import ApiException
+
+    from line_client import LineClient
+
+    class FakeApi:
+        def __init__(self, reject=False):
+            self.reject = reject
+            self.calls = []
+
+        def reply_message(self, req):
+            if self.reject:
+                exc = ApiException(status=400, reason="Bad Request")
+                exc.body = f'{{"message": "{self.reject}"}}'
+                raise exc
+            self.calls.append(("reply", len(req.messages)))
+
+        def push_message(self, req):
+            self.calls.append(("push", len(req.messages)))
+
+    client = LineClient("token", workers=2)
+    client.api = FakeApi()
+    client.reply("r1", [f"角色{i}" for i in range(7)], to="U1").result()
+    assert client.api.calls == [("reply", 5), ("push", 2)]
+
+    client.api = FakeApi(reject="Invalid reply token")
+    client.reply("r2", ["嗨"], to="U1").result()
+    assert client.api.calls == [("push", 1)]
+
+    # 訊息本身有錯 → 不要再 push 一次
+    client.api = FakeApi(reject="The request body has 1 error(s)")
+    with pytest.raises(ApiException):
+        client.reply("r3", ["嗨"], to="U1").result()
+    assert client.api.calls == []
+    client.close()
@@ -0,0 +1,119 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(status_code)
+        self.status_code = status_code
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(resilience, "breakers", {})
+    monkeypatch.setattr(resilience, "retry_budget", resilience.RetryBudget())
+    monkeypatch.setattr(resilience.time, "sleep", lambda s: None)
+
+
+def test_breaker_opens_and_half_opens(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("x", failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+    now[0] = 11
+    assert breaker.allow() and breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # 只放行一個探測請求
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_call_retries_transient_then_fails_fast():
+    calls = []
+
+    def flaky(timeout):
+        calls.append(timeout)
+        raise HTTPError(503)
+
+    resilience.get_breaker("up").failure_threshold = 2
+    with pytest.raises(HTTPError):
+        resilience.call("up", flaky, timeout=5, retries=1)
+    assert len(calls) == 2
+    assert resilience.breaker_states() == {"up": "open"}
+    with pytest.raises(CircuitOpenError):
+        resilience.call("up", flaky, timeout=5)
+    assert len(calls) == 2
+
+
+def test_client_errors_are_not_retried():
+    calls = []
+
+    def bad_request(timeout):
+        calls.append(timeout)
+        raise HTTPError(400)
+
+    with pytest.raises(HTTPError):
+        resilience.call("up", bad_request, timeout=5, retries=3)
+    assert len(calls) == 1
+    assert resilience.breaker_states()["up"] == "closed"
+
+
+def test_deadline_clamps_timeout():
+    seen = []
+    with resilience.deadline(2):
+        resilience.call("up", seen.append, timeout=20)
+        assert seen[0] <= 2
+    with resilience.deadline(0):
+        with pytest.raises(DeadlineExceeded):
+            resilience.call("up", seen.append, timeout=20)
+
+
+def test_hedged_call_returns_fastest():
+    attempts = []
+    release = threading.Event()
+
+    def slow_first(timeout):
+        attempts.append(timeout)
+        if len(attempts) == 1:
+            release.wait(2)
+            return "slow"
+        return "fast"
+
+    try:
+        assert resilience._hedged(slow_first, 2, 0.05) == "fast"
+    finally:
+        release.set()
+    assert len(attempts) == 2
+
+
+def test_configure_sizes_hedge_pool(monkeypatch):
+    monkeypatch.setattr(resilience, "_hedge_pool", resilience._hedge_pool)
+    resilience.configure(1)
+    gate = threading.Event()
+    started = threading.Event()
+
+    def blocked(timeout):
+        started.set()
+        gate.wait(2)
+        return "late"
+
+    try:
+        first = resilience._hedge_pool.submit(blocked, 1)
+        started.wait(1)
+        queued = resilience._hedge_pool.submit(lambda: "next")
+        assert resilience.pending() == 1
+    finally:
+        gate.set()
+    assert first.result(1) == "late"
+    assert queued.result(1) == "next"
+    assert resilience.pending() == 0
+    resilience._hedge_pool.shutdown()
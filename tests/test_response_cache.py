@@ -0,0 +1,63 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import response_cache
+from response_cache import ResponseCache, normalize
+
+
+def test_normalize():
+    assert normalize("早安～～!!") == "早安"
+    assert normalize(" 在 嗎？") == "在嗎"
+    assert normalize("ＨＩ 😊") == "hi"
+    assert normalize("晚安安安安") == "晚安"
+    assert normalize("哈哈") == "哈哈"
+    assert normalize("今天好累喔～") == normalize("今天好累哦") == "今天好累"
+    assert normalize("妳好") == "你好"
+
+
+def test_only_small_talk_is_cacheable():
+    cache = ResponseCache()
+    for text in ("早安寶貝!", "在不在？", "你好嗎", "今天好累喔", "晚安安安", "hi~"):
+        assert cache.key(text) is not None, text
+    for text in ("明天要考試", "早安可以教我微積分嗎", "你叫什麼名字", "想你媽媽了"):
+        assert cache.key(text) is None, text
+
+
+def test_collects_variants_then_hits():
+    cache = ResponseCache(variants=2)
+    cache.similarity = False  # 只測完全比對
+    key = cache.key("早安!")
+    assert cache.get("rina", key) is None
+    cache.put("rina", key, "早安呀")
+    assert cache.get("rina", key) is None  # 還在收集第二種回覆
+    cache.put("rina", key, "早安～吃早餐了嗎")
+    assert cache.get("rina", cache.key("早安")) in ("早安呀", "早安～吃早餐了嗎")
+    assert cache.get("sora", key) is None  # 不同角色各自快取
+
+
+def test_bypass_long_text_and_lru_and_ttl(monkeypatch):
+    cache = ResponseCache(max_entries=2, variants=1, ttl=10, max_len=4)
+    assert cache.key("今天我也好累了啦") is None
+    for text in ("早安", "午安", "晚安"):
+        cache.put("rina", cache.key(text), text)
+    assert len(cache) == 2
+    assert cache.get("rina", "早安") is None  # 最舊的被淘汰
+    assert cache.get("rina", "晚安") == "晚安"
+
+    now = [response_cache.time.monotonic() + 11]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    assert cache.get("rina", "晚安") is None
+
+
+def test_similar_messages_share_an_entry():
+    pytest.importorskip("numpy")
+    cache = ResponseCache(variants=1)  # 預設門檻
+    cache.put("rina", cache.key("今天好累喔"), "辛苦了")
+    assert cache.get("rina", cache.key("今天好累哦")) == "辛苦了"
+    cache.put("rina", cache.key("早安寶貝"), "早安～")
+    assert cache.get("rina", cache.key("寶貝早安")) == "早安～"  # 相似度比對
+    assert cache.get("rina", cache.key("好無聊")) is None
+    assert cache.get("rina", cache.key("午安")) is None
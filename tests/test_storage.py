@@ -0,0 +1,127 @@
+import datetime
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from storage import (
+    RedisUserStore,
+    SQLiteUserStore,
+    UserRow,
+    extend_from,
+    is_expired,
+)
+
+TODAY = datetime.date(2024, 5, 1)
+USERS_SQL = """
+CREATE TABLE users(
+    user_id TEXT PRIMARY KEY,
+    msg_count     INT DEFAULT 0,
+    is_paid       INT DEFAULT 0,
+    free_count    INT DEFAULT 10,
+    paid_until    TEXT,
+    persona       TEXT DEFAULT 'rina',
+    group_personas TEXT,
+    timezone      TEXT,
+    push_opt_out  INT DEFAULT 0
+);
+"""
+
+
+def sqlite_store():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    conn.execute(USERS_SQL)
+    return SQLiteUserStore(conn, free_quota=10, default_persona="rina")
+
+
+def redis_store():
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisUserStore(fakeredis.FakeRedis(), free_quota=10, default_persona="rina")
+
+
+@pytest.fixture(params=[sqlite_store, redis_store], ids=["sqlite", "redis"])
+def store(request):
+    return request.param()
+
+
+def test_extend_from():
+    assert extend_from(None, 3, TODAY) == "2024-05-04"
+    assert extend_from("2024-04-01", 3, TODAY) == "2024-05-04"  # 已過期從今天算
+    assert extend_from("2024-05-10", 3, TODAY) == "2024-05-13"
+
+
+def test_is_expired():
+    assert not is_expired(None, TODAY)
+    assert not is_expired("", TODAY)
+    assert not is_expired("2024-05-01", TODAY)  # 到期日當天仍有效
+    assert is_expired("2024-04-30", TODAY)
+
+
+def test_get_user_creates_with_free_quota(store):
+    assert store.get_user("u1") == UserRow(0, 0, 10, None, "rina", None)
+    store.incr("u1", msg_count=1, free_count=-1)
+    store.incr("u1", msg_count=1)
+    assert store.get_user("u1")[:3] == (2, 0, 9)
+
+
+def test_update_and_batch_read(store):
+    store.get_user("u1")
+    store.get_user("u2")
+    store.update("u1", persona="sora", group_personas="rina,sora")
+    store.update("u1", group_personas=None)
+    users = store.get_users(["u1", "u2", "missing"])
+    assert set(users) == {"u1", "u2"}
+    assert users["u1"].persona == "sora"
+    assert users["u1"].group_personas is None
+    with pytest.raises(ValueError):
+        store.update("u1", free_count=99)
+
+
+def test_membership_and_expiry_index(store):
+    assert store.extend_membership("u1", 3, TODAY) == "2024-05-04"
+    assert store.extend_membership("u1", 1, TODAY) == "2024-05-05"
+    assert store.users_expiring("2024-05-04") == []
+    assert store.users_expiring("2024-05-05") == [("u1", "2024-05-05", "rina")]
+    store.update("u1", is_paid=0)
+    assert store.users_expiring("2024-05-05") == []
+
+
+def test_membership_applies_each_trade_once(store):
+    assert store.extend_membership("u1", 3, TODAY, trade_no="T1") == "2024-05-04"
+    assert store.extend_membership("u1", 3, TODAY, trade_no="T1") is None
+    assert store.extend_membership("u1", 1, TODAY, trade_no="T2") == "2024-05-05"
+    assert store.get_user("u1").paid_until == "2024-05-05"
+
+
+def test_failed_extension_does_not_claim_trade():
+    store = sqlite_store()
+    store.get_user("u1")
+    # users 的更新失敗 → 訂單紀錄也要撤回，重試時才能再套用
+    store.conn.execute(
+        "CREATE TRIGGER boom BEFORE UPDATE OF paid_until ON users "
+        "BEGIN SELECT RAISE(ABORT, 'disk full'); END"
+    )
+    with pytest.raises(sqlite3.DatabaseError):
+        store.extend_membership("u1", 3, TODAY, trade_no="T1")
+    store.conn.execute("DROP TRIGGER boom")
+    assert store.extend_membership("u1", 3, TODAY, trade_no="T1") == "2024-05-04"
+
+
+def test_push_recipients_skip_opted_out(store):
+    for i in range(5):
+        store.get_user(f"u{i}")
+    store.update("u1", timezone="Asia/Tokyo")
+    store.update("u2", push_opt_out=1)
+    batches = list(store.push_recipients(batch=2))
+    rows = dict(r for batch in batches for r in batch)
+    assert sorted(rows) == ["u0", "u1", "u3", "u4"]
+    assert rows["u1"] == "Asia/Tokyo" and rows["u0"] is None
+    assert store.push_settings("u1") == ("Asia/Tokyo", False)
+    assert store.push_settings("u2") == (None, True)
+    assert store.push_settings_many(["u1", "u2", "u3", "nobody"]) == {
+        "u1": ("Asia/Tokyo", False),
+        "u2": (None, True),
+        "u3": (None, False),
+    }
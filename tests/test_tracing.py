@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import tracing
+
+
+def read_lines(path, timeout=2.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        if path.exists() and path.read_text().strip():
+            return [json.loads(line) for line in path.read_text().splitlines()]
+        time.sleep(0.01)
+    return []
+
+
+def test_sampled_trace_exports_span_tree(tmp_path):
+    out = tmp_path / "traces.jsonl"
+    tracing.configure(1.0, str(out), slow_threshold_ms=1e9)
+    with tracing.start_trace("callback"):
+        with tracing.span("process", command="chat"):
+            tracing.annotate(persona="rina")
+            tracing.record("upstream.openai", 0.2, ok=False)
+    assert tracing.current_trace_id() is None
+
+    (trace,) = read_lines(out)
+    names = {s["name"]: s for s in trace["spans"]}
+    assert names["process"]["parent"] == names["callback"]["id"]
+    assert names["process"]["attrs"] == {"command": "chat", "persona": "rina"}
+    assert names["upstream.openai"]["attrs"] == {"error": True}
+    assert names["upstream.openai"]["ms"] == 200.0
+
+
+def test_slow_unsampled_trace_waits_for_background_reply(tmp_path):
+    slow = tmp_path / "slow.jsonl"
+    tracing.configure(0.0, None, slow_threshold_ms=0, slow_path=str(slow))
+
+    async def reply():
+        await asyncio.sleep(0)
+        with tracing.span("line.reply"):
+            pass
+
+    async def main():
+        with tracing.start_trace("callback"):
+            task = asyncio.create_task(tracing.hold_async(reply()))
+        await task
+
+    asyncio.run(main())
+    (trace,) = read_lines(slow)
+    assert [s["name"] for s in trace["spans"]] == ["callback", "line.reply"]
+
+
+def test_span_outside_trace_is_noop():
+    with tracing.span("orphan") as s:
+        assert s is None
+    tracing.record("upstream.r2", 0.1)
+
+
+def test_span_ids_unique_across_threads():
+    def work(i):
+        for _ in range(500):
+            with tracing.span("chunk", index=i):
+                pass
+
+    # 頻繁切換執行緒，讓同一個 trace 的 span 真的同時建立
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with tracing.start_trace("asr") as root:
+            with ThreadPoolExecutor(8) as pool:
+                for f in [pool.submit(tracing.wrap(work), i) for i in range(8)]:
+                    f.result()
+    finally:
+        sys.setswitchinterval(interval)
+    ids = [s.span_id for s in root.trace.spans]
+    assert len(ids) == len(set(ids)) == 1 + 8 * 500
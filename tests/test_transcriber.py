@@ -0,0 +1,75 @@
+import io
+import os
+import sys
+import threading
+
+import pytest
+
+pytest.importorskip("pydub")
+from pydub import AudioSegment
+from pydub.generators import Sine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import transcriber
+from transcriber import AudioTooLong, Transcriber, split_points, stitch
+
+
+def wav(audio: AudioSegment) -> bytes:
+    buf = io.BytesIO()
+    audio.export(buf, format="wav")
+    return buf.getvalue()
+
+
+def speech(ms: int) -> AudioSegment:
+    return Sine(440).to_audio_segment(duration=ms, volume=-10).set_channels(2)
+
+
+def test_stitch_spaces_only_between_latin_words():
+    assert stitch(["今天好累", " 想睡了 ", ""]) == "今天好累想睡了"
+    assert stitch(["see you", "tomorrow", "晚安"]) == "see you tomorrow晚安"
+
+
+def test_split_points_prefer_quiet_spots():
+    # 第 9 秒有 200ms 的停頓 → 在停頓處切，而不是硬切在 10 秒
+    audio = speech(9_000) + AudioSegment.silent(200) + speech(6_000)
+    cuts = split_points(audio, chunk_ms=10_000)
+    assert len(cuts) == 1
+    assert 9_000 <= cuts[0] <= 9_200
+
+
+def test_transcribe_trims_chunks_and_stitches_in_order(monkeypatch):
+    monkeypatch.setattr(transcriber, "UPLOAD_FORMAT", "wav")
+    seen = []
+    lock = threading.Lock()
+
+    def fake_whisper(data, filename):
+        chunk = AudioSegment.from_file(io.BytesIO(data), format="wav")
+        with lock:
+            seen.append((filename, chunk.channels, chunk.frame_rate, len(chunk)))
+        return f"[{filename.split('.')[0]}]"
+
+    asr = Transcriber(fake_whisper, workers=2, chunk_seconds=4, max_seconds=20)
+    clip = AudioSegment.silent(2_000) + speech(10_000) + AudioSegment.silent(2_000)
+    assert asr.transcribe(wav(clip), "wav") == "[0][1][2]"
+    assert {(ch, rate) for _, ch, rate, _ in seen} == {(1, 16_000)}
+    # 前後的靜音被剪掉 → 只剩約 10 秒
+    assert 9_900 <= sum(ms for *_, ms in seen) <= 10_100
+
+    with pytest.raises(AudioTooLong):
+        asr.transcribe(wav(speech(21_000)), "wav")
+    assert asr.transcribe(wav(AudioSegment.silent(3_000)), "wav") == ""
+    asr.close()
+
+
+def test_submit_is_bounded():
+    gate = threading.Event()
+    asr = Transcriber(lambda data, name: "", workers=1, max_queue=1)
+    running = asr.submit(gate.wait)
+    # worker 被佔住：一個可以排隊，第二個回 None
+    while asr.pending():
+        pass
+    assert asr.submit(gate.wait) is not None
+    assert asr.submit(gate.wait) is None
+    gate.set()
+    running.result()
+    asr.close()
@@ -0,0 +1,142 @@
+import contextvars
+import datetime
+import os
+import sqlite3
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import usage_ledger
+from conftest import deliver, text_event
+from usage_ledger import (
+    ALL_USERS,
+    MonthlyUsage,
+    RedisUsageBackend,
+    SQLiteUsageBackend,
+    UsageLedger,
+)
+
+UTC = datetime.timezone.utc
+MAY = datetime.datetime(2024, 5, 10, tzinfo=UTC).timestamp()
+
+
+def make_ledger(path, **kwargs):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    return UsageLedger(SQLiteUsageBackend(conn), tz=UTC, **kwargs)
+
+
+def sqlite_backend(tmp_path):
+    return SQLiteUsageBackend(sqlite3.connect(tmp_path / "u.db"))
+
+
+def redis_backend(tmp_path):
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisUsageBackend(fakeredis.FakeRedis())
+
+
+@pytest.fixture(params=[sqlite_backend, redis_backend], ids=["sqlite", "redis"])
+def backend(request, tmp_path):
+    return request.param(tmp_path)
+
+
+def test_metered_collects_usage_from_any_thread(backend):
+    ledger = UsageLedger(backend, tz=UTC)
+    with ledger.metered("U1"):
+        usage_ledger.count_message()
+        usage_ledger.add("openai", tokens=60)
+        usage_ledger.observe_upstream("openai", 0.5, True)
+        # resilience 的對沖請求在其他執行緒（複製的 context）回報
+        ctx = contextvars.copy_context()
+        t = threading.Thread(
+            target=ctx.run, args=(usage_ledger.add, "openai"), kwargs={"tokens": 40}
+        )
+        t.start()
+        t.join()
+    usage_ledger.add("openai", tokens=999)  # metered 之外 → 忽略
+
+    assert ledger.monthly("U1") == MonthlyUsage(messages=1, tokens=100)
+    assert ledger.monthly(ALL_USERS).tokens == 100
+
+
+def test_only_counted_events_are_messages(backend):
+    # 回覆快取命中不會呼叫上游，但仍是一則訊息；指令、拒絕的回覆不計
+    ledger = UsageLedger(backend, tz=UTC)
+    for counted in (True, False, True, True):
+        with ledger.metered("U1"):
+            if counted:
+                usage_ledger.count_message()
+                usage_ledger.count_message()  # 同一事件只算一則
+    assert ledger.monthly("U1") == MonthlyUsage(messages=3)
+    ledger.flush()
+    assert UsageLedger(backend, tz=UTC).monthly("U1") == MonthlyUsage(messages=3)
+
+
+def test_shared_backend_sees_other_instances(tmp_path):
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    a = UsageLedger(RedisUsageBackend(client), tz=UTC, flush_every=0)
+    b = UsageLedger(RedisUsageBackend(client), tz=UTC, flush_every=0)
+    tally = usage_ledger.Tally()
+    tally.count_message()
+    tally.add("openai", calls=1, tokens=30)
+    a.record("U1", tally, ts=MAY)
+    assert b.monthly("U1", "2024-05") == MonthlyUsage()
+    a.flush()
+    assert b.monthly("U1", "2024-05") == MonthlyUsage(1, 30)
+    assert b.monthly(ALL_USERS, "2024-05") == MonthlyUsage(1, 30)
+
+
+def test_flush_batches_and_rollups_survive_restart(tmp_path):
+    ledger = make_ledger(tmp_path / "u.db", flush_size=3)
+    for uid in ("U1", "U2"):
+        tally = usage_ledger.Tally()
+        tally.count_message()
+        tally.add("replicate", calls=1, images=1, latency=4.2)
+        tally.add("elevenlabs", calls=1, tts_chars=12)
+        ledger.record(uid, tally, ts=MAY)
+    # 第二筆觸發 flush（4 個事件 ≥ 3）
+    conn = ledger.backend.conn
+    assert conn.execute("SELECT COUNT(*) FROM usage_events").fetchone()[0] == 4
+
+    tally = usage_ledger.Tally()
+    tally.count_message()
+    tally.add("openai", calls=1, tokens=30)
+    ledger.record("U1", tally, ts=MAY)
+    assert ledger.monthly("U1", "2024-05") == MonthlyUsage(2, 30, 1, 12)
+    ledger.stop()
+
+    reopened = make_ledger(tmp_path / "u.db")
+    assert reopened.monthly("U1", "2024-05") == MonthlyUsage(2, 30, 1, 12)
+    assert reopened.monthly(ALL_USERS, "2024-05") == MonthlyUsage(3, 30, 2, 24)
+    assert reopened.monthly("U1", "2024-06") == MonthlyUsage()
+
+
+def test_evicted_cache_entries_include_unflushed_usage(tmp_path):
+    ledger = make_ledger(tmp_path / "u.db", max_cached=1)
+    for uid in ("U1", "U2", "U3"):
+        tally = usage_ledger.Tally()
+        tally.add("openai", calls=1, tokens=10)
+        ledger.record(uid, tally, ts=MAY)
+    assert ledger.monthly("U1", "2024-05").tokens == 10
+
+
+def test_sqlite_workers_see_each_others_usage(tmp_path):
+    # uvicorn --workers N：每個 worker 各有一個 ledger，共用同一個檔案
+    a = make_ledger(tmp_path / "u.db", flush_every=0)
+    b = make_ledger(tmp_path / "u.db", flush_every=0)
+    assert b.monthly("U1", "2024-05") == MonthlyUsage()
+    tally = usage_ledger.Tally()
+    tally.count_message()
+    a.record("U1", tally, ts=MAY)
+    a.flush()
+    assert b.monthly("U1", "2024-05") == MonthlyUsage(messages=1)
+
+
+def test_only_chat_replies_count_toward_month_limit(app, sent):
+    uid = "U" + "36" * 16
+    for text in ("/help", "/狀態查詢", "早安"):
+        assert deliver(app, text_event(uid, text)).status_code == 200
+    assert len(sent) == 3
+    assert app.ledger.monthly(uid).messages == 1
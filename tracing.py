@@ -0,0 +1,271 @@
+"""Lightweight span tracing for the webhook → process() pipeline.
+
+A trace is started for each ``/callback`` request (and each scheduler job or
+payment activation) with :func:`start_trace`; code inside opens child spans
+with :func:`span` or :func:`traced`.  The active span lives in a
+:mod:`contextvars` variable, so it follows ``asyncio.create_task``
+automatically and threads via :func:`wrap`.  Work handed off with
+:func:`wrap` or :func:`hold_async` keeps the trace open, so a background
+reply or image job is exported as part of the event that started it.
+
+Every trace is recorded in memory (a handful of small objects), then:
+
+* head-sampled traces (``sample_rate``) are written to a JSON-lines file, and
+* any trace slower than ``slow_ms`` is written, whole, to the slow log
+  regardless of sampling.
+
+Writes happen on a background thread so exporting never blocks a request.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import functools
+import itertools
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+_current: contextvars.ContextVar["Span | None"] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+sample_rate = 0.0
+slow_ms = 3000.0
+_export_path: str | None = None
+_slow_path: str | None = None
+_queue: "queue.SimpleQueue[tuple[str, str]]" = queue.SimpleQueue()
+_writer: threading.Thread | None = None
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "spans", "pending", "ids", "_lock")
+
+    def __init__(self, sampled: bool) -> None:
+        self.trace_id = uuid.uuid4().hex
+        self.sampled = sampled
+        self.spans: list[Span] = []
+        # 1 for the root span plus one per handed-off background job
+        self.pending = 1
+        # span id：wrap 之後同一個 trace 的 span 可能在多個執行緒同時建立
+        self.ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def hold(self) -> None:
+        with self._lock:
+            self.pending += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self.pending -= 1
+            done = self.pending == 0
+        if done:
+            _export(self, self.spans[0])
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "duration", "attrs")
+
+    def __init__(self, trace: Trace, name: str, parent: "Span | None", attrs) -> None:
+        self.trace = trace
+        self.name = name
+        self.span_id = next(trace.ids)
+        self.parent_id = parent.span_id if parent else 0
+        self.start = time.time()
+        self.duration = 0.0
+        self.attrs = attrs
+        trace.spans.append(self)
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "ms": round(self.duration * 1000, 3),
+            **({"attrs": self.attrs} if self.attrs else {}),
+        }
+
+
+def configure(
+    rate: float,
+    export_path: str | None = None,
+    slow_threshold_ms: float = 3000.0,
+    slow_path: str | None = None,
+) -> None:
+    """Set sampling and output files; start the writer thread if needed."""
+    global sample_rate, slow_ms, _export_path, _slow_path, _writer
+    sample_rate = rate
+    slow_ms = slow_threshold_ms
+    _export_path = export_path or None
+    _slow_path = slow_path or None
+    if _writer is None and (_export_path or _slow_path):
+        _writer = threading.Thread(target=_write_loop, name="trace-writer", daemon=True)
+        _writer.start()
+
+
+def _write_loop() -> None:
+    while True:
+        path, line = _queue.get()
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError:
+            logging.exception("trace export to %s failed", path)
+
+
+def _export(trace: Trace, root: Span) -> None:
+    # 以最後結束的 span 計算整體耗時（含背景工作）
+    end = max(s.start + s.duration for s in trace.spans)
+    root.duration = max(root.duration, end - root.start)
+    slow = root.duration * 1000 >= slow_ms
+    if not (trace.sampled and _export_path) and not slow:
+        return
+    line = json.dumps(
+        {
+            "trace_id": trace.trace_id,
+            "name": root.name,
+            "ms": round(root.duration * 1000, 3),
+            "spans": [s.as_dict() for s in trace.spans],
+        },
+        ensure_ascii=False,
+    )
+    if trace.sampled and _export_path:
+        _queue.put((_export_path, line))
+    if slow:
+        logging.warning(
+            "slow trace %s %s %.0fms", trace.trace_id, root.name, root.duration * 1000
+        )
+        if _slow_path:
+            _queue.put((_slow_path, line))
+
+
+@contextmanager
+def _enter(trace: Trace, name: str, parent: "Span | None", attrs: dict):
+    s = Span(trace, name, parent, attrs)
+    token = _current.set(s)
+    start = time.perf_counter()
+    try:
+        yield s
+    except BaseException as exc:
+        s.attrs["error"] = type(exc).__name__
+        raise
+    finally:
+        s.duration = time.perf_counter() - start
+        _current.reset(token)
+
+
+@contextmanager
+def start_trace(name: str, **attrs):
+    """Start a new trace (or a child span if one is already active)."""
+    if _current.get() is not None:
+        with span(name, **attrs) as s:
+            yield s
+        return
+    trace = Trace(random.random() < sample_rate)
+    try:
+        with _enter(trace, name, None, attrs) as root:
+            yield root
+    finally:
+        trace.release()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Open a child span; a no-op outside a trace."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    with _enter(parent.trace, name, parent, attrs) as s:
+        yield s
+
+
+def record(name: str, seconds: float, ok: bool = True) -> None:
+    """Add an already finished span (e.g. from a resilience observer)."""
+    parent = _current.get()
+    if parent is None:
+        return
+    s = Span(parent.trace, name, parent, {} if ok else {"error": True})
+    s.start -= seconds
+    s.duration = seconds
+
+
+def annotate(**attrs) -> None:
+    """Attach attributes to the active span."""
+    s = _current.get()
+    if s is not None:
+        s.attrs.update(attrs)
+
+
+def current_trace_id() -> str | None:
+    s = _current.get()
+    return s.trace.trace_id if s else None
+
+
+def traced(name: str, root: bool = False):
+    """Decorator running the function inside a span (or a new trace if ``root``)."""
+
+    def decorator(func):
+        opener = start_trace if root else span
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with opener(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def wrap(func):
+    """Bind ``func`` to the current context so it can run on another thread."""
+    ctx = contextvars.copy_context()
+    parent = _current.get()
+    if parent is None:
+        return functools.partial(ctx.run, func)
+    parent.trace.hold()
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        try:
+            return ctx.run(func, *args, **kwargs)
+        finally:
+            parent.trace.release()
+
+    return run
+
+
+def hold_async(coro):
+    """Keep the current trace open until ``coro`` (e.g. a reply task) finishes."""
+    parent = _current.get()
+    if parent is None:
+        return coro
+    parent.trace.hold()
+
+    async def run():
+        try:
+            return await coro
+        finally:
+            parent.trace.release()
+
+    return run()
+
+
+__all__ = [
+    "annotate",
+    "configure",
+    "current_trace_id",
+    "hold_async",
+    "record",
+    "span",
+    "start_trace",
+    "traced",
+    "wrap",
+]
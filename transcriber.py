@@ -0,0 +1,172 @@
+"""Voice-message transcription stage.
+
+Voice messages used to go to Whisper as raw ``.m4a`` from the webhook
+thread, whatever their length and however much silence they held.
+:class:`Transcriber` does the work on its own bounded pool instead.
+
+1. :func:`preprocess` decodes the clip once.  It downmixes and resamples
+   to 16 kHz mono (what Whisper uses internally) and trims leading and
+   trailing silence.
+2. Clips longer than ``max_seconds`` are rejected with :class:`AudioTooLong`.
+3. Clips longer than ``chunk_seconds`` are cut at the quietest point near
+   each boundary (:func:`split_points`).  The chunks are transcribed
+   concurrently and the texts stitched back in order (:func:`stitch`).
+
+Each chunk is uploaded as low-bitrate mono MP3, so requests are a fraction
+of the original size.  Decoding and encoding run in ffmpeg subprocesses
+and resampling in C, so threads are enough for voice-message lengths.
+"""
+
+from __future__ import annotations
+
+import io
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from pydub import AudioSegment
+from pydub.silence import detect_leading_silence
+
+import tracing
+from pools import CountingPool
+
+SAMPLE_RATE = 16_000
+UPLOAD_FORMAT = "mp3"
+UPLOAD_BITRATE = "32k"
+# 切點在邊界前這段範圍內找最安靜的位置（毫秒）
+SEARCH_MS = 2_000
+WINDOW_MS = 50
+
+
+class AudioTooLong(ValueError):
+    """The clip (after trimming silence) is over the configured limit."""
+
+    def __init__(self, seconds: float, limit: float) -> None:
+        super().__init__(f"audio is {seconds:.0f}s, limit {limit:.0f}s")
+        self.seconds = seconds
+        self.limit = limit
+
+
+def preprocess(
+    data: bytes, fmt: str | None = None, silence_thresh: float = -40.0
+) -> AudioSegment:
+    """Decode, downmix to 16 kHz mono and trim silence at both ends."""
+    audio = AudioSegment.from_file(io.BytesIO(data), format=fmt)
+    audio = audio.set_channels(1).set_frame_rate(SAMPLE_RATE)
+    start = detect_leading_silence(audio, silence_threshold=silence_thresh)
+    end = len(audio) - detect_leading_silence(
+        audio.reverse(), silence_threshold=silence_thresh
+    )
+    return audio[start:end] if end > start else audio[:0]
+
+
+def split_points(audio: AudioSegment, chunk_ms: int) -> list[int]:
+    """Cut positions (ms) so that no chunk exceeds ``chunk_ms``.
+
+    Each cut lands on the quietest :data:`WINDOW_MS` window within
+    :data:`SEARCH_MS` before the boundary (the latest one among near
+    ties), so words are rarely split.
+    """
+    cuts = []
+    pos = 0
+    while len(audio) - pos > chunk_ms:
+        limit = pos + chunk_ms
+        lo = max(pos + WINDOW_MS, limit - SEARCH_MS)
+        levels = {
+            t: audio[t : t + WINDOW_MS].rms
+            for t in range(lo, limit - WINDOW_MS + 1, WINDOW_MS)
+        }
+        quiet = min(levels.values(), default=0)
+        # 音量差不多時取最後面的窗，分段不會無謂地變短
+        best = max(
+            (t for t, rms in levels.items() if rms <= quiet * 1.1),
+            default=limit - WINDOW_MS,
+        )
+        cut = best + WINDOW_MS // 2
+        cuts.append(cut)
+        pos = cut
+    return cuts
+
+
+def stitch(parts: list[str]) -> str:
+    """Join chunk transcripts; a space only goes between two Latin words."""
+    out = ""
+    for part in (p.strip() for p in parts):
+        if not part:
+            continue
+        if out and _latin(out[-1]) and _latin(part[0]):
+            out += " "
+        out += part
+    return out
+
+
+def _latin(ch: str) -> bool:
+    return ch.isascii() and ch.isalnum()
+
+
+class Transcriber:
+    """Bounded pool running preprocessing and chunked transcription.
+
+    ``transcribe_chunk(data, filename)`` sends one encoded chunk upstream
+    and returns its text.
+    """
+
+    def __init__(
+        self,
+        transcribe_chunk: Callable[[bytes, str], str],
+        workers: int = 4,
+        max_queue: int = 32,
+        max_seconds: float = 300,
+        chunk_seconds: float = 30,
+        silence_thresh: float = -40.0,
+    ) -> None:
+        self.transcribe_chunk = transcribe_chunk
+        self.max_queue = max_queue
+        self.max_seconds = max_seconds
+        self.chunk_ms = int(chunk_seconds * 1000)
+        self.silence_thresh = silence_thresh
+        self.pool = CountingPool(workers, thread_name_prefix="asr")
+        # 分段請求另開執行緒池：工作在 pool 裡等分段時不會把自己卡死
+        self.chunk_pool = ThreadPoolExecutor(
+            workers * 2, thread_name_prefix="asr-chunk"
+        )
+
+    def submit(self, func, *args) -> Future | None:
+        """Run ``func(*args)`` on the pool; ``None`` when too many are waiting."""
+        if self.pending() >= self.max_queue:
+            return None
+        return self.pool.submit(tracing.wrap(func), *args)
+
+    def pending(self) -> int:
+        return self.pool.pending()
+
+    def transcribe(self, data: bytes, fmt: str | None = None) -> str:
+        """Preprocess ``data`` and return its transcript ("" for pure silence)."""
+        with tracing.span("asr.preprocess", size=len(data)):
+            audio = preprocess(data, fmt, self.silence_thresh)
+        seconds = len(audio) / 1000
+        if seconds > self.max_seconds:
+            raise AudioTooLong(seconds, self.max_seconds)
+        if seconds < 0.3:
+            return ""
+        bounds = [0, *split_points(audio, self.chunk_ms), len(audio)]
+        chunks = [audio[a:b] for a, b in zip(bounds, bounds[1:])]
+        logging.debug("ASR: %.1fs in %d chunk(s)", seconds, len(chunks))
+        futures = [
+            self.chunk_pool.submit(tracing.wrap(self._chunk), chunk, i)
+            for i, chunk in enumerate(chunks)
+        ]
+        return stitch([f.result() for f in futures])
+
+    def _chunk(self, chunk: AudioSegment, index: int) -> str:
+        buf = io.BytesIO()
+        chunk.export(buf, format=UPLOAD_FORMAT, bitrate=UPLOAD_BITRATE)
+        with tracing.span("asr.chunk", index=index, seconds=len(chunk) / 1000):
+            return self.transcribe_chunk(buf.getvalue(), f"{index}.{UPLOAD_FORMAT}")
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+        self.chunk_pool.shutdown(wait=True)
+
+
+__all__ = ["AudioTooLong", "Transcriber", "preprocess", "split_points", "stitch"]
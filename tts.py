@@ -4,6 +4,8 @@ from mutagen.mp3 import MP3
 from pydub import AudioSegment
 
 import config
+import resilience
+import usage_ledger
 
 
 def _change_speed(sound: AudioSegment, speed: float) -> AudioSegment:
@@ -17,7 +19,8 @@ def _change_speed(sound: AudioSegment, speed: float) -> AudioSegment:
 
 def synthesize_speech(text: str):
     """Generate speech using the ElevenLabs API."""
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{config.ELEVENLABS_VOICE_ID or 'nova'}"
+    voice = config.ELEVENLABS_VOICE_ID or "nova"
+    url = f"{config.ELEVENLABS_BASE_URL}/v1/text-to-speech/{voice}"
     headers = {
         "xi-api-key": config.ELEVENLABS_API_KEY,
         "Content-Type": "application/json",
@@ -33,9 +36,14 @@ def synthesize_speech(text: str):
         "style": 0.2,
     },
 }
-    res = requests.post(url, headers=headers, json=payload)
-    res.raise_for_status()
-    audio_bytes = res.content
+
+    def _post(timeout: float) -> bytes:
+        res = requests.post(url, headers=headers, json=payload, timeout=timeout)
+        res.raise_for_status()
+        return res.content
+
+    audio_bytes = resilience.call("elevenlabs", _post, timeout=30)
+    usage_ledger.add("elevenlabs", tts_chars=len(text))
     try:
         audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format="mp3")
         audio = _change_speed(audio, config.TTS_SPEED)
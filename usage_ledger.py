@@ -0,0 +1,390 @@
+"""Per-user, per-upstream usage accounting.
+
+While a message is handled, upstream wrappers report what they consumed with
+:func:`add` (tokens, generated images, TTS characters; latency arrives via a
+:mod:`resilience` observer).  The amounts collect in a :class:`Tally` bound
+to the current context, so the code calling OpenAI or Replicate does not
+need to know which user it is working for.
+
+:meth:`UsageLedger.metered` wraps one webhook event.  The event counts as a
+message only when the handler calls :func:`count_message`: chat replies
+(including ones from the response cache), images and speech do, while
+commands such as ``/help``, refusals and rate-limit replies do not.  At the
+end, the tally becomes usage events and is added to the user's monthly
+totals.  Both are buffered and
+handed to a :class:`UsageBackend` every ``flush_every`` seconds or
+``flush_size`` events:
+
+* :class:`SQLiteUsageBackend` writes the ``usage_events`` and
+  ``usage_monthly`` tables with one ``executemany`` each.  Every worker
+  process on the machine (uvicorn ``--workers N``) shares the file.
+* :class:`RedisUsageBackend` keeps monthly totals in Redis hashes and
+  events in a capped stream.  Several instances then share one monthly
+  limit and one token budget (``STORAGE_BACKEND=redis``).
+
+Monthly totals are cached in memory, so the monthly-limit check and
+``/狀態查詢`` are a dict lookup (one key read on a cold cache) instead of a
+scan.  Cached totals are reloaded after ``flush_every`` seconds to pick up
+the usage other workers or instances flushed to the backend.
+
+The pseudo-user :data:`ALL_USERS` accumulates everyone's usage and drives the
+local token budget guard.
+"""
+
+from __future__ import annotations
+
+import abc
+import contextlib
+import contextvars
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, NamedTuple
+
+CREATE_USAGE_TABLES_SQL = """
+CREATE TABLE IF NOT EXISTS usage_events(
+    ts         INTEGER NOT NULL,
+    user_id    TEXT NOT NULL,
+    upstream   TEXT NOT NULL,
+    calls      INTEGER NOT NULL,
+    tokens     INTEGER NOT NULL,
+    images     INTEGER NOT NULL,
+    tts_chars  INTEGER NOT NULL,
+    latency_ms INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage_monthly(
+    user_id   TEXT NOT NULL,
+    month     TEXT NOT NULL,
+    messages  INTEGER NOT NULL DEFAULT 0,
+    tokens    INTEGER NOT NULL DEFAULT 0,
+    images    INTEGER NOT NULL DEFAULT 0,
+    tts_chars INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(user_id, month)
+) WITHOUT ROWID;
+"""
+
+ALL_USERS = "*"
+
+
+class MonthlyUsage(NamedTuple):
+    messages: int = 0
+    tokens: int = 0
+    images: int = 0
+    tts_chars: int = 0
+
+
+class Tally:
+    """Usage of one event: ``{upstream: [calls, tokens, images, tts_chars, secs]}``."""
+
+    def __init__(self) -> None:
+        self.upstreams: dict[str, list] = {}
+        self.messages = 0
+        self._lock = threading.Lock()  # 對沖請求會從其他執行緒回報
+
+    def add(
+        self,
+        upstream: str,
+        calls: int = 0,
+        tokens: int = 0,
+        images: int = 0,
+        tts_chars: int = 0,
+        latency: float = 0.0,
+    ) -> None:
+        with self._lock:
+            row = self.upstreams.setdefault(upstream, [0, 0, 0, 0, 0.0])
+            row[0] += calls
+            row[1] += tokens
+            row[2] += images
+            row[3] += tts_chars
+            row[4] += latency
+
+    def count_message(self) -> None:
+        """Count this event against the monthly message limit (once)."""
+        self.messages = 1
+
+    def totals(self) -> MonthlyUsage:
+        """Monthly increments of this event: messages plus upstream usage."""
+        with self._lock:
+            rows = list(self.upstreams.values())
+        return MonthlyUsage(
+            self.messages,
+            sum(r[1] for r in rows),
+            sum(r[2] for r in rows),
+            sum(r[3] for r in rows),
+        )
+
+
+_tally: contextvars.ContextVar[Tally | None] = contextvars.ContextVar(
+    "usage_tally", default=None
+)
+
+
+def add(upstream: str, **amounts) -> None:
+    """Report usage for the event being handled (no-op outside :meth:`metered`)."""
+    tally = _tally.get()
+    if tally is not None:
+        tally.add(upstream, **amounts)
+
+
+def count_message() -> None:
+    """Count the current event as a monthly message (no-op outside :meth:`metered`)."""
+    tally = _tally.get()
+    if tally is not None:
+        tally.count_message()
+
+
+def observe_upstream(name: str, seconds: float, ok: bool) -> None:
+    """Observer for :func:`resilience.add_observer`."""
+    add(name, calls=1, latency=seconds)
+
+
+class UsageBackend(abc.ABC):
+    """Where flushed usage goes."""
+
+    #: True when other workers or instances write to the same totals
+    shared = False
+
+    @abc.abstractmethod
+    def load(self, uid: str, month: str) -> list[int] | None:
+        """Stored ``[messages, tokens, images, tts_chars]`` or ``None``."""
+
+    @abc.abstractmethod
+    def write(
+        self, events: list[tuple], deltas: dict[tuple[str, str], list[int]]
+    ) -> None:
+        """Store ``events`` and add ``deltas`` to the monthly totals atomically."""
+
+
+class SQLiteUsageBackend(UsageBackend):
+    """``usage_events`` / ``usage_monthly``; the ledger's lock guards ``conn``."""
+
+    # 同一台機器的多個 worker 共用這個檔案
+    shared = True
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        self.conn.executescript(CREATE_USAGE_TABLES_SQL)
+        self.conn.commit()
+
+    def load(self, uid: str, month: str) -> list[int] | None:
+        row = self.conn.execute(
+            "SELECT messages, tokens, images, tts_chars FROM usage_monthly "
+            "WHERE user_id = ? AND month = ?",
+            (uid, month),
+        ).fetchone()
+        return list(row) if row else None
+
+    def write(
+        self, events: list[tuple], deltas: dict[tuple[str, str], list[int]]
+    ) -> None:
+        try:
+            self.conn.executemany(
+                "INSERT INTO usage_events VALUES(?, ?, ?, ?, ?, ?, ?, ?)", events
+            )
+            self.conn.executemany(
+                """
+                INSERT INTO usage_monthly
+                    (user_id, month, messages, tokens, images, tts_chars)
+                VALUES(?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, month) DO UPDATE SET
+                    messages  = messages  + excluded.messages,
+                    tokens    = tokens    + excluded.tokens,
+                    images    = images    + excluded.images,
+                    tts_chars = tts_chars + excluded.tts_chars
+                """,
+                [(*key, *delta) for key, delta in deltas.items()],
+            )
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+
+
+class RedisUsageBackend(UsageBackend):
+    """Monthly totals in ``<prefix>usage:<month>:<uid>`` hashes.
+
+    Events go to the ``<prefix>usage:events`` stream, trimmed to about
+    ``max_events`` entries.  Monthly hashes expire after ``ttl`` seconds.
+    """
+
+    shared = True
+
+    def __init__(
+        self,
+        client,
+        prefix: str = "laigf:",
+        max_events: int = 1_000_000,
+        ttl: int = 400 * 24 * 60 * 60,
+    ) -> None:
+        self.r = client
+        self.prefix = prefix
+        self.max_events = max_events
+        self.ttl = ttl
+
+    def _key(self, uid: str, month: str) -> str:
+        return f"{self.prefix}usage:{month}:{uid}"
+
+    def load(self, uid: str, month: str) -> list[int] | None:
+        values = self.r.hmget(self._key(uid, month), *MonthlyUsage._fields)
+        if all(v is None for v in values):
+            return None
+        return [int(v or 0) for v in values]
+
+    def write(
+        self, events: list[tuple], deltas: dict[tuple[str, str], list[int]]
+    ) -> None:
+        # MULTI/EXEC：要嘛全部寫入，要嘛都沒寫（flush 失敗重試時不會重複累加）
+        pipe = self.r.pipeline(transaction=True)
+        stream = f"{self.prefix}usage:events"
+        for ts, uid, upstream, calls, tokens, images, tts_chars, latency in events:
+            pipe.xadd(
+                stream,
+                {
+                    "ts": ts,
+                    "user_id": uid,
+                    "upstream": upstream,
+                    "calls": calls,
+                    "tokens": tokens,
+                    "images": images,
+                    "tts_chars": tts_chars,
+                    "latency_ms": latency,
+                },
+                maxlen=self.max_events,
+                approximate=True,
+            )
+        for (uid, month), delta in deltas.items():
+            key = self._key(uid, month)
+            for name, value in zip(MonthlyUsage._fields, delta):
+                if value:
+                    pipe.hincrby(key, name, value)
+            pipe.expire(key, self.ttl)
+        pipe.execute()
+
+
+class UsageLedger:
+    def __init__(
+        self,
+        backend: UsageBackend,
+        tz: datetime.tzinfo | None = None,
+        flush_size: int = 200,
+        flush_every: float = 5.0,
+        max_cached: int = 50_000,
+    ) -> None:
+        self.backend = backend
+        self.tz = tz
+        self.flush_size = flush_size
+        self.flush_every = flush_every
+        self.max_cached = max_cached
+        # 共用的 backend 其他 worker / instance 也在寫 → 快取只信任 flush_every 秒
+        self.refresh = flush_every if backend.shared else None
+        self._events: list[tuple] = []
+        self._deltas: dict[tuple[str, str], list[int]] = {}
+        # key -> (totals, 載入時間)
+        self._cache: OrderedDict[tuple[str, str], tuple[list[int], float]] = (
+            OrderedDict()
+        )
+        # 一把鎖同時保護緩衝區與 backend：flush 只是一次批次寫入，很短
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def month(self, ts: float | None = None) -> str:
+        ts = time.time() if ts is None else ts
+        return datetime.datetime.fromtimestamp(ts, self.tz).strftime("%Y-%m")
+
+    @contextlib.contextmanager
+    def metered(self, uid: str) -> Iterator[Tally]:
+        """Collect usage reported while handling one event and record it."""
+        tally = Tally()
+        token = _tally.set(tally)
+        try:
+            yield tally
+        finally:
+            _tally.reset(token)
+            self.record(uid, tally)
+
+    def record(self, uid: str, tally: Tally, ts: float | None = None) -> None:
+        ts = time.time() if ts is None else ts
+        month = self.month(ts)
+        totals = tally.totals()
+        with self._lock:
+            for upstream, (*amounts, secs) in list(tally.upstreams.items()):
+                self._events.append(
+                    (int(ts), uid, upstream, *amounts, int(secs * 1000))
+                )
+            for who in (uid, ALL_USERS):
+                key = (who, month)
+                cached = self._cached(key)
+                delta = self._deltas.setdefault(key, [0, 0, 0, 0])
+                for i, value in enumerate(totals):
+                    cached[i] += value
+                    delta[i] += value
+            full = max(len(self._events), len(self._deltas)) >= self.flush_size
+        if full:
+            self.flush()
+
+    def monthly(self, uid: str, month: str | None = None) -> MonthlyUsage:
+        with self._lock:
+            return MonthlyUsage(*self._cached((uid, month or self.month())))
+
+    def _cached(self, key: tuple[str, str]) -> list[int]:
+        """Current totals for ``key`` (caller holds ``_lock``)."""
+        now = time.monotonic()
+        hit = self._cache.get(key)
+        if hit is not None and (self.refresh is None or now - hit[1] < self.refresh):
+            self._cache.move_to_end(key)
+            return hit[0]
+        totals = self.backend.load(*key) or [0, 0, 0, 0]
+        # 尚未寫入的增量也要算進去（快取被淘汰或重新載入的情況）
+        for i, value in enumerate(self._deltas.get(key, ())):
+            totals[i] += value
+        self._cache[key] = (totals, now)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return totals
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._events and not self._deltas:
+                return
+            try:
+                self.backend.write(self._events, self._deltas)
+            except Exception:
+                # 緩衝區保留，下次再寫
+                logging.exception("usage ledger flush failed; retrying later")
+                return
+            self._events = []
+            self._deltas = {}
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="usage", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_every):
+            self.flush()
+
+
+__all__ = [
+    "ALL_USERS",
+    "CREATE_USAGE_TABLES_SQL",
+    "MonthlyUsage",
+    "RedisUsageBackend",
+    "SQLiteUsageBackend",
+    "Tally",
+    "UsageBackend",
+    "UsageLedger",
+    "add",
+    "count_message",
+    "observe_upstream",
+]